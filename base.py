@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 
 import argparse
+import json
+import os
 from copy import deepcopy
+from collections import deque
 
 import larpix
 import larpix.io
@@ -9,6 +12,10 @@ import larpix.logger
 import numpy as np
 import time
 
+import readback
+import pacman_io
+import read_ring
+
 LARPIX_10X10_SCRIPTS_VERSION='v1.0.3'
 
 _default_controller_config=None
@@ -54,24 +61,6 @@ vddd_reg[6] = 0x0002413b
 vddd_reg[7] = 0x0002413d
 vddd_reg[8] = 0x0002413f
 
-def unique_channel_id(io_group, io_channel, chip_id, channel_id):
-    return channel_id + 100*(chip_id + 1000*(io_channel + 1000*(io_group)))
-
-def from_unique_to_chip_key(unique):
-    io_group = (unique // (100*1000*1000)) % 1000
-    io_channel = (unique // (100*1000)) % 1000
-    chip_id = (unique // 100) % 1000
-    return larpix.Key(io_group, io_channel, chip_id)
-
-def from_unique_to_channel_id(unique):
-    return int(unique) % 100
-
-def from_unique_to_chip_id(unique):
-    return int(unique//100) % 1000
-
-def chip_key_to_string(chip_key):
-    return '-'.join([str(int(chip_key.io_group)),str(int(chip_key.io_channel)),str(int(chip_key.chip_id))])
-
 def get_tile_from_io_channel(io_channel):
     return np.floor( (io_channel-1-((io_channel-1)%4))/4+1)
 
@@ -122,14 +111,185 @@ def power_registers():
     return data
 
 
-def flush_data(controller, runtime=0.1, rate_limit=0., max_iterations=10):
-    ###### continues to read data until data rate is less than rate_limit
-    for _ in range(max_iterations):
-        controller.run(runtime, 'flush_data')
-        if len(controller.reads[-1])/runtime <= rate_limit:
-            break
+def flush_data(controller, runtime=0.1, rate_limit=0., max_iterations=10, poll_interval=0.01, verbose=False):
+    ###### continuously reads and discards data until the packet rate over the last runtime
+    ###### seconds stays at or below rate_limit (gives up after runtime*max_iterations)
+    ###### returns the time spent flushing, flushed packets are not kept in controller.reads
+    start_time = time.time()
+    already_listening = controller.io.is_listening
+    if not already_listening: controller.start_listening()
+    n_flushed = 0
+    window = deque()
+    quiet_since = start_time
+    while True:
+        time.sleep(min(poll_interval, runtime))
+        packets, _ = controller.read()
+        now = time.time()
+        n_flushed += len(packets)
+        if packets: window.append((now, len(packets)))
+        while window and window[0][0] < now - runtime: window.popleft()
+        if sum([n for _, n in window]) > rate_limit*runtime: quiet_since = now
+        elif now - quiet_since >= runtime: break
+        if now - start_time >= runtime*max_iterations: break
+    if not already_listening: controller.stop_listening()
+    flush_time = time.time() - start_time
+    if verbose: print('flushed {} packets in {:0.3f} s'.format(n_flushed, flush_time))
+    return flush_time
+
+def rotate_logger(c, filename=None):
+    ###### finish the current HDF5 log (if any) and continue logging to a new file on the same controller
+    if hasattr(c,'logger') and c.logger:
+        c.logger.flush()
+        c.logger.disable()
+    if filename is None: c.logger = larpix.logger.HDF5Logger()
+    else: c.logger = larpix.logger.HDF5Logger(filename=filename)
+    print('filename:',c.logger.filename)
+    c.logger.record_configs(list(c.chips.values()))
+    return c.logger
+
+def save_snapshot(c, filename, controller_config=None):
+    ###### post bring-up state: chip configurations, FPGA UART clock ratios and network
+    snapshot = dict(
+        version=LARPIX_10X10_SCRIPTS_VERSION,
+        controller_config=controller_config,
+        network=dict([(str(io_group), sorted(int(io_channel) for io_channel in io_channels)) for io_group, io_channels in c.network.items()]),
+        uart_clock_ratio=dict(),
+        chips=dict(),
+        )
+    for io_group, io_channels in c.network.items():
+        for io_channel in io_channels:
+            chip_keys = c.get_network_keys(io_group, io_channel)
+            if not chip_keys: continue
+            snapshot['uart_clock_ratio']['{}-{}'.format(io_group, io_channel)] = clk_ctrl_2_clk_ratio_map[c[chip_keys[0]].config.clk_ctrl]
+    for chip_key, chip in c.chips.items():
+        snapshot['chips'][str(chip_key)] = chip.config.to_dict()
+    with open(filename,'w') as f: json.dump(snapshot, f, indent=4)
+    print('snapshot:',filename)
+    return snapshot
+
+
+def save_bring_up_config(c):
+    ###### post bring-up chip configurations, restored between QC steps by restore_bring_up_config
+    c.bring_up_configs = dict([(chip_key, deepcopy(chip.config)) for chip_key, chip in c.chips.items()])
+
+
+def quiet_config(config):
+    ###### all channels masked, CSAs off, global threshold at maximum
+    config.channel_mask=[1]*64
+    config.csa_enable=[0]*64
+    config.threshold_global = 255
+    config.enable_hit_veto = 1
+
+
+def restore_bring_up_config(c, chip_keys=None, modify=None, verbose=False):
+    ###### differential write back to the post bring-up configuration (changed per chip by modify(config), if
+    ###### given) followed by readback enforce; returns the enforce result (ok, diff)
+    if not hasattr(c,'bring_up_configs'): save_bring_up_config(c)
+    chip_keys = list(reversed(c.chips.keys())) if chip_keys is None else list(chip_keys)
+    chip_config_pairs = []
+    for chip_key in chip_keys:
+        previous = c[chip_key].config
+        c[chip_key].config = deepcopy(c.bring_up_configs.get(chip_key, previous))
+        if modify is not None: modify(c[chip_key].config)
+        chip_config_pairs.append((chip_key, previous))
+    c.differential_write_configuration(chip_config_pairs, write_read=0, connection_delay=0.01)
+    flush_data(c, verbose=verbose)
+    ok, diff = readback.enforce_configuration(c, chip_keys, timeout=0.1, n=3, n_verify=3)
+    if verbose: print('bring-up configuration restored on',len(chip_keys),'chips' if ok else 'chips, config error on {} chips'.format(len(diff)))
+    return ok, diff
+
+
+def load_snapshot(c, filename):
+    ###### restore chip configurations and FPGA UART clock ratios from a snapshot (no chip writes)
+    with open(filename,'r') as f: snapshot = json.load(f)
+    if sorted(snapshot['chips'].keys()) != sorted(str(chip_key) for chip_key in c.chips):
+        raise RuntimeError('snapshot',filename,'does not match the hydra network')
+    for chip_key in c.chips:
+        c[chip_key].config.from_dict(snapshot['chips'][str(chip_key)])
+    for chain, ratio in snapshot['uart_clock_ratio'].items():
+        io_group, io_channel = [int(i) for i in chain.split('-')]
+        c.io.set_uart_clock_ratio(io_channel, ratio, io_group=io_group)
+    return snapshot
+
+
+def init_chain(c, io_group, io_channel, verbose=False):
+    ###### re-initialize a single hydra chain and restore its chips' configuration, other chains untouched
+    chip_keys = c.get_network_keys(io_group, io_channel, root_first_traversal=False)
+    configs = dict([(chip_key, deepcopy(c[chip_key].config)) for chip_key in chip_keys])
+    if verbose: print('re-initializing chain',io_group,io_channel,'(',len(chip_keys),'chips )')
+
+    ##### drop chips that still respond to power-up UART speed (leaf first), then release the network
+    for chip_key in chip_keys:
+        c[chip_key].config.clk_ctrl = 0
+        c.write_configuration(chip_key, 'clk_ctrl')
+    c.io.set_uart_clock_ratio(io_channel, clk_ctrl_2_clk_ratio_map[0], io_group=io_group)
+    c.reset_network(io_group, io_channel)
+
+    group_packets_by_io_group = c.io.group_packets_by_io_group
+    c.io.group_packets_by_io_group = False # throttle the data rate to insure no FIFO collisions
+    try:
+        c.init_network(io_group, io_channel, modify_mosi=False)
+
+        for chip_key in chip_keys:
+            c[chip_key].config.clk_ctrl = configs[chip_key].clk_ctrl
+            c.write_configuration(chip_key, 'clk_ctrl')
+        c.io.set_uart_clock_ratio(io_channel, clk_ctrl_2_clk_ratio_map[configs[chip_keys[0]].clk_ctrl], io_group=io_group)
+
+        ##### restore last known configuration
+        for chip_key in chip_keys: c[chip_key].config = configs[chip_key]
+        c.io.double_send_packets = True
+        c.multi_write_configuration([(chip_key, None) for chip_key in chip_keys], write_read=0, connection_delay=0.01)
+        c.io.double_send_packets = False
+        flush_data(c, verbose=verbose)
+        return readback.enforce_configuration(c, chip_keys, timeout=0.1, n=10, n_verify=10)
+    finally:
+        c.io.group_packets_by_io_group = group_packets_by_io_group
+
+
+def warm_start(c, snapshot, verbose=True):
+    ###### verify a powered and configured tile against a snapshot; re-initialize only the chains that fail
+    ###### returns the list of (io_group, io_channel) chains that could not be recovered
+    load_snapshot(c, snapshot)
+    ok, diff = readback.verify_configuration(c, timeout=0.1, n=2)
+    if ok:
+        if verbose: print('warm start: all',len(c.chips),'chips match snapshot',snapshot)
+        return []
+    if len(diff) == len(c.chips) and all(value[1] is None for chip_diff in diff.values() for value in chip_diff.values()):
+        if verbose: print('warm start: no chip responded')
+        return sorted(set((chip_key.io_group, chip_key.io_channel) for chip_key in c.chips))
+
+    failed = []
+    for chain in sorted(set((chip_key.io_group, chip_key.io_channel) for chip_key in diff)):
+        chain_keys = [chip_key for chip_key in diff if (chip_key.io_group, chip_key.io_channel) == chain]
+        if verbose: print('warm start: chain',chain,len(chain_keys),'chips differ from snapshot')
+        ##### chips that respond only need their registers rewritten
+        if not all(value[1] is None for chip_key in chain_keys for value in diff[chip_key].values()):
+            ok, _ = readback.enforce_configuration(c, chain_keys, timeout=0.1, n=3, n_verify=2)
+            if ok: continue
+        ok, _ = init_chain(c, *chain, verbose=verbose)
+        if not ok: failed.append(chain)
+    return failed
+
+
+def recover_chains(c, chip_keys, verbose=False):
+    ###### re-initialize only the chains holding chip_keys, restoring their chips' last known configuration
+    ###### returns the list of (io_group, io_channel) chains that could not be recovered
+    failed = []
+    for chain in sorted(set((larpix.Key(chip_key).io_group, larpix.Key(chip_key).io_channel) for chip_key in chip_keys)):
+        timeStart = time.time()
+        ok, diff = init_chain(c, *chain, verbose=verbose)
+        if verbose: print('chain',chain,'recovered' if ok else 'NOT recovered','in %.3f s'%(time.time()-timeStart))
+        if not ok: failed.append(chain)
+    return failed
+
+
+def reset(c, config=None, enforce=False, verbose=False, modify_power=False, vdda=46020, chip_keys=None):
+    ##### chain-level recovery, other chains untouched; full reset only if it fails
+    if chip_keys:
+        failed = recover_chains(c, chip_keys, verbose=verbose)
+        if not failed: return c
+        print('chain recovery failed on',failed,'==> full reset')
 
-def reset(c, config=None, enforce=False, verbose=False, modify_power=False, vdda=46020):
     if modify_power:
         c.io.set_reg(0x00000010, 0, io_group=io_group)
         time.sleep(0.1)
@@ -182,7 +342,7 @@ def reset(c, config=None, enforce=False, verbose=False, modify_power=False, vdda
     c.io.gruop_packets_by_io_group = True
     chip_register_pairs = c.differential_write_configuration(chip_config_pairs, write_read=0, connection_delay=0.01)
     chip_register_pairs = c.differential_write_configuration(chip_config_pairs, write_read=0, connection_delay=0.01)
-    flush_data(c)
+    flush_data(c, verbose=verbose)
 
     #for chip_key in c.chips:
     #    chip_registers = [(chip_key, i) for i in [82,83,125,129]]
@@ -195,11 +355,13 @@ def reset(c, config=None, enforce=False, verbose=False, modify_power=False, vdda
     if hasattr(c,'logger') and c.logger: c.logger.record_configs(list(c.chips.values()))
     return c
         
-def main(controller_config=_default_controller_config, pacman_version=_default_pacman_version, logger=_default_logger, vdda=46020, reset=_default_reset, enforce=True, no_enforce=False, verbose=True, modify_power=True, **kwargs):
+def main(controller_config=_default_controller_config, pacman_version=_default_pacman_version, logger=_default_logger, vdda=46020, reset=_default_reset, enforce=True, no_enforce=False, verbose=True, modify_power=True, snapshot=None, warm=False, max_reads=read_ring._default_max_reads, max_packets=read_ring._default_max_packets, spill_filename=read_ring._default_spill_filename, **kwargs):
     if verbose: print('[START BASE]')
     ###### create controller with pacman io
     c = larpix.Controller()
-    c.io = larpix.io.PACMAN_IO(relaxed=True)
+    c.io = pacman_io.PACMAN_IO(relaxed=True)
+    ###### bounded c.reads, evicted reads are dropped or spilled to disk
+    read_ring.set_read_retention(c, max_reads=max_reads, max_packets=max_packets, spill_filename=spill_filename, verbose=verbose)
     if no_enforce: enforce = False
 
      ##### setup hydra network configuration
@@ -212,6 +374,24 @@ def main(controller_config=_default_controller_config, pacman_version=_default_p
     else:
         c.load(controller_config)
 
+
+    ###### warm start: tile still powered and configured, skip power, reset and network init
+    if warm and snapshot is not None and os.path.exists(snapshot):
+        if logger:
+            if verbose: print('logger enabled')
+            rotate_logger(c, kwargs.get('filename', None))
+        failed = warm_start(c, snapshot, verbose=verbose)
+        if not failed:
+            if hasattr(c,'logger') and c.logger: c.logger.record_configs(list(c.chips.values()))
+            save_bring_up_config(c)
+            save_snapshot(c, snapshot, controller_config)
+            if verbose: print('[FINISH BASE]')
+            return c
+        print('warm start failed on chains',failed,'==> full bring-up')
+        if hasattr(c,'logger') and c.logger:
+            c.logger.flush()
+            c.logger.disable()
+        return main(controller_config=controller_config, pacman_version=pacman_version, logger=logger, vdda=vdda, reset=reset, enforce=enforce, verbose=verbose, modify_power=modify_power, snapshot=snapshot, warm=False, max_reads=max_reads, max_packets=max_packets, spill_filename=spill_filename, **kwargs)
     
     ###### set power to tile    
     if modify_power:
@@ -249,10 +429,7 @@ def main(controller_config=_default_controller_config, pacman_version=_default_p
     
     if logger:
         if verbose: print('logger enabled')
-        if 'filename' in kwargs: c.logger = larpix.logger.HDF5Logger(filename=kwargs['filename'])
-        else: c.logger = larpix.logger.HDF5Logger()
-        print('filename:',c.logger.filename)
-        c.logger.record_configs(list(c.chips.values()))
+        rotate_logger(c, kwargs.get('filename', None))
 
 
     ##### issue hard reset (resets state machines and configuration memory)
@@ -303,10 +480,12 @@ def main(controller_config=_default_controller_config, pacman_version=_default_p
     c.io.gruop_packets_by_io_group = True
     chip_register_pairs = c.differential_write_configuration(chip_config_pairs, write_read=0, connection_delay=0.01)
     chip_register_pairs = c.differential_write_configuration(chip_config_pairs, write_read=0, connection_delay=0.01)
-    flush_data(c)
+    flush_data(c, verbose=verbose)
 
     if not enforce: 
         if hasattr(c,'logger') and c.logger: c.logger.record_configs(list(c.chips.values()))
+        save_bring_up_config(c)
+        if snapshot is not None: save_snapshot(c, snapshot, controller_config)
         if verbose: print('[FINISH BASE]')
         return c
 
@@ -321,6 +500,8 @@ def main(controller_config=_default_controller_config, pacman_version=_default_p
     if verbose: print('base configuration successfully enforced')
     
     if hasattr(c,'logger') and c.logger: c.logger.record_configs(list(c.chips.values()))
+    save_bring_up_config(c)
+    if snapshot is not None: save_snapshot(c, snapshot, controller_config)
     if verbose: print('[FINISH BASE]')
     return c
 
@@ -333,6 +514,11 @@ if __name__ == '__main__':
     parser.add_argument('--no_enforce', action='store_true', default=False, help='''Flag whether to enforce config''')
     parser.add_argument('--no_reset', default=_default_reset, action='store_false', help='''Flag that if present, chips will NOT be reset, otherwise chips will be reset during initialization''')
     parser.add_argument('--vdda', default=46020, type=int, help='''VDDA setting during bringup''')
+    parser.add_argument('--snapshot', default=None, type=str, help='''JSON file to save the post bring-up state to (and to warm start from with --warm)''')
+    parser.add_argument('--warm', default=False, action='store_true', help='''Flag that if present, verify a still powered tile against --snapshot and only re-initialize chains that fail''')
+    parser.add_argument('--max_reads', default=read_ring._default_max_reads, type=int, help='''Number of reads kept in controller.reads (default=%(default)s)''')
+    parser.add_argument('--max_packets', default=read_ring._default_max_packets, type=int, help='''Total number of packets kept in controller.reads (default: no limit)''')
+    parser.add_argument('--spill_filename', default=read_ring._default_spill_filename, type=str, help='''Packet HDF5 file to append reads dropped from controller.reads to (default: discard them)''')
     args = parser.parse_args()
     c = main(**vars(args))
 
@@ -0,0 +1,123 @@
+'''
+Benchmarks raw and packet HDF5 writing for each compression mode
+
+Synthetic data:
+  - noise:     random chips, channels, ADC values and timestamps
+  - pedestal:  periodic triggers cycling over all channels, ADC around a per-channel pedestal
+
+For every mode of hdf5_compression (plus the larpix-control raw file default)
+the messages are appended in batches as the raw writer does, and the decoded
+packets as the converter does. Sustained write MB/s (of uncompressed input)
+and compression ratio are printed, with ``SLOW`` where the writer would not
+keep up with --data_rate.
+
+Usage:
+  python3 benchmark_compression.py --n_msgs 20000 --data_rate 20
+
+'''
+import larpix.format.rawhdf5format as rhdf5
+import larpix.format.pacman_msg_format as pacman_msg_format
+
+import hdf5_compression
+import pacman_decoder
+import convert_rawhdf5
+
+import os
+import argparse
+import tempfile
+import time
+import numpy as np
+import h5py
+
+_default_n_msgs=20000
+_default_words_per_msg=32
+_default_batch_size=1000 # messages per append
+_default_data_rate=10. # [MB/s] raw data rate the writer has to sustain
+_default_seed=0
+
+
+def packet_words(chip_id, channel_id, timestamp, dataword, trigger_type):
+    ##### 64-bit LArPix data packets with odd parity
+    words = (np.uint64(0) | chip_id.astype(np.uint64) << np.uint64(2) | channel_id.astype(np.uint64) << np.uint64(10)
+             | timestamp.astype(np.uint64) << np.uint64(16) | dataword.astype(np.uint64) << np.uint64(48)
+             | trigger_type.astype(np.uint64) << np.uint64(56))
+    return words | (np.uint64(1) - pacman_decoder._parity(words).astype(np.uint64)) << np.uint64(63)
+
+
+def synthetic_msgs(kind, n_msgs, words_per_msg, seed=_default_seed):
+    rng = np.random.default_rng(seed)
+    n = n_msgs*words_per_msg
+    if kind == 'noise':
+        chip_id = rng.integers(11, 111, n)
+        channel_id = rng.integers(0, 64, n)
+        timestamp = rng.integers(0, 2**31, n)
+        dataword = rng.integers(0, 256, n)
+        trigger_type = np.zeros(n, dtype=int)
+    else:
+        i = np.arange(n)
+        chip_id = 11 + (i // 64) % 100
+        channel_id = i % 64
+        timestamp = (i * 10) % 2**31
+        pedestal = np.random.default_rng(seed+1).normal(80, 10, (100, 64))
+        dataword = np.clip(np.round(pedestal[chip_id-11, channel_id] + rng.normal(0, 2, n)), 0, 255)
+        trigger_type = np.full(n, 3)
+
+    words = np.zeros((n, pacman_msg_format.WORD_LEN), dtype=np.uint8)
+    words[:,0] = ord(pacman_msg_format.WORD_TYPE_DATA)
+    words[:,1] = 1 + chip_id % 4
+    words[:,2:6] = (timestamp.astype('<u4')[:,np.newaxis]).view(np.uint8)
+    words[:,8:16] = packet_words(chip_id, channel_id, timestamp, dataword, trigger_type).astype('<u8')[:,np.newaxis].view(np.uint8)
+    header = np.zeros((n_msgs, pacman_msg_format.HEADER_LEN), dtype=np.uint8)
+    header[:,0] = ord(pacman_msg_format.MSG_TYPE_DATA)
+    header[:,1:5] = (1700000000 + np.arange(n_msgs, dtype='<u4')//100)[:,np.newaxis].view(np.uint8)
+    header[:,6:8] = np.full((n_msgs, 1), words_per_msg, dtype='<u2').view(np.uint8)
+    msgs = np.concatenate([header, words.reshape(n_msgs, -1)], axis=1)
+    return [msg.tobytes() for msg in msgs], [1]*n_msgs
+
+
+def write_raw(filename, compression, msgs, io_groups, batch_size):
+    if compression == 'default': rhdf5.to_rawfile(filename=filename, io_version=pacman_msg_format.latest_version)
+    else: hdf5_compression.create_rawfile(filename, compression=compression)
+    for i in range(0, len(msgs), batch_size):
+        hdf5_compression.to_rawfile(filename, msgs[i:i+batch_size], msg_headers={'io_groups': io_groups[i:i+batch_size]})
+
+
+def write_packets(filename, compression, packets, batch_size):
+    convert_rawhdf5.create_packet_file(filename, compression)
+    with h5py.File(filename, 'a') as f:
+        for i in range(0, len(packets), batch_size):
+            convert_rawhdf5.append_packets(f, packets[i:i+batch_size])
+
+
+def report(label, compression, n_bytes, filename, timeEnd, data_rate):
+    rate = n_bytes/1e6/timeEnd
+    print('{:>9} {:>7} {:>11}: {:8.1f} MB/s  ratio {:5.2f}  {}'.format(label[0], label[1], compression, rate, n_bytes/os.path.getsize(filename), 'ok' if rate > data_rate else 'SLOW'))
+
+
+def main(n_msgs=_default_n_msgs, words_per_msg=_default_words_per_msg, batch_size=_default_batch_size, data_rate=_default_data_rate, **kwargs):
+    print('compression modes:', ', '.join(hdf5_compression.modes()))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for kind in ('noise', 'pedestal'):
+            msgs, io_groups = synthetic_msgs(kind, n_msgs, words_per_msg)
+            n_bytes = sum([len(msg) for msg in msgs])
+            packets = pacman_decoder.decode_msgs(msgs, io_groups)
+            print('\n{}: {} messages, {:0.1f} MB raw, {:0.1f} MB packets'.format(kind, n_msgs, n_bytes/1e6, packets.nbytes/1e6))
+            for compression in ['default'] + hdf5_compression.modes():
+                filename = os.path.join(tmpdir, '{}-raw-{}.h5'.format(kind, compression.replace(':','-')))
+                timeStart = time.time()
+                write_raw(filename, compression, msgs, io_groups, batch_size)
+                report((kind, 'raw'), compression, n_bytes, filename, time.time()-timeStart, data_rate)
+            for compression in hdf5_compression.modes():
+                filename = os.path.join(tmpdir, '{}-packets-{}.h5'.format(kind, compression.replace(':','-')))
+                timeStart = time.time()
+                write_packets(filename, compression, packets, batch_size*words_per_msg)
+                report((kind, 'packets'), compression, packets.nbytes, filename, time.time()-timeStart, data_rate)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--n_msgs', default=_default_n_msgs, type=int, help='''Messages per data set (default=%(default)s)''')
+    parser.add_argument('--words_per_msg', default=_default_words_per_msg, type=int, help='''Packets per message (default=%(default)s)''')
+    parser.add_argument('--batch_size', default=_default_batch_size, type=int, help='''Messages per append (default=%(default)s)''')
+    parser.add_argument('--data_rate', default=_default_data_rate, type=float, help='''Raw data rate [MB/s] the writer has to sustain (default=%(default)s)''')
+    args = parser.parse_args()
+    main(**vars(args))
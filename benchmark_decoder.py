@@ -0,0 +1,94 @@
+'''
+Benchmarks the vectorized PACMAN decoder against the packet object path
+
+Decodes the same messages with
+  - objects:   pacman_msg_format.parse + hdf5format packet encoding (one Packet_v2 per packet)
+  - msgs:      pacman_decoder.decode_msgs on the message list
+  - buffer:    pacman_decoder.decode_buffer on the concatenated messages
+  - memmap:    pacman_decoder.decode_buffer on a memory-mapped binary dump
+checks that all results are identical and prints the packet rate of each.
+
+Messages are synthetic (random data words) unless --raw_filename is given.
+
+Usage:
+  python3 benchmark_decoder.py --n_msgs 20000
+  python3 benchmark_decoder.py --raw_filename <raw file> --n_msgs 50000
+
+'''
+import larpix.format.pacman_msg_format as pacman_msg_format
+import larpix.format.hdf5format as hdf5format
+
+import pacman_decoder
+import hdf5_compression
+
+import os
+import argparse
+import tempfile
+import time
+import numpy as np
+
+_default_raw_filename=None
+_default_n_msgs=10000
+_default_words_per_msg=16
+_default_seed=0
+
+
+def synthetic_msgs(n_msgs, words_per_msg, seed=_default_seed):
+    rng = np.random.default_rng(seed)
+    msgs, io_groups = [], []
+    for _ in range(n_msgs):
+        words = [('DATA', int(rng.integers(1,33)), int(rng.integers(0,2**32)), rng.bytes(8)) for _ in range(rng.integers(0, 2*words_per_msg))]
+        if rng.random() < 0.05: words.append(('TRIG', bytes([1]), int(rng.integers(0,2**32))))
+        if rng.random() < 0.05: words.append(('SYNC', b'S', 1, int(rng.integers(0,2**32))))
+        msgs.append(pacman_msg_format.format_msg('DATA', words))
+        io_groups.append(int(rng.integers(1,3)))
+    return msgs, io_groups
+
+
+def decode_objects(msgs, io_groups):
+    ##### existing path: packet objects, then the hdf5format row encoding
+    packets = []
+    for msg, io_group in zip(msgs, io_groups):
+        packets += pacman_msg_format.parse(msg, io_group=io_group)
+    rows = [hdf5format._encode_packet(packet, pacman_decoder.version, 'packets') for packet in packets]
+    return np.array([row for row in rows if row], dtype=pacman_decoder.packets_dtype)
+
+
+def timed(label, n_msgs, f, *args, **kwargs):
+    timeStart = time.time()
+    packets = f(*args, **kwargs)
+    timeEnd = time.time()-timeStart
+    print('{:>8}: {:8.3f} s  {:12.0f} packets/s  {:10.0f} msgs/s'.format(label, timeEnd, len(packets)/timeEnd, n_msgs/timeEnd))
+    return packets, timeEnd
+
+
+def main(raw_filename=_default_raw_filename, n_msgs=_default_n_msgs, words_per_msg=_default_words_per_msg, **kwargs):
+    if raw_filename is None:
+        msgs, io_groups = synthetic_msgs(n_msgs, words_per_msg)
+    else:
+        rd = hdf5_compression.from_rawfile(raw_filename, start=0, end=n_msgs)
+        msgs, io_groups = [bytes(msg) for msg in rd['msgs']], rd['msg_headers']['io_groups']
+    n_msgs = len(msgs)
+    print(n_msgs,'messages,',sum([len(msg) for msg in msgs])/1e6,'MB')
+
+    reference, t_reference = timed('objects', n_msgs, decode_objects, msgs, io_groups)
+    results = dict()
+    results['msgs'] = timed('msgs', n_msgs, pacman_decoder.decode_msgs, msgs, io_groups)
+    buf = b''.join(msgs)
+    results['buffer'] = timed('buffer', n_msgs, pacman_decoder.decode_buffer, buf, io_groups)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dump_filename = os.path.join(tmpdir, 'msgs.bin')
+        with open(dump_filename, 'wb') as f: f.write(buf)
+        results['memmap'] = timed('memmap', n_msgs, pacman_decoder.decode_buffer, np.memmap(dump_filename, dtype=np.uint8, mode='r'), io_groups)
+
+    for label, (packets, t) in results.items():
+        same = len(packets) == len(reference) and all([np.array_equal(packets[field], reference[field]) for field in reference.dtype.names])
+        print('{:>8}: x{:0.1f} faster, {}'.format(label, t_reference/t, 'identical' if same else 'MISMATCH'))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--raw_filename', default=_default_raw_filename, type=str, help='''Raw HDF5 file to take messages from (default: synthetic messages)''')
+    parser.add_argument('--n_msgs', default=_default_n_msgs, type=int, help='''Number of messages to decode (default=%(default)s)''')
+    parser.add_argument('--words_per_msg', default=_default_words_per_msg, type=int, help='''Average data words per synthetic message (default=%(default)s)''')
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,123 @@
+'''
+Channel key codec
+
+A channel is identified by one ``uint64``, the bit-packed
+``(io_group, io_channel, chip_id, channel_id)``:
+
+    bits  0- 5  channel_id
+    bits  6-13  chip_id
+    bits 14-21  io_channel
+    bits 22-29  io_group
+
+so that ``key >> 6`` is the chip and grouping packets by channel or by chip
+is one integer operation. ``encode`` / ``decode`` work on scalars or numpy
+arrays; ``to_chip_key`` / ``chip_key_string`` convert to ``larpix.Key`` and
+to the ``'<io_group>-<io_channel>-<chip_id>'`` strings used in the json files.
+
+Usage:
+    import channel_key
+    keys = channel_key.encode_packets(f['packets'][mask])
+    unique_keys, n = np.unique(keys, return_counts=True)
+    unique_keys, adc_by_channel = channel_key.group(keys, f['packets']['dataword'][mask])
+    io_group, io_channel, chip_id, channel_id = channel_key.decode(unique_keys)
+    chip_keys = channel_key.to_chip_keys(unique_keys)
+    strings = channel_key.to_strings(unique_keys)
+
+'''
+import larpix
+
+import numpy as np
+
+channel_bits=6
+chip_bits=8
+io_channel_bits=8
+io_group_bits=8
+
+_channel_shift=np.uint64(0)
+_chip_shift=np.uint64(channel_bits)
+_io_channel_shift=np.uint64(channel_bits+chip_bits)
+_io_group_shift=np.uint64(channel_bits+chip_bits+io_channel_bits)
+
+
+def _mask(bits): return np.uint64((1 << bits) - 1)
+
+
+def encode(io_group, io_channel, chip_id, channel_id):
+    return (np.asarray(io_group, dtype=np.uint64) << _io_group_shift
+            | np.asarray(io_channel, dtype=np.uint64) << _io_channel_shift
+            | np.asarray(chip_id, dtype=np.uint64) << _chip_shift
+            | np.asarray(channel_id, dtype=np.uint64) << _channel_shift)
+
+
+def encode_packets(packets):
+    ##### numpy structured array with io_group, io_channel, chip_id and channel_id fields (hdf5format packets)
+    return encode(packets['io_group'], packets['io_channel'], packets['chip_id'], packets['channel_id'])
+
+
+def group(keys, *values):
+    '''
+    Group values by key with one sort
+
+    :returns: ``(unique_keys, <values[0] split by key>, ...)``, each split a list of arrays in ``unique_keys`` order
+
+    '''
+    keys = np.asarray(keys)
+    order = np.argsort(keys, kind='stable')
+    unique_keys, start = np.unique(keys[order], return_index=True)
+    return (unique_keys,) + tuple([np.split(np.asarray(value)[order], start[1:]) for value in values])
+
+
+def from_chip_key(chip_key, channel_id):
+    chip_key = larpix.Key(chip_key)
+    return encode(chip_key.io_group, chip_key.io_channel, chip_key.chip_id, channel_id)
+
+
+def decode(key):
+    '''
+    :returns: ``(io_group, io_channel, chip_id, channel_id)``, each the shape of ``key``
+
+    '''
+    key = np.asarray(key, dtype=np.uint64)
+    return (io_group(key), io_channel(key), chip_id(key), channel_id(key))
+
+
+def io_group(key): return (np.asarray(key, dtype=np.uint64) >> _io_group_shift) & _mask(io_group_bits)
+
+
+def io_channel(key): return (np.asarray(key, dtype=np.uint64) >> _io_channel_shift) & _mask(io_channel_bits)
+
+
+def chip_id(key): return (np.asarray(key, dtype=np.uint64) >> _chip_shift) & _mask(chip_bits)
+
+
+def channel_id(key): return (np.asarray(key, dtype=np.uint64) >> _channel_shift) & _mask(channel_bits)
+
+
+def chip(key):
+    ##### chip part of the key, same value for all channels of a chip
+    return np.asarray(key, dtype=np.uint64) >> _chip_shift
+
+
+def to_chip_key(key):
+    return larpix.Key(*[int(field) for field in decode(key)[:3]])
+
+
+def to_chip_keys(keys):
+    return [larpix.Key(*fields) for fields in zip(*[field.tolist() for field in decode(keys)[:3]])]
+
+
+def chip_key_string(chip_key):
+    return '-'.join([str(int(chip_key.io_group)),str(int(chip_key.io_channel)),str(int(chip_key.chip_id))])
+
+
+def to_string(key):
+    return '-'.join([str(int(field)) for field in decode(key)[:3]])
+
+
+def to_strings(keys):
+    return ['-'.join(map(str, fields)) for fields in zip(*[field.tolist() for field in decode(keys)[:3]])]
+
+
+def from_string(string, channel_id=0):
+    ##### '<io_group>-<io_channel>-<chip_id>'
+    return encode(*[int(field) for field in string.split('-')], channel_id)
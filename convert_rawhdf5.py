@@ -0,0 +1,86 @@
+'''
+Converts a raw PACMAN HDF5 file (start_run_log_raw) to a packet HDF5 file
+
+The raw file is split into ranges of ``--chunk_size`` messages, each range is
+read and decoded (pacman_decoder) by a worker process and the packet arrays
+are appended to the output ``packets`` dataset in message order. The output
+has the same layout as files written by ``larpix.format.hdf5format.to_file``
+and can be used directly by plot_metric, pedestal_qc and the rate analyses.
+
+Usage:
+  python3 convert_rawhdf5.py <raw file> --output_filename <packet file> --workers 8
+
+'''
+import pacman_decoder
+import hdf5_compression
+
+import os
+import argparse
+import time
+import multiprocessing
+import h5py
+
+_default_output_filename=None
+_default_workers=None
+_default_chunk_size=20000 # messages per worker task
+_default_fifo_diagnostics=False
+_default_compression=hdf5_compression._default_compression
+
+
+def decode_range(args):
+    filename, start, end, fifo_diagnostics = args
+    return pacman_decoder.decode_rawfile(filename, start=start, end=end, fifo_diagnostics=fifo_diagnostics)
+
+
+def message_ranges(n_msgs, chunk_size):
+    return [(start, min(start+chunk_size, n_msgs)) for start in range(0, n_msgs, chunk_size)]
+
+
+def create_packet_file(filename, compression=_default_compression):
+    ##### empty packet file with the larpix hdf5 header and datasets
+    hdf5_compression.create_packet_file(filename, compression=compression, version=pacman_decoder.version)
+
+
+def append_packets(f, packets):
+    dset = f['packets']
+    start_index = dset.shape[0]
+    dset.resize(start_index + len(packets), axis=0)
+    dset[start_index:] = packets
+
+
+def main(input_filename, output_filename=_default_output_filename, workers=_default_workers, chunk_size=_default_chunk_size, fifo_diagnostics=_default_fifo_diagnostics, compression=_default_compression):
+    time_initial = time.time()
+    if output_filename is None:
+        output_filename = os.path.splitext(input_filename)[0] + '-packets.h5'
+    if os.path.exists(output_filename): raise RuntimeError('{} exists'.format(output_filename))
+    if workers is None: workers = os.cpu_count()
+
+    n_msgs = hdf5_compression.len_rawfile(input_filename)
+    ranges = message_ranges(n_msgs, chunk_size)
+    print('converting',n_msgs,'messages in',len(ranges),'chunks with',workers,'workers')
+
+    create_packet_file(output_filename, compression)
+    n_packets = 0
+    with h5py.File(output_filename, 'a') as f:
+        with multiprocessing.Pool(workers) as pool:
+            ##### imap keeps message order while later chunks are decoded
+            for i, packets in enumerate(pool.imap(decode_range, [(input_filename, start, end, fifo_diagnostics) for start, end in ranges])):
+                append_packets(f, packets)
+                n_packets += len(packets)
+                print('chunk {}/{}: {} packets\r'.format(i+1, len(ranges), n_packets), end='')
+        f['_header'].attrs['modified'] = time.time()
+
+    timeEnd = time.time()-time_initial
+    print('\n==> %.3f seconds --- %d messages, %d packets written to %s'%(timeEnd, n_msgs, n_packets, output_filename))
+    return output_filename
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('input_filename', type=str, help='''Raw HDF5 file to convert''')
+    parser.add_argument('--output_filename', default=_default_output_filename, type=str, help='''Packet HDF5 file to create (default=<input>-packets.h5)''')
+    parser.add_argument('--workers', default=_default_workers, type=int, help='''Number of decoding processes (default=number of cores)''')
+    parser.add_argument('--chunk_size', default=_default_chunk_size, type=int, help='''Messages per decoding task (default=%(default)s)''')
+    parser.add_argument('--fifo_diagnostics', default=_default_fifo_diagnostics, action='store_true', help='''Data was taken with FIFO diagnostics enabled''')
+    parser.add_argument('--compression', default=_default_compression, type=str, help='''Packet dataset compression, options: {}'''.format(', '.join(hdf5_compression.modes())))
+    args = parser.parse_args()
+    main(**vars(args))
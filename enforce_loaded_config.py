@@ -18,6 +18,7 @@ import larpix.logger
 import time
 
 import base
+import readback
 
 _default_config_name='configs/'
 _default_controller_config=None
@@ -113,7 +114,7 @@ def main(config_name=_default_config_name, controller_config=_default_controller
             
     # enforce all config registers
     print('enforcing correct configuration...')
-    ok,diff = c.enforce_configuration(list(c.chips.keys()), timeout=0.01, connection_delay=0.01, n=10, n_verify=10)
+    ok,diff = readback.enforce_configuration(c, list(c.chips.keys()), timeout=0.1, connection_delay=0.01, n=10, n_verify=10)
     if not ok:
         if any([reg not in range(66,74) for key,regs in diff.items() for reg in regs]):
             raise RuntimeError(diff,'\nconfig error on chips',list(diff.keys()))
@@ -155,12 +156,9 @@ def main(config_name=_default_config_name, controller_config=_default_controller
             
     # enforce csa enable registers
     print('enforcing configuration...')
-    for chip_key, chip in reversed(c.chips.items()):
-        ok, diff = c.enforce_registers([(chip_key,list(range(66,74)) )], timeout=0.01, n=10, n_verify=10)
-        if not ok:
-            for key in diff:
-                #print('config error',key,diff[key])
-                raise RuntimeError(diff,'\nconfig error on chips',list(diff.keys())) # BR 3/31/21
+    ok, diff = readback.enforce_registers(c, [(chip_key,list(range(66,74))) for chip_key in reversed(c.chips.keys())], timeout=0.1, n=10, n_verify=10)
+    if not ok:
+        raise RuntimeError(diff,'\nconfig error on chips',list(diff.keys())) # BR 3/31/21
             #sys.exit('Failed to configure CSA\t EXITING')
     print('ENABLED FRONTEND')
 
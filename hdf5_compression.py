@@ -0,0 +1,164 @@
+'''
+Compression settings for raw and packet HDF5 output
+
+A compression mode is one of ``none``, ``gzip`` (``gzip:<level>``),
+``lzf``, or, if the ``hdf5plugin`` package is installed, ``lz4`` and
+``blosc`` (``blosc:<codec>``, e.g. ``blosc:lz4``, ``blosc:zstd``). Packet
+files are created with these filters and with chunk sizes suited to
+appending, after which ``hdf5format.to_file`` and the readers work on them
+as usual (reading blosc/lz4 files requires ``import hdf5plugin``).
+
+HDF5 filters do not compress the variable-length ``msgs`` bytestrings of a
+larpix-control raw file, only their index. Compressed raw files therefore
+use a packed layout instead: the message bytes back to back in one chunked
+``uint8`` dataset ``msg_bytes`` and the end offset of each message in
+``msg_ends``, next to the usual ``msg_headers``. Write them with
+``to_rawfile`` and read them with ``len_rawfile`` / ``from_rawfile`` /
+``read_buffer`` of this module, which also read plain larpix-control raw
+files. See benchmark_compression.py for rates and ratios.
+
+Usage:
+    import hdf5_compression
+    hdf5_compression.create_rawfile(raw_filename, compression='lzf')
+    hdf5_compression.to_rawfile(raw_filename, msgs, msg_headers={'io_groups': io_groups})
+    msgs = hdf5_compression.from_rawfile(raw_filename, start=0, end=1000)['msgs']
+    hdf5_compression.create_packet_file(packet_filename, compression='gzip:1')
+
+'''
+import larpix.format.rawhdf5format as rhdf5
+import larpix.format.hdf5format as hdf5format
+import larpix.format.pacman_msg_format as pacman_msg_format
+
+import time
+import h5py
+import numpy as np
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+_default_compression=None
+_default_raw_chunk_size=4096 # messages per chunk
+_default_raw_byte_chunk_size=1<<14 # message bytes per chunk, small as every append rewrites the last partial chunk
+_default_packet_chunk_size=16384 # packets per chunk (~0.5 MB)
+
+
+def modes():
+    ##### compression modes available here
+    available = ['none', 'gzip', 'lzf']
+    if hdf5plugin is not None: available += ['lz4', 'blosc:lz4', 'blosc:zstd']
+    return available
+
+
+def dataset_options(compression=_default_compression):
+    '''
+    :returns: ``dict`` of ``h5py.Group.create_dataset`` keyword arguments for the compression mode
+
+    '''
+    if compression is None or compression == 'none': return dict()
+    mode, _, option = compression.partition(':')
+    if mode == 'gzip':
+        return dict(compression='gzip', compression_opts=int(option) if option else 4, shuffle=True)
+    if mode == 'lzf':
+        return dict(compression='lzf', shuffle=True)
+    if mode in ('lz4', 'blosc'):
+        if hdf5plugin is None: raise RuntimeError('{} compression requires the hdf5plugin package'.format(compression))
+        if mode == 'lz4': return dict(hdf5plugin.LZ4())
+        return dict(hdf5plugin.Blosc(cname=option if option else 'lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+    raise ValueError('unknown compression {}, options: {}'.format(compression, modes()))
+
+
+def create_rawfile(filename, compression=_default_compression, chunk_size=_default_raw_chunk_size, byte_chunk_size=_default_raw_byte_chunk_size, version=rhdf5.latest_version):
+    ##### packed raw file (msg_bytes, msg_ends, msg_headers) with the requested filters and chunking
+    now = time.time()
+    options = dataset_options(compression)
+    with h5py.File(filename, 'w', libver='latest') as f:
+        f.create_group('meta')
+        f['meta'].attrs['version'] = version
+        f['meta'].attrs['created'] = now
+        f['meta'].attrs['modified'] = now
+        f['meta'].attrs['io_version'] = pacman_msg_format.latest_version
+        f['meta'].attrs['compression'] = str(compression)
+        f.create_dataset('msg_bytes', shape=(0,), maxshape=(None,), chunks=(byte_chunk_size,), dtype='u1', **options)
+        f.create_dataset('msg_ends', shape=(0,), maxshape=(None,), chunks=(chunk_size,), dtype='u8', **options)
+        f.create_dataset('msg_headers', shape=(0,), maxshape=(None,), chunks=(chunk_size,), dtype=rhdf5.dataset_dtypes[version]['msg_headers'], **options)
+        f.swmr_mode = True
+
+
+def is_packed(f):
+    return 'msg_bytes' in f
+
+
+def _append(dset, data):
+    start = dset.shape[0]
+    dset.resize((start+len(data),))
+    dset[start:] = data
+    dset.flush()
+
+
+def to_rawfile(filename, msgs, msg_headers):
+    ##### append to a packed raw file, or to a larpix-control raw file with rhdf5.to_rawfile
+    with h5py.File(filename, 'a', libver='latest') as f:
+        if is_packed(f):
+            f.swmr_mode = True
+            f['meta'].attrs['modified'] = time.time()
+            if not len(msgs): return
+            msg_ends = np.cumsum([len(msg) for msg in msgs], dtype=np.uint64)
+            if len(f['msg_ends']): msg_ends += f['msg_ends'][-1]
+            headers = np.zeros(len(msgs), dtype=f['msg_headers'].dtype)
+            for key, value in msg_headers.items(): headers[key] = value
+            ##### bytes before the offsets pointing into them, headers last: a reader never sees a message without its bytes
+            _append(f['msg_bytes'], np.frombuffer(b''.join(msgs), dtype=np.uint8))
+            _append(f['msg_ends'], msg_ends)
+            _append(f['msg_headers'], headers)
+            return
+    rhdf5.to_rawfile(filename, msgs=msgs, msg_headers=msg_headers, io_version=pacman_msg_format.latest_version)
+
+
+def len_rawfile(filename):
+    with h5py.File(filename, 'r', swmr=True, libver='latest') as f:
+        if not is_packed(f): return rhdf5.len_rawfile(filename)
+        return min(len(f['msg_ends']), len(f['msg_headers']))
+
+
+def read_buffer(filename, start=None, end=None):
+    '''
+    Messages ``[start, end)`` of a raw file as one buffer
+
+    :returns: ``(<uint8 array of the messages back to back>, <message start offsets>, <io group of each message>)``
+
+    '''
+    with h5py.File(filename, 'r', swmr=True, libver='latest') as f:
+        if is_packed(f):
+            n_msgs = min(len(f['msg_ends']), len(f['msg_headers']))
+            start, end, _ = slice(start, end).indices(n_msgs)
+            if end <= start: return np.zeros((0,), dtype=np.uint8), np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=np.uint8)
+            msg_ends = f['msg_ends'][start:end].astype(np.int64)
+            first = int(f['msg_ends'][start-1]) if start > 0 else 0
+            buf = f['msg_bytes'][first:msg_ends[-1]]
+            return buf, np.r_[0, msg_ends[:-1]-first], f['msg_headers'][start:end]['io_groups']
+    rd = rhdf5.from_rawfile(filename, start=start, end=end)
+    msg_len = np.array([len(msg) for msg in rd['msgs']], dtype=np.int64)
+    return np.frombuffer(b''.join(rd['msgs']), dtype=np.uint8), np.cumsum(msg_len)-msg_len, np.asarray(rd['msg_headers']['io_groups'], dtype=np.uint8)
+
+
+def from_rawfile(filename, start=None, end=None):
+    '''
+    :returns: ``dict`` with ``'msgs'`` (``list`` of bytestrings) and ``'msg_headers'`` (``{<field>: <list>}``), as ``rhdf5.from_rawfile``
+
+    '''
+    with h5py.File(filename, 'r', swmr=True, libver='latest') as f:
+        if not is_packed(f): return rhdf5.from_rawfile(filename, start=start, end=end)
+    buf, msg_start, io_groups = read_buffer(filename, start, end)
+    msg_end = np.r_[msg_start[1:], len(buf)]
+    buf = buf.tobytes()
+    return dict(msgs=[buf[i:j] for i, j in zip(msg_start.tolist(), msg_end.tolist())], msg_headers=dict(io_groups=io_groups.tolist()))
+
+
+def create_packet_file(filename, compression=_default_compression, chunk_size=_default_packet_chunk_size, version=hdf5format.latest_version):
+    ##### packets dataset with the requested filters and chunking, the rest of the file from hdf5format.to_file
+    with h5py.File(filename, 'w') as f:
+        dset = f.create_dataset('packets', shape=(0,), maxshape=(None,), chunks=(chunk_size,), dtype=hdf5format.dtypes[version]['packets'], **dataset_options(compression))
+        dset.attrs['compression'] = str(compression)
+    hdf5format.to_file(filename, packet_list=[], version=version, workers=1)
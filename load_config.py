@@ -16,6 +16,7 @@ import larpix.io
 import larpix.logger
 
 import base
+import readback
 
 _default_config_name='configs/'
 _default_controller_config=None
@@ -52,11 +53,11 @@ def main(config_name=_default_config_name, controller_config=_default_controller
 
     # verify
     print('verifying')
-    for chip_key in c.chips:
-        ok, diff = c.verify_configuration(chip_key, timeout=0.1)
-        if not ok:
-            print('config error',diff)
-            print('packets',len(c.reads[-1].extract('packet_type',packet_type=0)))
+    ok, diff = readback.verify_configuration(c, list(c.chips.keys()), timeout=0.1)
+    if not ok:
+        for chip_key in diff:
+            print('config error',chip_key,diff[chip_key])
+        print('packets',len(c.reads[-1].extract('packet_type',packet_type=0)))
     c.io.double_send_packets = False
 
     print('END LOAD CONFIG')
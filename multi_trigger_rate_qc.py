@@ -3,9 +3,13 @@ import larpix.io
 import larpix.logger
 
 import base
+import threshold_search
+import packet_view
+import channel_key
 
 import argparse
 import json
+from copy import deepcopy
 from datetime import datetime
 import h5py
 import numpy as np
@@ -23,43 +27,154 @@ _default_low_dac_threshold = 31
 _cryo_default_low_dac_threshold = 49
 _default_cryo=False
 _default_low_dac_asic_test = False
+_default_isolation_runtime = 0.1
+_default_isolation_rate = 50. # [Hz] off-group triggers for a half of the group to count as noisy
+
+##### test group scheduling
+_chain_rate_budget=2500. # [Hz] expected triggers per hydra chain in one test group
+_group_rate_budget=5000. # [Hz] expected triggers per test group (automatic reset at 10 kHz)
+_default_rate_prior=1000. # [Hz] assumed for chips not yet measured
+_min_rate_prior=10. # [Hz]
+_noisy_rate=1000. # [Hz] chips above this, or with shared FIFO flags, are tested alone
+_depth_weight=0.02 # load increase per hop from the PACMAN
 
 rate_cut=[10000,1000]#,100] #,10]
 suffix = ['no_cut','10kHz_cut','1kHz_cut','100Hz_cut']
 
-def initial_setup(ctr, controller_config, tile_id):
+def quiet_tile(c, verbose=False):
+    ##### every register back to the post bring-up configuration (as the hard reset used to), with all
+    ##### channels masked / CSAs off, written as a diff against the last known configuration;
+    ##### chains are re-initialized only if the configuration cannot be enforced
+    ok, diff = base.restore_bring_up_config(c, modify=base.quiet_config, verbose=verbose)
+    if not ok:
+        print('***config error on',len(diff),'chips*** ==> re-initializing')
+        base.reset(c, chip_keys=list(diff.keys()), verbose=verbose)
+
+def initial_setup(ctr, controller_config, tile_id, c=None):
     now = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
     fname="-trigger_rate_%s_" % suffix[ctr] #str(rate_cut[ctr])
     fname=tile_id+fname+str(now)+".h5"
-    c = base.main(controller_config, logger=True, filename=fname, enforce=False)
+    if c is None: c = base.main(controller_config, logger=True, filename=fname, enforce=False)
+    else: base.rotate_logger(c, fname)
     return c, fname
 
-def initial_setup_low_dac(controller_config, tile_id):
+def initial_setup_low_dac(controller_config, tile_id, c=None):
     now = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
     fname="-low_thresh_trigger_rate_"#str(rate_cut[ctr])
     fname=tile_id+fname+str(now)+".h5"
-    c = base.main(controller_config, logger=True, filename=fname, enforce=False)
+    if c is None: c = base.main(controller_config, logger=True, filename=fname, enforce=False)
+    else: base.rotate_logger(c, fname)
     return c, fname
 
 def find_mode(l):
     a = Counter(l)
     return a.most_common(1)
 
-def get_parallel_groups(chip_key_dict):
-    #sort by io group, ioc
-    groups = []
-    ctr = 0
-    while True:
-        current_group = []
-        for key in chip_key_dict:
-            if ctr >= len(chip_key_dict[key]): continue
-            current_group.append(chip_key_dict[key][ctr])
-        ctr += 1
-        if len(current_group)==0: break
-        groups.append(current_group)
-    return groups
-
-def asic_test(c, chips_to_test, forbidden, threshold, runtime, enforce_initial, config):
+def update_chip_priors(chip_priors, c, view, chip_key_group, runtime):
+    ##### measured trigger rate and shared FIFO half/full flags per chip from the PacketView of the last read
+    triggers = view.chip_counts(packet_type=0)
+    fifo_flag = set(view.chip_counts(packet_type=0, shared_fifo_half=1)) | set(view.chip_counts(packet_type=0, shared_fifo_full=1))
+    for chip_key in set(chip_key_group) | set(triggers.keys()):
+        if chip_key not in c.chips: continue
+        prior = chip_priors.setdefault(chip_key, dict(rate=0., fifo=False))
+        if chip_key in chip_key_group: prior['rate'] = triggers.get(chip_key,0)/runtime
+        else: prior['rate'] = max(prior['rate'], triggers[chip_key]/runtime) # triggering while masked
+        prior['fifo'] = prior['fifo'] or chip_key in fifo_flag
+    return chip_priors
+
+def schedule_test_groups(chip_key_dict, chip_priors):
+    ##### pack chips into test groups within the per-chain and per-group rate budgets (first fit,
+    ##### highest expected load first); known-noisy chips are tested alone at the end
+    depth = dict()
+    for chain, chip_keys in chip_key_dict.items():
+        for i, chip_key in enumerate(chip_keys): depth[chip_key] = i
+    def load(chip_key):
+        rate = _default_rate_prior
+        if chip_key in chip_priors: rate = max(chip_priors[chip_key]['rate'], _min_rate_prior)
+        return rate*(1+_depth_weight*depth[chip_key]) # deeper chips relay through more shared FIFOs
+    noisy = [chip_key for chip_key in depth if chip_key in chip_priors and (chip_priors[chip_key]['rate'] > _noisy_rate or chip_priors[chip_key]['fifo'])]
+    groups = [] # [chips, group load, load per chain]
+    for chip_key in sorted([chip_key for chip_key in depth if chip_key not in noisy], key=lambda chip_key: (-load(chip_key), depth[chip_key])):
+        chain = (chip_key.io_group, chip_key.io_channel)
+        for group in groups:
+            if group[1]+load(chip_key) <= _group_rate_budget and group[2].get(chain,0)+load(chip_key) <= _chain_rate_budget:
+                break
+        else:
+            group = [[], 0., dict()]
+            groups.append(group)
+        group[0].append(chip_key)
+        group[1] += load(chip_key)
+        group[2][chain] = group[2].get(chain,0) + load(chip_key)
+    return [group[0] for group in groups] + [[chip_key] for chip_key in noisy]
+
+def triggered_chip_keys(c, view, exclude=[]):
+    ##### known chips (other than exclude) that triggered in the read of view, used to recover only their chains
+    return set([chip_key for chip_key in view.chip_counts(packet_type=0) if chip_key in c.chips and chip_key not in exclude])
+
+def off_group_triggers(view, chip_key_group):
+    ##### data packets per chip key in the read of view, for chips not in the group under test
+    group_chip_keys = set(chip_key_group)
+    return Counter(dict([(chip_key, n) for chip_key, n in view.chip_counts(packet_type=0).items() if not chip_key in group_chip_keys]))
+
+def isolate_noisy_chip(c, chip_key_group, runtime=_default_isolation_runtime, isolation_rate=_default_isolation_rate):
+    ##### bisect the enabled chips of the group under test, silencing half of the remaining candidates per
+    ##### step, to find the chip that causes triggers from elsewhere on the board in O(log n) acquisitions;
+    ##### if the triggers persist with the whole group silenced, the source is the off-group chip that
+    ##### sends them and its key is returned; returns None if the candidate alone does not reproduce
+    ##### the triggers (intermittent burst)
+    chip_registers = list(range(131,139))+[64]+list(range(66,74))
+    enabled = dict([(chip_key, deepcopy(c[chip_key].config)) for chip_key in chip_key_group])
+    def set_enabled(chip_keys, enable):
+        for chip_key in chip_keys:
+            if enable: c[chip_key].config = deepcopy(enabled[chip_key])
+            else:
+                c[chip_key].config.channel_mask=[1]*64
+                c[chip_key].config.csa_enable=[0]*64
+                c[chip_key].config.threshold_global = 255
+        c.multi_write_configuration([(chip_key, chip_registers) for chip_key in chip_keys])
+        c.multi_write_configuration([(chip_key, chip_registers) for chip_key in chip_keys])
+    def noisy():
+        base.flush_data(c)
+        c.run(runtime,'isolate noisy chip')
+        ##### off-group triggers per chip key if above the isolation rate, else None
+        triggers = off_group_triggers(packet_view.PacketView(c.reads[-1]), chip_key_group)
+        if sum(triggers.values())/runtime > isolation_rate: return triggers
+        return None
+
+    set_enabled(chip_key_group, False)
+    triggers = noisy()
+    if triggers:
+        set_enabled(chip_key_group, True)
+        off_group_chip_key = triggers.most_common(1)[0][0]
+        print('noisy chip outside the group under test:',off_group_chip_key)
+        return off_group_chip_key
+
+    candidates = list(chip_key_group)
+    set_enabled(candidates, True)
+    while len(candidates) > 1:
+        half, rest = candidates[:len(candidates)//2], candidates[len(candidates)//2:]
+        set_enabled(rest, False)
+        if noisy() is not None: candidates = half
+        else:
+            set_enabled(half, False)
+            set_enabled(rest, True)
+            candidates = rest
+    ##### confirmation with only the candidate enabled
+    confirmed = noisy() is not None
+    set_enabled(chip_key_group, True)
+    if not confirmed:
+        print('noisy chip candidate',candidates[0],'quiet on its own, not forbidden')
+        return None
+    print('noisy chip isolated:',candidates[0])
+    return candidates[0]
+
+def recover(c, config, chip_keys):
+    ##### chain recovery, or a full reset on a new controller that keeps the HDF5 log
+    new_c = base.reset(c, config, chip_keys=chip_keys)
+    if new_c is not c and hasattr(c,'logger'): new_c.logger = c.logger
+    return new_c
+
+def asic_test(c, chips_to_test, forbidden, threshold, runtime, enforce_initial, config, chip_priors=None):
     channels = [i for i in range(0,64) if i not in v2a_nonrouted_channels]
     chips = dict()
     reset_threshold = 10000
@@ -69,8 +184,10 @@ def asic_test(c, chips_to_test, forbidden, threshold, runtime, enforce_initial,
             network_ids.remove('ext')
             chips[(io_group, io_channel)] = [larpix.key.Key(io_group, io_channel, chip) for chip in network_ids if larpix.key.Key(io_group, io_channel, chip) in chips_to_test ]
     c.io.double_send_packets = False
-    grouped_chips_to_test = get_parallel_groups(chips)
-    base.reset(c)
+    if chip_priors is None: chip_priors = dict()
+    grouped_chips_to_test = schedule_test_groups(chips, chip_priors)
+    print(len(grouped_chips_to_test),'test groups')
+    quiet_tile(c)
     set_pacman_power(c, vdda=46020)
     for chip_key_group in grouped_chips_to_test:
         chip_register_pairs=[]
@@ -108,22 +225,36 @@ def asic_test(c, chips_to_test, forbidden, threshold, runtime, enforce_initial,
         c.logger.flush()
         c.logger.disable()
 
-        chip_triggers = c.reads[-1].extract('chip_id')
-        rate = len(chip_triggers)/runtime
-        try:
-            for packet in c.reads[-1]:
-                if not packet.chip_id in [int(chip_key.chip_id) for chip_key in chip_key_group]: print(packet)
-        except:
-            print(packet)
-        offending_chip = find_mode(chip_triggers)
+        view = packet_view.PacketView(c.reads[-1])
+        chip_triggers = view.chip_counts(packet_type=0)
+        rate = sum(chip_triggers.values())/runtime
+        ##### full chip keys, the same chip_id repeats on every chain
+        packet_chips = channel_key.chip(channel_key.encode(view.data['io_group'], view.data['io_channel'], view.data['chip_id'], 0))
+        group_chips = [channel_key.chip(channel_key.from_chip_key(chip_key, 0)) for chip_key in chip_key_group]
+        for i in np.flatnonzero((view.data['packet_type']==0) & ~np.isin(packet_chips, group_chips)):
+            print(c.reads[-1][i])
+        offending_chip = Counter(chip_triggers).most_common(1)
         print('total rate:', rate, '\toffending chip:', offending_chip)
+        update_chip_priors(chip_priors, c, view, chip_key_group, runtime)
+        ##### from the rate measurement, before any isolation acquisition replaces c.reads[-1]
+        triggered = triggered_chip_keys(c, view)
         for chip_key in chip_key_group:
-            channel_triggers = c.reads[-1].extract('channel_id',chip_key=chip_key)
+            channel_triggers = view.extract('channel_id',packet_type=0,chip_key=chip_key).tolist()
             print(chip_key,' \toffending channel, triggers: {}'.format(find_mode(channel_triggers)))
         if rate > 0:
-            if not int(offending_chip[0][0]) in [int(chip_key.chip_id) for chip_key in chip_key_group]: 
-                print('Noisy chip elsewhere on board..... resetting')
-                base.reset(c, config)
+            if not offending_chip[0][0] in chip_key_group:
+                print('Noisy chip elsewhere on board..... isolating')
+                noisy_chip = isolate_noisy_chip(c, chip_key_group)
+                if noisy_chip is None:
+                    print('Noisy chip not reproduced..... resetting')
+                    c = recover(c, config, triggered - set(chip_key_group))
+                else:
+                    for channel in channels: forbidden.add((noisy_chip, channel))
+                    print(noisy_chip,' added to do not enable list')
+                    if noisy_chip not in chip_key_group:
+                        ##### triggering while masked, its configuration is not the one written
+                        print('Noisy chip not in group..... resetting its chain')
+                        c = recover(c, config, [noisy_chip])
   
         for chip_key in chip_key_group:
             c[chip_key].config.channel_mask=[1]*64
@@ -136,14 +267,15 @@ def asic_test(c, chips_to_test, forbidden, threshold, runtime, enforce_initial,
 
         if rate > reset_threshold:
             print('Rate too high: \t',rate, 'Hz --- automatic reset triggered')
-            base.reset(c, config)
+            c = recover(c, config, triggered)
         else:
             ok, diff = c.enforce_configuration(chip_key_group, timeout=0.01, n=3, n_verify=3)
             if not ok: 
                 print('***config error on',len(diff), 'registers***')
-                base.reset(c, config)
+                c = recover(c, config, list(diff.keys()))
+    return c
 
-def low_dac_asic_test(c, chips_to_test, forbidden, threshold, runtime, enforce_initial):
+def low_dac_asic_test(c, chips_to_test, forbidden, threshold, runtime, enforce_initial, chip_priors=None):
     channels = [i for i in range(0,64) if i not in v2a_nonrouted_channels]
     chips = dict()
     reset_threshold = 10000
@@ -153,8 +285,10 @@ def low_dac_asic_test(c, chips_to_test, forbidden, threshold, runtime, enforce_i
             network_ids.remove('ext')
             chips[(io_group, io_channel)] = [larpix.key.Key(io_group, io_channel, chip) for chip in network_ids if larpix.key.Key(io_group, io_channel, chip) in chips_to_test ]
     c.io.double_send_packets = False
-    grouped_chips_to_test = get_parallel_groups(chips)
-    base.reset(c)
+    if chip_priors is None: chip_priors = dict()
+    grouped_chips_to_test = schedule_test_groups(chips, chip_priors)
+    print(len(grouped_chips_to_test),'test groups')
+    quiet_tile(c)
     set_pacman_power(c, vdda=46020)
     for chip_key_group in grouped_chips_to_test:
         chip_register_pairs=[]
@@ -177,54 +311,14 @@ def low_dac_asic_test(c, chips_to_test, forbidden, threshold, runtime, enforce_i
             c.logger.record_configs([c[chip_key]])
         c.multi_write_configuration(chip_register_pairs)
         c.multi_write_configuration(chip_register_pairs)
-        all_rates = [0]
-        rates = dict()
-        it_count = 0
-        for key in chip_key_group: rates[key]=0
-        while any(all_rates) < 2:
-            if it_count >10: break
-            it_count += 1
-            update_keys = [chipkey for chipkey in chip_key_group if rates[chipkey] < 2]
-            for chip_key in update_keys: c[chip_key].config.threshold_global = c[chip_key].config.threshold_global - 1
-            for chip_key in [chipkey for chipkey in chip_key_group if not chip_key in update_keys]:
-                c[chip_key].channel_mask = [1]*64
-                c[chip_key].csa_enable = [0]*64
-            c.multi_write_configuration(chip_register_pairs)
-            c.multi_write_configuration(chip_register_pairs)
-            if enforce_initial: 
-                ok, diff = c.enforce_registers(chip_register_pairs, timeout=0.01, n=3, n_verify=3)
-            base.flush_data(c)
-            #c.logger.enable()
-            c.run(runtime,'collect data')
-            #c.logger.flush()
-            #c.logger.disable()
-
-            chip_triggers = c.reads[-1].extract('chip_id')
-            rate = len(chip_triggers)/runtime
-            rates = dict()
-            all_rates = []
-            for chip_key in update_keys: 
-                this_chip_count = chip_triggers.count(chip_key.chip_id)
-                all_rates.append(this_chip_count)
-                rates[chip_key] = this_chip_count
-            for chip_key in chip_key_group: 
-                if not chip_key in update_keys: rates[chip_key]=9999999
-            try:
-                for packet in c.reads[-1]:
-                    if not packet.chip_id in [int(chip_key.chip_id) for chip_key in chip_key_group]: print(packet)
-            except:
-                print(packet)
-            offending_chip = find_mode(chip_triggers)
-            print('total rate:', rate, '\toffending chip:', offending_chip)
-            for chip_key in chip_key_group:
-                channel_triggers = c.reads[-1].extract('channel_id',chip_key=chip_key)
-                print(chip_key,' \toffending channel, triggers: {}'.format(find_mode(channel_triggers)))
-            if rate > 0:
-                if not int(offending_chip[0][0]) in [int(chip_key.chip_id) for chip_key in chip_key_group]: 
-                    print('Noisy chip elsewhere on board..... resetting')
-                    base.reset(c)
-                    c.multi_write_configuration(chip_register_pairs)
-                    c.multi_write_configuration(chip_register_pairs)
+        ##### walk the group's global threshold down (at most 11 DAC) by parallel bisection for the first
+        ##### value at which a chip triggers at least twice, and take the final data there
+        thresholds, unresolved = threshold_search.bisect_global_dac(c, chip_key_group, target_rate=1./runtime, runtime=runtime, low=threshold-12, high=threshold, runaway_rate=reset_threshold, per_channel=False)
+        for chip_key in chip_key_group: c[chip_key].config.threshold_global = max(thresholds[chip_key]-1, threshold-11)
+        c.multi_write_configuration(chip_register_pairs)
+        c.multi_write_configuration(chip_register_pairs)
+        if enforce_initial: 
+            ok, diff = c.enforce_registers(chip_register_pairs, timeout=0.01, n=3, n_verify=3)
 
 
         print('Final test:')
@@ -258,7 +352,7 @@ def low_dac_asic_test(c, chips_to_test, forbidden, threshold, runtime, enforce_i
             if rate > 0:
                 if not int(offending_chip[0][0]) in [int(chip_key.chip_id) for chip_key in chip_key_group]: 
                     print('Noisy chip elsewhere on board..... resetting')
-                    base.reset(c)
+                    base.reset(c, chip_keys=triggered_chip_keys(c, packet_view.PacketView(c.reads[-1]), exclude=chip_key_group))
 
   
         for chip_key in chip_key_group:
@@ -274,26 +368,9 @@ def low_dac_asic_test(c, chips_to_test, forbidden, threshold, runtime, enforce_i
             ok, diff = c.enforce_registers(chip_register_pairs, timeout=0.01, n=3, n_verify=3)
             if not ok: 
                 print('***config error on',len(diff), 'registers***')
-                base.reset(c)
+                base.reset(c, chip_keys=list(diff.keys()))
         
               
-def unique_channel_id(io_group, io_channel, chip_id, channel_id):
-    return channel_id + 100*(chip_id + 1000*(io_channel + 1000*(io_group)))
-
-
-def from_unique_to_chip_key(unique):
-    io_group = (unique // (100*1000*1000)) % 1000
-    io_channel = (unique // (100*1000)) % 1000
-    chip_id = (unique // 100) % 1000
-    return larpix.Key(io_group, io_channel, chip_id)
-
-def chip_key_to_string(chip_key):
-    return '-'.join([str(int(chip_key.io_group)),str(int(chip_key.io_channel)),str(int(chip_key.chip_id))])
-              
-def from_unique_to_channel_id(unique):
-    return int(unique) % 100
-              
-              
 def evaluate_rate(fname, ctr, runtime, forbidden):
     cut = 99999
     if ctr >= 0:
@@ -301,36 +378,24 @@ def evaluate_rate(fname, ctr, runtime, forbidden):
     else:
         cut = 1000.
 
-    f = h5py.File(fname,'r')
-    data_mask=f['packets'][:]['packet_type']==0
-    data=f['packets'][data_mask]
-
-    io_group=data['io_group'].astype(np.uint64)
-    io_channel=data['io_channel'].astype(np.uint64)
-    chip_id=data['chip_id'].astype(np.uint64)
-    channel_id=data['channel_id'].astype(np.uint64)
-    unique_channels = set(unique_channel_id(io_group, io_channel, chip_id, channel_id))
-
-    for unique in sorted(unique_channels):
-        channel_mask = unique_channel_id(io_group, io_channel, chip_id, channel_id) == unique
-        triggers = len(data[channel_mask]['dataword'])
-        if triggers/runtime > cut:
-            pair = ( chip_key_to_string(from_unique_to_chip_key(unique)), from_unique_to_channel_id(unique) )
-            if pair not in forbidden:
-                forbidden.append(pair)
-                print(pair,' added to do not enable list')
-    return forbidden
+    with h5py.File(fname,'r') as f: packets=f['packets'][:]
+    data=packets[packets['packet_type']==0]
 
+    ##### triggers per channel in one pass, forbidden is a set of (chip key string, channel)
+    unique_channels, triggers = np.unique(channel_key.encode_packets(data), return_counts=True)
+    hot_channels = unique_channels[triggers/runtime > cut]
+    for pair in zip(channel_key.to_strings(hot_channels), channel_key.channel_id(hot_channels).tolist()):
+        if pair not in forbidden:
+            forbidden.add(pair)
+            print(pair,' added to do not enable list')
+    return forbidden
 
-def chip_key_string(chip_key):
-    return '-'.join([str(int(chip_key.io_group)),str(int(chip_key.io_channel)),str(int(chip_key.chip_id))])
 
-              
 def save_do_not_enable_list(forbidden,tile_id):
     d = {}
     d['larpix-scripts-version'] = base.LARPIX_10X10_SCRIPTS_VERSION
-    for p in forbidden:
-        #ck = chip_key_string(p[0])
+    for p in sorted(forbidden, key=lambda p: (str(p[0]), p[1])):
+        #ck = channel_key.chip_key_string(p[0])
         ck = str(p[0])
         #ck = p[0]
         if ck not in d: d[ck]=[]
@@ -341,17 +406,20 @@ def save_do_not_enable_list(forbidden,tile_id):
         return 
 
               
-def main(controller_config=_default_controller_config, chip_key=_default_chip_key, threshold=_default_threshold, runtime=_default_runtime, disabled_list=_default_disabled_list, cryo=_default_cryo, low_dac_asic_test=_default_low_dac_asic_test):
+def main(controller_config=_default_controller_config, chip_key=_default_chip_key, threshold=_default_threshold, runtime=_default_runtime, disabled_list=_default_disabled_list, cryo=_default_cryo, low_dac_asic_test=_default_low_dac_asic_test, c=None):
     print('START ITERATIVE TRIGGER RATE TEST')
 
-    c = base.main(controller_config, enforce=False)
+    ##### one bring-up (or a controller passed in, e.g. from session.py) is reused for every iteration,
+    ##### each iteration only rotates the HDF5 log
+    if c is None: c = base.main(controller_config, enforce=False)
     chips_to_test = c.chips.keys()
     tile_id = 'tile-id-' + controller_config.split('-')[2]
     if not chip_key is None: chips_to_test = [chip_key]
     print('chips to test: ',chips_to_test)
     print('==> \tfound ASICs to test')
 
-    forbidden=[] # list of (chip key, channel) to disable, to be updated as script progresses
+    chip_priors=dict() # chip key: measured rate and FIFO flags, used to schedule test groups
+    forbidden=set() # set of (chip key, channel) to disable, to be updated as script progresses
     if disabled_list:
         print('applying disabled list: ', disabled_list)
         with open(disabled_list,'r') as f:
@@ -359,12 +427,12 @@ def main(controller_config=_default_controller_config, chip_key=_default_chip_ke
             for key in disable_input.keys():
                 channel_list = disable_input[key]
                 for chan in channel_list:
-                    forbidden.append((key,chan))
+                    forbidden.add((key,chan))
     else:
         print('No disabled list provided. Default disabled list applied.')
         for chip_key in chips_to_test:
             for channel in v2a_nonrouted_channels:
-                forbidden.append((chip_key,channel))
+                forbidden.add((chip_key,channel))
     print('==> \tinitial channel disable list set')
     
     if isinstance(threshold, list):
@@ -374,9 +442,9 @@ def main(controller_config=_default_controller_config, chip_key=_default_chip_ke
             if ithr > 1: enforce_initial = True
             if ithr==0: this_it_runtime=runtime/2
             for ctr in range(len(rate_cut)):
-                c, fname = initial_setup(ctr, controller_config, tile_id)
+                c, fname = initial_setup(ctr, controller_config, tile_id, c)
                 print('==> \ttesting ASICs with ',rate_cut[ctr],' Hz trigger rate threshold, Global DAC', thr)
-                asic_test(c, chips_to_test, forbidden, thr, this_it_runtime, enforce_initial, controller_config)
+                c = asic_test(c, chips_to_test, forbidden, thr, this_it_runtime, enforce_initial, controller_config, chip_priors)
                 if ctr==3: continue
                 n_initial=len(forbidden)
                 forbidden = evaluate_rate(fname, ctr, this_it_runtime, forbidden)
@@ -384,10 +452,10 @@ def main(controller_config=_default_controller_config, chip_key=_default_chip_ke
                 print('==> \tdo not enable list updated with ',n_final-n_initial,' additional channels')
     elif isinstance(threshold, int):
         for ctr in range(len(rate_cut)):
-            c, fname = initial_setup(ctr, controller_config, tile_id)
+            c, fname = initial_setup(ctr, controller_config, tile_id, c)
             print('==> \ttesting ASICs with ',rate_cut[ctr],' Hz trigger rate threshold, Global DAC', threshold)
             enforce_initial = True
-            asic_test(c, chips_to_test, forbidden, threshold, runtime, enforce_initial)
+            c = asic_test(c, chips_to_test, forbidden, threshold, runtime, enforce_initial, controller_config, chip_priors)
             if ctr==3: continue
             n_initial=len(forbidden)
             forbidden = evaluate_rate(fname, ctr, runtime, forbidden)
@@ -403,8 +471,8 @@ def main(controller_config=_default_controller_config, chip_key=_default_chip_ke
     enforce_initial = True
     low_dac_test_threshold = _default_low_dac_threshold
     if cryo: low_dac_test_threshold = _cryo_default_low_dac_threshold
-    c, fname = initial_setup_low_dac(controller_config)
-    low_dac_asic_test(c, chips_to_test, forbidden, low_dac_test_threshold, runtime, enforce_initial)
+    c, fname = initial_setup_low_dac(controller_config, tile_id, c)
+    low_dac_asic_test(c, chips_to_test, forbidden, low_dac_test_threshold, runtime, enforce_initial, chip_priors)
     n_initial=len(forbidden)
     forbidden = evaluate_rate(fname, ctr, runtime, forbidden)
     n_final=len(forbidden)
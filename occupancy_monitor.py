@@ -0,0 +1,168 @@
+'''
+Live per-channel occupancy monitor for data runs
+
+``OccupancyMonitor`` is a side thread that receives a random sample of the
+messages read by ``pacman_io.PACMAN_IO`` (``submit`` never blocks: when the
+monitor falls behind, samples are dropped and counted instead of delaying
+the reader or the raw writer), decodes them with pacman_decoder and keeps
+per-channel and per-chip trigger counts. Every ``interval`` seconds it
+writes a summary JSON with the chip rates, the channels above ``hot_rate``
+and the chains without data for ``silent_time`` seconds, plus an XY
+occupancy PNG from the layout geometry. Rates are corrected for the sampling
+fraction.
+
+Usage:
+    import occupancy_monitor
+    monitor = occupancy_monitor.OccupancyMonitor(chains=[(1,1),(1,2)], outdir='monitor/', tile_id='tile-id-1')
+    monitor.start()
+    c.io.monitor = monitor
+    ...
+    c.io.monitor = None
+    monitor.stop()
+
+'''
+import pacman_decoder
+import channel_key
+
+import os
+import json
+import queue
+import threading
+import time
+from collections import Counter
+import numpy as np
+
+_default_sample_fraction=0.1
+_default_hot_rate=10. # [Hz] per channel
+_default_silent_time=60. # [s]
+_default_interval=30. # [s]
+_default_geometry_yaml='layout-2.4.0.yaml'
+_default_queue_size=64 # [reads]
+
+pitch=4.4 # mm
+nonrouted_v2a_channels=[6,7,8,9,22,23,24,25,38,39,40,54,55,56,57]
+
+
+class OccupancyMonitor(threading.Thread):
+    '''
+    :param chains: ``(io_group, io_channel)`` expected to send data, to detect silent chains
+
+    :param sample_fraction: fraction of the messages decoded
+
+    '''
+    def __init__(self, chains=None, outdir='./', tile_id='tile', sample_fraction=_default_sample_fraction,
+                 hot_rate=_default_hot_rate, silent_time=_default_silent_time, interval=_default_interval,
+                 geometry_yaml=_default_geometry_yaml, queue_size=_default_queue_size, seed=None):
+        super(OccupancyMonitor, self).__init__(daemon=True)
+        self.outdir = outdir
+        self.tile_id = tile_id
+        self.sample_fraction = sample_fraction
+        self.hot_rate = hot_rate
+        self.silent_time = silent_time
+        self.interval = interval
+        self.geometry_yaml = geometry_yaml
+        self.n_dropped = 0
+        self._rng = np.random.default_rng(seed)
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._stop_event = threading.Event()
+        self._window_start = time.time()
+        self._channel_counts = Counter()
+        self._last_seen = dict([(tuple(chain), time.time()) for chain in chains]) if chains else dict()
+        self._geo = None
+
+    def submit(self, msgs, io_groups):
+        ##### called by the reader, must not block
+        if not msgs: return
+        sample = np.flatnonzero(self._rng.random(len(msgs)) < self.sample_fraction)
+        if not len(sample): return
+        try: self._queue.put_nowait(([msgs[i] for i in sample], [io_groups[i] for i in sample]))
+        except queue.Full: self.n_dropped += len(sample)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def _add(self, msgs, io_groups):
+        packets = pacman_decoder.decode_msgs(msgs, io_groups)
+        packets = packets[(packets['packet_type'] == 0) & (packets['valid_parity'] == 1)]
+        if not len(packets): return
+        keys, n = np.unique(channel_key.encode_packets(packets), return_counts=True)
+        self._channel_counts.update(dict(zip(keys.tolist(), n.tolist())))
+        now = time.time()
+        io_group, io_channel, _, _ = channel_key.decode(keys)
+        for chain in set(zip(io_group.tolist(), io_channel.tolist())):
+            self._last_seen[chain] = now
+
+    def summary(self):
+        now = time.time()
+        livetime = (now - self._window_start)*self.sample_fraction + 1e-9
+        channel_rates = dict([(key, n/livetime) for key, n in self._channel_counts.items()])
+        chip_rates = Counter()
+        for key, rate in channel_rates.items(): chip_rates[channel_key.to_string(key)] += rate
+        hot_channels = [dict(chip_key=channel_key.to_string(key), channel=int(channel_key.channel_id(key)), rate=rate)
+                        for key, rate in sorted(channel_rates.items(), key=lambda item: -item[1]) if rate > self.hot_rate]
+        silent_chains = ['{}-{}'.format(*chain) for chain, last_seen in sorted(self._last_seen.items()) if now - last_seen > self.silent_time]
+        return dict(
+            time=now,
+            window=now - self._window_start,
+            sample_fraction=self.sample_fraction,
+            dropped_messages=self.n_dropped,
+            total_rate=sum(channel_rates.values()),
+            chip_rates=dict(chip_rates),
+            hot_channels=hot_channels,
+            silent_chains=silent_chains,
+            ), channel_rates
+
+    def plot_xy(self, channel_rates, filename):
+        ##### object oriented matplotlib only, pyplot is not thread safe
+        import yaml
+        import matplotlib
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.patches import Rectangle
+        from matplotlib import cm
+        from matplotlib.colors import LogNorm
+        if self._geo is None:
+            with open(self.geometry_yaml) as fi: self._geo = yaml.full_load(fi)
+        geo = self._geo
+        chip_pix = dict([(chip_id, pix) for chip_id,pix in geo['chips']])
+        fig = Figure(figsize=(10,8))
+        FigureCanvasAgg(fig)
+        ax = fig.add_subplot(111)
+        ax.set_xlabel('X Position [mm]'); ax.set_ylabel('Y Position [mm]')
+        ax.set_xlim(-geo['width']/2*1.1, geo['width']/2*1.1)
+        ax.set_ylim(-geo['height']/2*1.1, geo['height']/2*1.1)
+        norm = LogNorm(vmin=self.hot_rate/1000., vmax=self.hot_rate)
+        cmap = matplotlib.colormaps['viridis']
+        for key, rate in channel_rates.items():
+            chip_id, channel_id = int(channel_key.chip_id(key)), int(channel_key.channel_id(key))
+            if chip_id not in chip_pix or channel_id in nonrouted_v2a_channels: continue
+            x = geo['pixels'][chip_pix[chip_id][channel_id]][1]
+            y = geo['pixels'][chip_pix[chip_id][channel_id]][2]
+            ax.add_patch(Rectangle((x-(pitch/2.), y-(pitch/2.)), pitch, pitch, color=cmap(norm(max(rate, norm.vmin)))))
+        colorbar = fig.colorbar(cm.ScalarMappable(norm=norm, cmap=cmap), ax=ax)
+        colorbar.set_label('Trigger Rate [Hz]')
+        ax.set_title('{}\n{}'.format(self.tile_id, time.strftime('%Y_%m_%d_%H_%M_%S_%Z')))
+        fig.savefig(filename)
+
+    def write_summary(self):
+        summary, channel_rates = self.summary()
+        basename = os.path.join(self.outdir, self.tile_id+'-monitor')
+        with open(basename+'.json.tmp', 'w') as f: json.dump(summary, f, indent=4)
+        os.replace(basename+'.json.tmp', basename+'.json')
+        self.plot_xy(channel_rates, basename+'-xy-rate.png')
+        if summary['hot_channels']: print('\n[MONITOR]',len(summary['hot_channels']),'channels above',self.hot_rate,'Hz, hottest:',summary['hot_channels'][0])
+        if summary['silent_chains']: print('\n[MONITOR] silent chains:',summary['silent_chains'])
+        self._channel_counts = Counter()
+        self._window_start = time.time()
+        return summary
+
+    def run(self):
+        next_summary = time.time() + self.interval
+        while not self._stop_event.is_set() or not self._queue.empty():
+            try: self._add(*self._queue.get(timeout=0.5))
+            except queue.Empty: pass
+            if time.time() > next_summary:
+                self.write_summary()
+                next_summary = time.time() + self.interval
+        self.write_summary()
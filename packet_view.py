@@ -0,0 +1,107 @@
+'''
+Indexed numpy view of a read
+
+``PacketCollection.extract`` scans every packet in Python for each query.
+``PacketView`` converts a read once into a numpy structured array and
+builds, on first use, a sorted index for each combination of selection
+fields, so that repeated counts and extracts on the same read are lookups
+instead of scans.
+
+Packets that do not have a field (e.g. timestamp packets have no
+``chip_id``) get 0 for it; select on ``packet_type`` to exclude them.
+
+Usage:
+    import packet_view
+    view = packet_view.PacketView(c.reads[-1])
+    n = view.count(packet_type=0, chip_id=12, channel_id=5)
+    adc = view.extract('dataword', packet_type=0, io_group=1, io_channel=1, chip_id=12)
+    triggers = view.counts('io_group', 'io_channel', 'chip_id', packet_type=0)
+
+'''
+
+import numpy as np
+
+import larpix
+
+dtype = np.dtype([
+    ('io_group','u1'),
+    ('io_channel','u1'),
+    ('chip_id','u1'),
+    ('packet_type','u1'),
+    ('channel_id','u1'),
+    ('dataword','u1'),
+    ('trigger_type','u1'),
+    ('shared_fifo_half','u1'),
+    ('shared_fifo_full','u1'),
+    ('timestamp','u8'),
+    ])
+
+
+class PacketView(object):
+    '''
+    Read-only structured array of a read with lazily built group indices
+
+    :param packets: ``PacketCollection`` or list of packets
+
+    '''
+    def __init__(self, packets):
+        packets = getattr(packets, 'packets', packets)
+        self.data = np.zeros(len(packets), dtype=dtype)
+        for field in dtype.names:
+            self.data[field] = [getattr(packet, field, 0) or 0 for packet in packets]
+        self._indices = dict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def _code(self, fields, values):
+        ##### fold small integer fields into one int64 key
+        code = np.zeros(np.shape(values[0]), dtype=np.int64)
+        for field, value in zip(fields, values):
+            code = code*(np.iinfo(dtype[field]).max+1) + np.asarray(value, dtype=np.int64)
+        return code
+
+    def _index(self, fields):
+        if fields not in self._indices:
+            code = self._code(fields, [self.data[field] for field in fields])
+            order = np.argsort(code, kind='stable')
+            keys, start, n = np.unique(code[order], return_index=True, return_counts=True)
+            self._indices[fields] = (order, dict(zip(keys.tolist(), zip(start.tolist(), n.tolist()))))
+        return self._indices[fields]
+
+    def select(self, **selection):
+        '''
+        :returns: indices (in read order) of the packets matching all ``selection`` values
+
+        '''
+        if 'chip_key' in selection:
+            chip_key = larpix.Key(selection.pop('chip_key'))
+            selection.update(io_group=chip_key.io_group, io_channel=chip_key.io_channel, chip_id=chip_key.chip_id)
+        if not selection: return np.arange(len(self.data))
+        fields = tuple(sorted(selection.keys()))
+        order, groups = self._index(fields)
+        start, n = groups.get(int(self._code(fields, [selection[field] for field in fields])), (0, 0))
+        return np.sort(order[start:start+n])
+
+    def count(self, **selection):
+        return len(self.select(**selection))
+
+    def extract(self, field, **selection):
+        return self.data[field][self.select(**selection)]
+
+    def counts(self, *fields, **selection):
+        '''
+        :returns: ``dict`` of ``{(<field values>): <number of packets>}`` for packets matching ``selection``
+
+        '''
+        data = self.data[self.select(**selection)]
+        if not len(data): return dict()
+        values, n = np.unique(np.stack([data[field] for field in fields], axis=-1), axis=0, return_counts=True)
+        return dict([(tuple(value.tolist()), int(count)) for value, count in zip(values, n)])
+
+    def chip_counts(self, **selection):
+        '''
+        :returns: ``dict`` of ``{<chip key>: <number of packets>}`` for packets matching ``selection``
+
+        '''
+        return dict([(larpix.Key(*value), n) for value, n in self.counts('io_group','io_channel','chip_id', **selection).items()])
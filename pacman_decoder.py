@@ -0,0 +1,210 @@
+'''
+Vectorized decoding of PACMAN data messages into packet arrays
+
+The decoders turn raw PACMAN data messages into a numpy structured array with
+the ``packets`` dtype of the LArPix HDF5 format, row for row identical to
+``pacman_msg_format.parse`` followed by ``hdf5format.to_file``: one
+timestamp packet per message followed by one row per data, trigger or sync
+word. The 64-bit LArPix words are unpacked with array operations instead of
+one ``Packet_v2`` object per packet.
+
+``decode_buffer`` works on back-to-back messages in one buffer (``bytes``,
+``numpy.memmap`` of a binary dump, ...), ``decode_msgs`` on a list of
+messages as stored in the ``msgs`` dataset of a raw HDF5 file and
+``decode_rawfile`` on a message range of a raw HDF5 file (larpix-control or
+packed layout, see hdf5_compression). See benchmark_decoder.py for a
+comparison with the packet object path.
+
+Usage:
+    import pacman_decoder
+    packets = pacman_decoder.decode_rawfile(raw_filename, start=0, end=10000)
+    packets = pacman_decoder.decode_buffer(np.memmap(dump_filename, mode='r'), io_groups=1)
+
+'''
+
+import larpix.format.hdf5format as hdf5format
+import larpix.format.pacman_msg_format as pacman_msg_format
+
+import hdf5_compression
+
+import struct
+import numpy as np
+
+version = hdf5format.latest_version
+packets_dtype = hdf5format.dtypes[version]['packets']
+
+_timestamp_packet_type = 4
+_sync_packet_type = 6
+_trigger_packet_type = 7
+
+_n_words_struct = struct.Struct('<H') # header bytes 6-7
+
+##### (first bit, number of bits) of the Packet_v2 fields
+_packet_v2_bits = dict(
+    packet_type=(0,2),
+    chip_id=(2,8),
+    channel_id=(10,6),
+    register_address=(10,8),
+    register_data=(18,8),
+    timestamp=(16,31),
+    first_packet=(47,1),
+    dataword=(48,8),
+    trigger_type=(56,2),
+    local_fifo=(58,2),
+    shared_fifo=(60,2),
+    downstream_marker=(62,1),
+    parity=(63,1),
+    )
+##### replace the timestamp if the chips run with FIFO diagnostics enabled
+_packet_v2_fifo_diagnostics_bits = dict(
+    timestamp=(16,16),
+    shared_fifo_events=(32,12),
+    local_fifo_events=(44,2),
+    )
+
+
+def _uint32(buf, offsets):
+    ##### little endian uint32 at each offset
+    return (buf[offsets].astype(np.uint32) | buf[offsets+1].astype(np.uint32) << 8
+            | buf[offsets+2].astype(np.uint32) << 16 | buf[offsets+3].astype(np.uint32) << 24)
+
+
+def _uint64(buf, offsets):
+    ##### little endian uint64 at each offset
+    return buf[offsets[:,np.newaxis] + np.arange(8)].copy().view('<u8').ravel()
+
+
+def _parity(words):
+    ##### xor of all 64 bits
+    words = words ^ (words >> np.uint64(32))
+    words = words ^ (words >> np.uint64(16))
+    words = words ^ (words >> np.uint64(8))
+    words = words ^ (words >> np.uint64(4))
+    words = words ^ (words >> np.uint64(2))
+    words = words ^ (words >> np.uint64(1))
+    return (words & np.uint64(1)).astype(np.uint8)
+
+
+def decode_packet_words(words, packets, fifo_diagnostics=False):
+    '''
+    Fill the LArPix fields of ``packets`` from the 64-bit packet ``words``
+
+    '''
+    words = np.asarray(words, dtype=np.uint64)
+    bits = dict(_packet_v2_bits, **_packet_v2_fifo_diagnostics_bits) if fifo_diagnostics else _packet_v2_bits
+    for field, (start, n_bits) in bits.items():
+        packets[field] = (words >> np.uint64(start)) & np.uint64((1 << n_bits) - 1)
+    packets['valid_parity'] = _parity(words)
+    packets['fifo_diagnostics_enabled'] = fifo_diagnostics
+
+
+def _n_words(buf, msg_start):
+    return buf[msg_start+6].astype(np.int64) | buf[msg_start+7].astype(np.int64) << 8
+
+
+def _as_uint8(buf):
+    if isinstance(buf, (bytes, bytearray, memoryview)): return np.frombuffer(buf, dtype=np.uint8)
+    return np.asarray(buf, dtype=np.uint8)
+
+
+def message_offsets(buf):
+    '''
+    Start offsets of the complete messages in a buffer of back-to-back PACMAN
+    messages, found by following the word count in each header (a truncated
+    last message, e.g. of a file still being written, is left out)
+
+    '''
+    buf = _as_uint8(buf)
+    offsets = []
+    offset = 0
+    while offset + pacman_msg_format.HEADER_LEN <= len(buf):
+        msg_len = pacman_msg_format.HEADER_LEN + pacman_msg_format.WORD_LEN*_n_words_struct.unpack_from(buf, offset+6)[0]
+        if offset + msg_len > len(buf): break
+        offsets.append(offset)
+        offset += msg_len
+    return np.array(offsets, dtype=np.int64)
+
+
+def decode_buffer(buf, io_groups, msg_start=None, fifo_diagnostics=False):
+    '''
+    :param buf: back-to-back PACMAN data messages as ``bytes``, ``numpy.memmap`` or ``uint8`` array
+
+    :param io_groups: io group of each message, or a single io group for all
+
+    :param msg_start: message start offsets (``message_offsets(buf)`` if not given)
+
+    :param fifo_diagnostics: interpret data packets as sent with FIFO diagnostics enabled
+
+    :returns: numpy structured array with ``packets_dtype``
+
+    '''
+    buf = _as_uint8(buf)
+    if msg_start is None: msg_start = message_offsets(buf)
+    msg_start = np.asarray(msg_start, dtype=np.int64)
+    if not len(msg_start): return np.zeros((0,), dtype=packets_dtype)
+    n_words = _n_words(buf, msg_start)
+    io_groups = np.broadcast_to(np.asarray(io_groups, dtype=np.uint8), msg_start.shape)
+
+    ##### each message gives a timestamp row followed by its words
+    row_start = np.r_[0, np.cumsum(n_words+1)[:-1]]
+    packets = np.zeros((int(np.sum(n_words+1)),), dtype=packets_dtype)
+    packets['io_group'] = np.repeat(io_groups, n_words+1)
+
+    packets['packet_type'][row_start] = _timestamp_packet_type
+    packets['timestamp'][row_start] = _uint32(buf, msg_start+1)
+
+    word_msg = np.repeat(np.arange(len(msg_start)), n_words)
+    word_index = np.arange(len(word_msg)) - np.repeat(np.r_[0, np.cumsum(n_words)[:-1]], n_words)
+    word_offset = msg_start[word_msg] + pacman_msg_format.HEADER_LEN + word_index*pacman_msg_format.WORD_LEN
+    word_row = row_start[word_msg] + 1 + word_index
+    word_type = buf[word_offset]
+
+    is_data = word_type == ord(pacman_msg_format.WORD_TYPE_DATA)
+    offset, row = word_offset[is_data], word_row[is_data]
+    data = np.zeros((len(row),), dtype=packets_dtype)
+    decode_packet_words(_uint64(buf, offset+8), data, fifo_diagnostics)
+    data['io_group'] = packets['io_group'][row]
+    data['io_channel'] = buf[offset+1]
+    data['receipt_timestamp'] = _uint32(buf, offset+2)
+    packets[row] = data
+
+    is_trig = word_type == ord(pacman_msg_format.WORD_TYPE_TRIG)
+    offset, row = word_offset[is_trig], word_row[is_trig]
+    packets['packet_type'][row] = _trigger_packet_type
+    packets['trigger_type'][row] = buf[offset+1]
+    packets['timestamp'][row] = _uint32(buf, offset+4)
+
+    is_sync = word_type == ord(pacman_msg_format.WORD_TYPE_SYNC)
+    offset, row = word_offset[is_sync], word_row[is_sync]
+    packets['packet_type'][row] = _sync_packet_type
+    packets['trigger_type'][row] = buf[offset+1]
+    packets['dataword'][row] = buf[offset+2] & 1
+    packets['timestamp'][row] = _uint32(buf, offset+4)
+
+    return packets
+
+
+def decode_msgs(msgs, io_groups, fifo_diagnostics=False):
+    '''
+    :param msgs: iterable of PACMAN data message bytestrings (e.g. the ``msgs`` of ``hdf5_compression.from_rawfile``)
+
+    :param io_groups: io group of each message
+
+    :param fifo_diagnostics: interpret data packets as sent with FIFO diagnostics enabled
+
+    :returns: numpy structured array with ``packets_dtype``
+
+    '''
+    msgs = [bytes(msg) for msg in msgs]
+    if not msgs: return np.zeros((0,), dtype=packets_dtype)
+    msg_len = np.array([len(msg) for msg in msgs], dtype=np.int64)
+    return decode_buffer(b''.join(msgs), io_groups, msg_start=np.r_[0, np.cumsum(msg_len)[:-1]], fifo_diagnostics=fifo_diagnostics)
+
+
+def decode_rawfile(filename, start=None, end=None, fifo_diagnostics=False):
+    '''
+    Decode messages ``[start, end)`` of a raw HDF5 file
+
+    '''
+    buf, msg_start, io_groups = hdf5_compression.read_buffer(filename, start=start, end=end)
+    return decode_buffer(buf, io_groups, msg_start=msg_start, fifo_diagnostics=fifo_diagnostics)
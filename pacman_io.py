@@ -0,0 +1,390 @@
+'''
+PACMAN io with in-memory data stream counters
+
+``PACMAN_IO`` behaves like ``larpix.io.PACMAN_IO`` but counts, per io group,
+the data messages, bytes and LArPix packets (data words) it receives, so that
+rate monitoring needs no access to the raw file being written. The counters
+are available through ``stats()`` and, if ``stats_filename`` is set, are
+written to that small JSON sidecar every ``stats_interval`` seconds.
+
+For continuous runs, ``start_raw_writer`` replaces the raw file worker
+process with a ``RawWriter`` thread fed through a bounded handoff queue.
+``rotate_raw_file`` switches the writer to a new file between two received
+messages, so files follow each other without stopping to listen and without
+losing messages. The writer also keeps the time index of each file
+(raw_index) and saves it when the file is closed.
+
+With several PACMANs, ``start_group_readers`` instead gives each io group
+its own ``GroupReader`` thread, with its own data socket, raw writer thread
+and raw file, so that a busy PACMAN does not hold back the others. The
+readers update the same per io group counters.
+
+A sample of the received messages is handed to ``monitor`` (an
+occupancy_monitor.OccupancyMonitor) if one is set.
+
+Usage:
+    import pacman_io
+    c.io = pacman_io.PACMAN_IO(relaxed=True)
+    c.io.stats_filename = 'run-stats.json'
+    ...
+    previous = c.io.stats()
+    ...
+    rates = pacman_io.stats_rates(previous, c.io.stats())
+
+    c.io.start_raw_writer('run-0.h5')
+    c.start_listening()
+    ... c.read() ...
+    c.io.rotate_raw_file('run-1.h5')
+    ... c.read() ...
+    c.stop_listening()
+    c.read()
+    c.io.stop_raw_writer()
+
+    c.io.start_group_readers({1: 'run-io_group-1-0.h5', 2: 'run-io_group-2-0.h5'})
+    ...
+    c.io.rotate_group_files({1: 'run-io_group-1-1.h5', 2: 'run-io_group-2-1.h5'})
+    ...
+    c.io.stop_group_readers()
+
+'''
+
+import larpix.io
+import larpix.format.pacman_msg_format as pacman_msg_format
+import larpix.format.rawhdf5format as rhdf5
+
+import raw_index
+import hdf5_compression
+
+import os
+import json
+import time
+import queue
+import threading
+import numpy as np
+import zmq
+
+_default_stats_interval=5. # [s]
+_default_handoff_queue_size=256 # [reads] pending in the raw writer before empty_queue blocks
+_default_max_msgs=100000 # messages per raw file write
+_default_poll_timeout=100 # [ms] reader thread wait for data between stop checks
+_put_timeout=0.5 # [s] handoff queue wait between raw writer liveness checks
+
+_counters=('messages','bytes','packets')
+
+
+def count_data_words(message):
+    ##### number of LArPix packets (data words) in a pacman data message
+    if message[0:1] != pacman_msg_format.MSG_TYPE_DATA: return 0
+    word_types = np.frombuffer(message, dtype=np.uint8)[pacman_msg_format.HEADER_LEN::pacman_msg_format.WORD_LEN]
+    return int(np.count_nonzero(word_types == ord(pacman_msg_format.WORD_TYPE_DATA)))
+
+
+def stats_rates(previous, current):
+    '''
+    :returns: ``dict`` of ``{<io group>: {<counter>: <rate [Hz]>}}`` between two ``PACMAN_IO.stats()`` snapshots
+
+    '''
+    dt = current['time'] - previous['time'] + 1e-9
+    rates = dict()
+    for io_group, counts in current['io_group'].items():
+        last = previous['io_group'].get(io_group, dict())
+        rates[io_group] = dict([(key, (counts[key] - last.get(key, 0))/dt) for key in _counters])
+    return rates
+
+
+class RawWriter(threading.Thread):
+    '''
+    Background thread appending received messages to the current raw file
+
+    ``put`` blocks when ``maxsize`` reads are pending, ``rotate`` closes the
+    current file after everything queued so far and opens ``filename``.
+
+    '''
+    def __init__(self, filename, maxsize=_default_handoff_queue_size, max_msgs=_default_max_msgs, index=True, compression=None, verbose=False):
+        super(RawWriter, self).__init__(daemon=True)
+        self.filename = filename
+        self.max_msgs = max_msgs
+        self.index = index
+        self.compression = compression
+        self.verbose = verbose
+        self.n_written = dict()
+        self.exception = None
+        self._time_index = None
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._new_file(filename)
+
+    def _new_file(self, filename):
+        self._save_index()
+        if self.compression is None: rhdf5.to_rawfile(filename=filename, io_version=pacman_msg_format.latest_version)
+        else: hdf5_compression.create_rawfile(filename, compression=self.compression)
+        self.filename = filename
+        self.n_written[filename] = 0
+        if self.index: self._time_index = raw_index.TimeIndex()
+
+    def _save_index(self):
+        if self._time_index is not None: self._time_index.save(raw_index.index_filename(self.filename))
+
+    def _write(self, msgs, io_groups):
+        if not msgs: return
+        hdf5_compression.to_rawfile(self.filename, msgs, msg_headers={'io_groups': io_groups})
+        self.n_written[self.filename] += len(msgs)
+        if self._time_index is not None: self._time_index.add(msgs)
+
+    def put(self, msgs, io_groups):
+        if not msgs: return
+        ##### never block on a full queue that a dead writer will not empty
+        while True:
+            if self.exception is not None or not self.is_alive(): raise RuntimeError('raw writer stopped') from self.exception
+            try:
+                self._queue.put(('data', msgs, io_groups), timeout=_put_timeout)
+                return
+            except queue.Full: pass
+
+    def rotate(self, filename):
+        self._queue.put(('file', filename))
+
+    def close(self):
+        self._queue.put(('stop',))
+        self.join()
+        if self.exception is not None: raise RuntimeError('raw writer stopped') from self.exception
+
+    def run(self):
+        try:
+            item = self._queue.get()
+            while item[0] != 'stop':
+                if item[0] == 'file':
+                    if self.verbose: print('raw writer: {} messages in {}, next file {}'.format(self.n_written[self.filename], self.filename, item[1]))
+                    self._new_file(item[1])
+                    item = self._queue.get()
+                    continue
+                ##### batch consecutive reads, up to the next rotation or stop
+                msgs, io_groups = list(item[1]), list(item[2])
+                item = None
+                while item is None and len(msgs) < self.max_msgs:
+                    try: item = self._queue.get(False)
+                    except queue.Empty: break
+                    if item[0] == 'data':
+                        msgs += item[1]
+                        io_groups += item[2]
+                        item = None
+                self._write(msgs, io_groups)
+                if item is None: item = self._queue.get()
+            self._save_index()
+        except Exception as e:
+            self.exception = e
+            raise
+
+
+class GroupReader(threading.Thread):
+    '''
+    Background thread receiving the data of one io group on its own socket
+    and handing it to its own ``RawWriter``
+
+    ``stop`` drains the socket, then waits for the writer to finish the file.
+
+    '''
+    def __init__(self, io, io_group, filename, maxsize=_default_handoff_queue_size, compression=None, poll_timeout=_default_poll_timeout, verbose=False):
+        super(GroupReader, self).__init__(daemon=True)
+        self.io = io
+        self.io_group = io_group
+        self.poll_timeout = poll_timeout
+        self.exception = None
+        self.writer = RawWriter(filename, maxsize=maxsize, compression=compression, verbose=verbose)
+        self._stop_event = threading.Event()
+        ##### zmq sockets are not thread safe, the reader never touches the io's own receivers
+        self.socket = io.context.socket(zmq.SUB)
+        self.socket.set_hwm(io.hwm)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(io._data_address(io_group))
+        self.socket.setsockopt(zmq.SUBSCRIBE, b'')
+
+    def rotate(self, filename):
+        self.writer.rotate(filename)
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        self.writer.close()
+        if self.exception is not None: raise RuntimeError('io group {} reader stopped'.format(self.io_group)) from self.exception
+        return self.writer
+
+    def _receive(self):
+        msgs = []
+        while len(msgs) < self.io.hwm:
+            try: msgs.append(self.socket.recv(zmq.NOBLOCK))
+            except zmq.Again: break
+        if not msgs: return 0
+        for message in msgs: self.io._count(message, self.io_group)
+        io_groups = [self.io_group]*len(msgs)
+        if self.io.monitor is not None: self.io.monitor.submit(msgs, io_groups)
+        self.writer.put(msgs, io_groups)
+        return len(msgs)
+
+    def run(self):
+        self.writer.start()
+        try:
+            while not self._stop_event.is_set():
+                if self.socket.poll(self.poll_timeout): self._receive()
+            while self._receive(): pass
+        except Exception as e:
+            self.exception = e
+            raise
+        finally:
+            self.socket.close()
+
+
+class PACMAN_IO(larpix.io.PACMAN_IO):
+    '''
+    ``larpix.io.PACMAN_IO`` with per io group message, byte and packet counters
+
+    '''
+    def __init__(self, *args, stats_filename=None, stats_interval=_default_stats_interval, **kwargs):
+        self._stats_lock = threading.Lock()
+        self._counts = dict()
+        self._start_time = time.time()
+        self.stats_filename = stats_filename
+        self.stats_interval = stats_interval
+        self._last_stats = None
+        self.raw_writer = None
+        self.group_readers = dict()
+        self.monitor = None
+        super(PACMAN_IO, self).__init__(*args, **kwargs)
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._counts = dict([(io_group, dict([(key, 0) for key in _counters])) for io_group in self._io_group_table])
+            self._start_time = time.time()
+        self._last_stats = self.stats()
+
+    def _count(self, message, io_group):
+        with self._stats_lock:
+            counts = self._counts.setdefault(io_group, dict([(key, 0) for key in _counters]))
+            counts['messages'] += 1
+            counts['bytes'] += len(message)
+            counts['packets'] += count_data_words(message)
+
+    def stats(self):
+        '''
+        :returns: ``dict`` with the counter snapshot ``{'time': <unix time>, 'start_time': <unix time>, 'io_group': {<io group>: {'messages': <n>, 'bytes': <n>, 'packets': <n>}}}``
+
+        '''
+        with self._stats_lock:
+            return dict(
+                time=time.time(),
+                start_time=self._start_time,
+                io_group=dict([(io_group, dict(counts)) for io_group, counts in self._counts.items()])
+                )
+
+    def write_stats(self, filename=None):
+        ##### counters and the rates since the last write, replaced atomically so readers never see a partial file
+        filename = filename if filename is not None else self.stats_filename
+        current = self.stats()
+        record = dict(current, rates=stats_rates(self._last_stats, current))
+        self._last_stats = current
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'w') as f:
+            json.dump(record, f, indent=4)
+        os.replace(tmp_filename, filename)
+
+    def start_raw_writer(self, filename, maxsize=_default_handoff_queue_size, compression=None, verbose=False):
+        '''
+        Write received messages to ``filename`` from a background thread
+        (instead of ``enable_raw_file_writing``) until ``stop_raw_writer``
+
+        '''
+        if self.raw_writer is not None: raise RuntimeError('raw writer already running')
+        self.raw_writer = RawWriter(filename, maxsize=maxsize, compression=compression, verbose=verbose)
+        self.raw_writer.start()
+
+    def rotate_raw_file(self, filename):
+        ##### messages read after this call go to filename, listening is not interrupted
+        self.raw_writer.rotate(filename)
+
+    def stop_raw_writer(self):
+        ##### write out everything handed off and wait for the writer
+        raw_writer, self.raw_writer = self.raw_writer, None
+        if raw_writer is not None: raw_writer.close()
+        return raw_writer
+
+    def start_group_readers(self, filenames, maxsize=_default_handoff_queue_size, compression=None, verbose=False):
+        '''
+        Receive and write the data of each io group from its own threads, to
+        ``filenames[io_group]``, until ``stop_group_readers``. Replaces
+        ``start_listening`` / ``read``.
+
+        '''
+        if self.group_readers: raise RuntimeError('io group readers already running')
+        ##### the io's own receivers would buffer a copy of everything up to the high-water mark
+        for io_group in filenames: self._disconnect_receiver(io_group)
+        for io_group, filename in filenames.items():
+            self.group_readers[io_group] = GroupReader(self, io_group, filename, maxsize=maxsize, compression=compression, verbose=verbose)
+        for reader in self.group_readers.values(): reader.start()
+
+    def rotate_group_files(self, filenames):
+        ##### per io group, messages received after this call go to filenames[io_group]
+        for io_group, filename in filenames.items(): self.group_readers[io_group].rotate(filename)
+
+    def stop_group_readers(self):
+        '''
+        :returns: ``dict`` of ``{<io group>: <RawWriter>}`` with the files written
+
+        '''
+        readers, self.group_readers = self.group_readers, dict()
+        for reader in readers.values(): reader._stop_event.set()
+        try:
+            return dict([(io_group, reader.stop()) for io_group, reader in readers.items()])
+        finally:
+            for io_group in readers: self._connect_receiver(io_group)
+
+    def _data_address(self, io_group):
+        return 'tcp://' + self._io_group_table[io_group] + ':' + self.dataserver_port
+
+    def _disconnect_receiver(self, io_group):
+        receiver = self.receivers[self._io_group_table[io_group]]
+        receiver.disconnect(self._data_address(io_group))
+        while True:
+            try: receiver.recv(zmq.NOBLOCK)
+            except zmq.Again: break
+
+    def _connect_receiver(self, io_group):
+        self.receivers[self._io_group_table[io_group]].connect(self._data_address(io_group))
+
+    def empty_queue(self):
+        '''
+        Fetch and parse waiting packets on pacman data socket, updating the counters
+
+        returns tuple of list of packets, full bytestream of all messages
+
+        '''
+        packets = []
+        address_list = list()
+        bytestream_list = list()
+        bytestream = b''
+        n_recv = 0
+        while self.poller.poll(0) and n_recv < self.hwm:
+            events = dict(self.poller.poll(0))
+            for socket, n_events in events.items():
+                for _ in range(n_events):
+                    message = socket.recv()
+                    n_recv += 1
+                    bytestream_list += [message]
+                    address_list += [self.receivers.inv[socket]]
+        io_groups = [self._io_group_table.inv[address] for address in address_list]
+        for message, io_group in zip(bytestream_list, io_groups):
+            self._count(message, io_group)
+        if self.monitor is not None: self.monitor.submit(bytestream_list, io_groups)
+        if not self.disable_packet_parsing:
+            for message, io_group in zip(bytestream_list, io_groups):
+                packets += pacman_msg_format.parse(message, io_group=io_group)
+            bytestream = b''.join(bytestream_list)
+        if self.raw_writer is not None:
+            self.raw_writer.put(bytestream_list, io_groups)
+        elif self.enable_raw_file_writing:
+            self._raw_file_queue.put((bytestream_list, io_groups))
+            if not self._raw_file_worker.is_alive():
+                self._launch_raw_file_worker()
+
+        if self.stats_filename and time.time() > self._last_stats['time'] + self.stats_interval:
+            self.write_stats()
+        return packets,bytestream
@@ -2,6 +2,8 @@ import larpix
 import larpix.io
 import larpix.logger
 import base
+import readback
+import channel_key
 
 import argparse
 import json
@@ -24,6 +26,7 @@ _default_no_apply_baseline_cut=False
 _default_noise_cut_value=10.
 _default_no_apply_noise_cut=False
 _default_no_refinement=False
+_default_no_log=False
 
 from base import *
 
@@ -57,7 +60,7 @@ def configure_pedestal(c, periodic_trigger_cycles, disabled_channels):
     #base.flush_data(c)
 
     print('enforcing correct configuration...')
-    ok,diff = c.enforce_configuration(list(c.chips.keys()), timeout=0.01, connection_delay=0.01, n=10, n_verify=10)
+    ok,diff = readback.enforce_configuration(c, list(c.chips.keys()), timeout=0.1, connection_delay=0.01, n=10, n_verify=10)
     if not ok:
         if any([reg not in range(66,74) for key, regs in diff.items() for reg in regs]):
             raise RuntimeError(diff,'\nconfig error on chips',list(diff.keys()))
@@ -81,7 +84,7 @@ def configure_pedestal(c, periodic_trigger_cycles, disabled_channels):
     #base.flush_data(c)
 
     print('enforcing correct configuration...')
-    ok,diff = c.enforce_configuration(list(c.chips.keys()), timeout=0.01, connection_delay=0.01, n=10, n_verify=10)
+    ok,diff = readback.enforce_configuration(c, list(c.chips.keys()), timeout=0.1, connection_delay=0.01, n=10, n_verify=10)
     if not ok:
         raise RuntimeError(diff,'\nconfig error on chips',list(diff.keys()))
     c.io.group_packets_by_io_group = False
@@ -89,62 +92,131 @@ def configure_pedestal(c, periodic_trigger_cycles, disabled_channels):
     set_pacman_power(c, vdda=46020)
 
 
-def run_pedestal(c, runtime):
+class PedestalStats(object):
+    '''
+    Per-channel pedestal count, mean, standard deviation and rate accumulated
+    from the controller read loop, so the bad channel decision is available
+    as soon as the run ends without re-reading the HDF5 log
+
+    '''
+    def __init__(self):
+        self.n = defaultdict(int)
+        self.sum = defaultdict(float)
+        self.sumsq = defaultdict(float)
+        self.first_timestamp = None
+        self.last_timestamp = None
+        self.start_time = time.time()
+        self.end_time = None
+
+    def add(self, packets):
+        fields, adc = [], []
+        for packet in packets:
+            if packet.packet_type == 0:
+                if not packet.has_valid_parity(): continue
+                fields.append((packet.io_group, packet.io_channel, packet.chip_id, packet.channel_id))
+                adc.append(packet.dataword)
+            elif packet.packet_type == 4:
+                if self.first_timestamp is None: self.first_timestamp = packet.timestamp
+                self.last_timestamp = packet.timestamp
+        if not fields: return
+        unique_channels, index = np.unique(channel_key.encode(*np.array(fields).T), return_inverse=True)
+        adc = np.array(adc, dtype=float)
+        n = np.bincount(index)
+        adc_sum = np.bincount(index, weights=adc)
+        adc_sumsq = np.bincount(index, weights=adc**2)
+        for i, channel in enumerate(unique_channels.tolist()):
+            self.n[channel] += int(n[i])
+            self.sum[channel] += adc_sum[i]
+            self.sumsq[channel] += adc_sumsq[i]
+
+    def livetime(self):
+        ##### PACMAN timestamp packets if any arrived, otherwise wall clock
+        if self.first_timestamp is not None and self.last_timestamp != self.first_timestamp:
+            return self.last_timestamp - self.first_timestamp
+        return (self.end_time if self.end_time else time.time()) - self.start_time
+
+    def channels(self):
+        livetime = self.livetime()
+        for channel in sorted(self.n.keys()):
+            n = self.n[channel]
+            mean = self.sum[channel]/n
+            std = np.sqrt(max(self.sumsq[channel]/n - mean**2, 0.))
+            yield channel, n, mean, std, n/(livetime + 1e-9)
+
+
+
+def run_pedestal(c, runtime, stats=None):
     print('START PEDESTAL RUN')
-    c.logger.enable()
-    c.run(runtime, 'collect pedestal, version ' + str(base.LARPIX_10X10_SCRIPTS_VERSION))
-    c.logger.flush()
-    print('packets read',len(c.reads[-1]))
-    c.logger.disable()
+    if stats is None: stats = PedestalStats()
+    ##### same as c.run, but packets go to the online statistics (and HDF5 log, if any) instead of c.reads
+    if hasattr(c,'logger') and c.logger: c.logger.enable()
+    sleeptime = min(0.1, runtime)
+    c.start_listening()
+    stats.start_time = time.time()
+    n_packets = 0
+    while time.time() - stats.start_time < runtime:
+        time.sleep(sleeptime)
+        packets, _ = c.read()
+        stats.add(packets)
+        n_packets += len(packets)
+    c.stop_listening()
+    stats.end_time = time.time()
+    if hasattr(c,'logger') and c.logger:
+        c.logger.flush()
+        c.logger.disable()
+    print('packets read',n_packets)
     print('END PEDESTAL RUN')
+    return stats
 
 
 
-def evaluate_pedestal(datalog_file, disabled_channels, baseline_cut_value, no_apply_baseline_cut, noise_cut_value, no_apply_noise_cut):
-    
-    n_bad_channels=0
-    f = h5py.File(datalog_file,'r')
-    unixtime = f['packets']['timestamp'][f['packets']['packet_type'] == 4]
-    livetime = np.max(unixtime) - np.min(unixtime)
-    
-    data_mask=f['packets'][:]['packet_type']==0
-    valid_parity_mask=f['packets'][data_mask]['valid_parity']==1
-    data=(f['packets'][data_mask])[valid_parity_mask]
-
-    io_group=data['io_group'].astype(np.uint64)
-    io_channel=data['io_channel'].astype(np.uint64)
-    chip_id=data['chip_id'].astype(np.uint64)
-    channel_id=data['channel_id'].astype(np.uint64)
-    unique_channels = set(unique_channel_id(io_group, io_channel, chip_id, channel_id))
+def is_bad_channel(n, mean, std, rate, baseline_cut_value, no_apply_baseline_cut, noise_cut_value, no_apply_noise_cut):
+    flag=False
+    if no_apply_baseline_cut==False:
+        if mean>=baseline_cut_value: flag=True
+    if no_apply_noise_cut==False:
+        if std>=noise_cut_value or std==0: flag=True
+    if rate>2.: flag=True
+    return flag
+
+
+
+def record_bad_channel(record, unique):
+    _chip_key_string_ = channel_key.to_string(unique)
+    _channel_id_ = int(channel_key.channel_id(unique))
+    record[_chip_key_string_].append( _channel_id_ )
+    print(channel_key.to_chip_key(unique),'  ', _channel_id_,'\t disabled')
+
+
 
+def evaluate_pedestal_stats(stats, disabled_channels, baseline_cut_value, no_apply_baseline_cut, noise_cut_value, no_apply_noise_cut):
+    n_bad_channels=0
     record = defaultdict(list)
-    for unique in sorted(unique_channels):
-        flag=False
-        channel_mask = unique_channel_id(io_group, io_channel, chip_id, channel_id) == unique
-        adc = data[channel_mask]['dataword']
-        if len(adc)<2: continue
-        if no_apply_baseline_cut==False:
-            if np.mean(adc)>=baseline_cut_value: flag=True
-        if no_apply_noise_cut==False:
-            if np.std(adc)>=noise_cut_value or np.std(adc)==0: flag=True
-        rate = len(adc)/ (livetime + 1e-9)
-        if rate>2.: flag=True
-        if flag==True:
+    for unique, n, mean, std, rate in stats.channels():
+        if n<2: continue
+        if is_bad_channel(n, mean, std, rate, baseline_cut_value, no_apply_baseline_cut, noise_cut_value, no_apply_noise_cut):
             n_bad_channels+=1
-            _chip_key_ = from_unique_to_chip_key(unique)
-            _chip_key_string_ = chip_key_to_string(_chip_key_)
-            if _chip_key_ in record: record[_chip_key_string_]=[]
-            record[_chip_key_string_].append( from_unique_to_channel_id(unique) )
-            print(_chip_key_,'  ', (unique % 100),'\t disabled')
+            record_bad_channel(record, unique)
 
     for key in disabled_channels.keys():
         if key=='larpix-scripts-version': continue
         record[key]+=disabled_channels[key]
-    
+
     return record, n_bad_channels
 
 
 
+def set_pedestal_logger(c, ped_fname, no_log):
+    if not no_log:
+        base.rotate_logger(c, ped_fname)
+        return
+    if hasattr(c,'logger') and c.logger:
+        c.logger.flush()
+        c.logger.disable()
+    c.logger = None
+
+
+
 def save_simple_json(record, tile_id):
     now = time.strftime("%Y_%m_%d_%H_%M_%S_%Z")
     record['larpix-scripts-version'] = base.LARPIX_10X10_SCRIPTS_VERSION
@@ -162,7 +234,9 @@ def main(controller_config=_default_controller_config,
          no_apply_baseline_cut=_default_no_apply_baseline_cut,
          noise_cut_value=_default_noise_cut_value,
          no_apply_noise_cut=_default_no_apply_noise_cut,
-         no_refinement=_default_no_refinement):
+         no_refinement=_default_no_refinement,
+         no_log=_default_no_log,
+         c=None):
 
     if no_refinement==False:
         if no_log_simple==False and no_apply_baseline_cut==True and apply_noise_cut==False:
@@ -197,36 +271,40 @@ def main(controller_config=_default_controller_config,
     ped_fname= ped_fname+".h5"
     print('initial disabled list: ',disabled_channels)
 
-    c = base.main(controller_config=controller_config, logger=True, filename=ped_fname, vdda=0)
+    if c is None: c = base.main(controller_config=controller_config, logger=not no_log, filename=ped_fname, vdda=0)
+    else: set_pedestal_logger(c, ped_fname, no_log) # reuse an already configured tile (e.g. from session.py)
     #c = base.main(controller_config=controller_config, logger=True, filename=ped_fname)
     configure_pedestal(c, periodic_trigger_cycles, disabled_channels)
     print('Wait 3 seconds for cooling the ASICs...'); time.sleep(3)
     base.flush_data(c, rate_limit=(1+1/(periodic_trigger_cycles*1e-7)*len(c.chips)))
     #base.flush_data(c, rate_limit=(1+1/(periodic_trigger_cycles*1e-7)*len(c.chips)))
-    run_pedestal(c, runtime)
+    stats = run_pedestal(c, runtime)
 
     revised_disabled_channels = defaultdict(list)
     revised_bad_channel_filename=None
     #if no_log_simple==False or log_qc:
     if no_log_simple==False:
-        revised_disabled_channels, n_bad_channels = evaluate_pedestal(ped_fname, disabled_channels, baseline_cut_value, no_apply_baseline_cut, noise_cut_value, no_apply_noise_cut)
+        revised_disabled_channels, n_bad_channels = evaluate_pedestal_stats(stats, disabled_channels, baseline_cut_value, no_apply_baseline_cut, noise_cut_value, no_apply_noise_cut)
         revised_bad_channel_filename=save_simple_json(revised_disabled_channels, tile_id)
         print('\n\n\n===========\t',n_bad_channels,' bad channels\t ===========\n\n\n')
 
     if no_refinement==False:
         ped_fname=tile_id+"-recursive-pedestal_%s" % revised_bad_channel_filename
-        c = base.main(controller_config=controller_config, logger=True, filename=ped_fname, vdda=0)
+        set_pedestal_logger(c, ped_fname, no_log)
+        ##### stop the periodic triggers of the first pass before configure_pedestal flushes and enforces
+        ok, diff = base.restore_bring_up_config(c, modify=base.quiet_config)
+        if not ok: base.reset(c, chip_keys=list(diff.keys()))
         #c = base.main(controller_config=controller_config, logger=True, filename=ped_fname)
         configure_pedestal(c, periodic_trigger_cycles, revised_disabled_channels)
         print('Wait 3 seconds for cooling the ASICs...'); time.sleep(3)
         base.flush_data(c, rate_limit=(1+1/(periodic_trigger_cycles*1e-7)*len(c.chips)))
         #base.flush_data(c, rate_limit=(1+1/(periodic_trigger_cycles*1e-7)*len(c.chips)))
-        run_pedestal(c, runtime)
+        stats = run_pedestal(c, runtime)
         #open file to add version info
     revised_bad_channel_filename=None
     #if no_log_simple==False or log_qc:
     if no_log_simple==False:
-        revised_disabled_channels, n_bad_channels = evaluate_pedestal(ped_fname, revised_disabled_channels, baseline_cut_value, no_apply_baseline_cut, noise_cut_value, no_apply_noise_cut)
+        revised_disabled_channels, n_bad_channels = evaluate_pedestal_stats(stats, revised_disabled_channels, baseline_cut_value, no_apply_baseline_cut, noise_cut_value, no_apply_noise_cut)
         revised_bad_channel_filename=save_simple_json(revised_disabled_channels, tile_id)
         print('\n\n\n===========\t',n_bad_channels,' bad channels\t ===========\n\n\n')
 
@@ -247,6 +325,7 @@ if __name__ == '__main__':
     parser.add_argument('--no_apply_baseline_cut', default=_default_no_apply_baseline_cut, action='store_true', help='''If flag is present, disable pedestal mean cut value applied''')
     parser.add_argument('--noise_cut_value', default=_default_noise_cut_value, type=float, help='''Pedestal noise standard deviation cut value: channels with pedestal standard deviation at or exceeding this value are added to disabled list''')
     parser.add_argument('--no_apply_noise_cut', default=_default_no_apply_noise_cut, action='store_true', help='''If flag present, disable pedestal standard deviation cut value applied''')
+    parser.add_argument('--no_log', default=_default_no_log, action='store_true', help='''If flag present, pedestal data is not logged to HDF5 (bad channels are evaluated online)''')
     parser.add_argument('--no_refinement', default=_default_no_refinement, action='store_true', help='''If flag present, pedestal is not run recursively to measure pedestal with bad channels removed''')
 
     args = parser.parse_args()
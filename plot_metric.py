@@ -1,3 +1,5 @@
+import channel_key
+
 import h5py
 import matplotlib.pyplot as plt
 import yaml
@@ -19,11 +21,6 @@ pitch=4.4 # mm
 
 
 
-def unique_channel_id(d): return((d['io_group'].astype(int)*256+d['io_channel'].astype(int))*256 + d['chi\
-p_id'].astype(int))*64 + d['channel_id'].astype(int)
-
-
-
 def parse_file(filename):
     d = dict()
     f = h5py.File(filename,'r')
@@ -32,12 +29,9 @@ def parse_file(filename):
     data_mask = f['packets'][:]['packet_type']==0
     valid_parity_mask = f['packets'][:]['valid_parity']==1
     mask = np.logical_and(data_mask, valid_parity_mask)
-    adc = f['packets']['dataword'][mask]
-    unique_id = unique_channel_id(f['packets'][mask])
-    unique_id_set = np.unique(unique_id)
-    for i in unique_id_set:
-        id_mask = unique_id == i
-        masked_adc = adc[id_mask]
+    packets = f['packets'][mask]
+    unique_id_set, adc_by_channel = channel_key.group(channel_key.encode_packets(packets), packets['dataword'])
+    for i, masked_adc in zip(unique_id_set.tolist(), adc_by_channel):
         d[i]=dict(
             mean = np.mean(masked_adc),
             std = np.std(masked_adc),
@@ -46,13 +40,6 @@ def parse_file(filename):
 
 
 
-def find_channel_id(u): return u % 64
-
-
-
-def find_chip_id(u): return (u//64) % 256
-
-
 def plot_1d(d, metric, tile_id, version):
     fig, ax = plt.subplots(figsize=(8,8))
     a = [d[key][metric] for key in d.keys()]
@@ -109,8 +96,8 @@ def plot_xy(d, metric, geometry_yaml, normalization, tile_id, version):
         plt.annotate(str(chipid), [avgX,avgY], ha='center', va='center')
 
     for key in d.keys():
-        channel_id = find_channel_id(key)
-        chip_id = find_chip_id(key)
+        channel_id = int(channel_key.channel_id(key))
+        chip_id = int(channel_key.chip_id(key))
         if chip_id not in range(11,111): continue
         if channel_id in nonrouted_v2a_channels: continue
         if channel_id not in range(64): continue
@@ -0,0 +1,171 @@
+'''
+Time index for raw PACMAN HDF5 files
+
+The index is a small sidecar file (``<raw file>-index.h5``) with one row
+each time the message time advances: the message index in the raw file, the
+unix time from the PACMAN message header and the PACMAN timestamp (receipt
+timestamp of the first data word, 0 if the message has none). It is filled by
+the raw writer (pacman_io.RawWriter) while data is taken, or afterwards in a
+single pass over the file with ``build_index``.
+
+``read_time_range`` uses the index to decode only the messages of a time
+range instead of the whole file.
+
+Usage:
+    build (if missing) the index of an existing raw file:
+        python3 raw_index.py <raw file>
+
+    convert minutes 30-35 of a run to a packet file:
+        python3 raw_index.py <raw file> --start 1800 --end 2100 --relative --output_filename <packet file>
+
+    import raw_index
+    packets = raw_index.read_time_range(raw_filename, 1800, 2100, relative=True)
+
+'''
+import larpix.format.pacman_msg_format as pacman_msg_format
+
+import pacman_decoder
+import convert_rawhdf5
+import hdf5_compression
+
+import os
+import argparse
+import struct
+import time
+import numpy as np
+import h5py
+
+_default_start=None
+_default_end=None
+_default_relative=False
+_default_output_filename=None
+_default_chunk_size=100000 # messages per read when building the index
+
+index_dtype = np.dtype([('msg_index','u8'),('unix_time','u4'),('pacman_timestamp','u4')])
+
+_header_time_struct = struct.Struct('<L') # header bytes 1-4
+_receipt_timestamp_struct = struct.Struct('<L') # first word bytes 2-5
+
+
+def index_filename(raw_filename):
+    return os.path.splitext(raw_filename)[0] + '-index.h5'
+
+
+class TimeIndex(object):
+    '''
+    Incrementally built time index of a raw file
+
+    :param n_msgs: number of messages already in the raw file before the first ``add``
+
+    '''
+    def __init__(self, n_msgs=0):
+        self.n_msgs = n_msgs
+        self.last_time = -1
+        self.rows = []
+
+    def add(self, msgs):
+        ##### messages appended to the raw file, in file order
+        for i, msg in enumerate(msgs):
+            unix_time = _header_time_struct.unpack_from(msg, 1)[0]
+            if unix_time <= self.last_time: continue
+            self.last_time = unix_time
+            pacman_timestamp = 0
+            if len(msg) > pacman_msg_format.HEADER_LEN and msg[pacman_msg_format.HEADER_LEN:pacman_msg_format.HEADER_LEN+1] == pacman_msg_format.WORD_TYPE_DATA:
+                pacman_timestamp = _receipt_timestamp_struct.unpack_from(msg, pacman_msg_format.HEADER_LEN+2)[0]
+            self.rows.append((self.n_msgs+i, unix_time, pacman_timestamp))
+        self.n_msgs += len(msgs)
+
+    def array(self):
+        return np.array(self.rows, dtype=index_dtype)
+
+    def save(self, filename):
+        with h5py.File(filename, 'w') as f:
+            f.create_dataset('index', data=self.array())
+            f['index'].attrs['n_msgs'] = self.n_msgs
+            f['index'].attrs['modified'] = time.time()
+
+
+def build_index(raw_filename, chunk_size=_default_chunk_size):
+    ##### single pass over an existing raw file
+    n_msgs = hdf5_compression.len_rawfile(raw_filename)
+    index = TimeIndex()
+    for start in range(0, n_msgs, chunk_size):
+        index.add(hdf5_compression.from_rawfile(raw_filename, start=start, end=min(start+chunk_size, n_msgs))['msgs'])
+    index.save(index_filename(raw_filename))
+    return index.array()
+
+
+def load_index(raw_filename, build=True):
+    ##### builds the index first if there is none or it does not cover the whole raw file
+    filename = index_filename(raw_filename)
+    if os.path.exists(filename):
+        with h5py.File(filename, 'r') as f:
+            if not build or f['index'].attrs['n_msgs'] >= hdf5_compression.len_rawfile(raw_filename): return f['index'][:]
+    if not build: raise RuntimeError('no index for {}'.format(raw_filename))
+    return build_index(raw_filename)
+
+
+def message_range(index, start=None, end=None):
+    '''
+    :returns: ``(first, last)`` message indices (``last`` exclusive, ``None`` for the end of file) covering unix times ``[start, end)``
+
+    '''
+    first, last = 0, None
+    ##### message times are only roughly ordered across io groups, keep one second of margin
+    if start is not None:
+        i = np.searchsorted(index['unix_time'], start - 1, side='right') - 1
+        if i >= 0: first = int(index['msg_index'][i])
+    if end is not None:
+        i = np.searchsorted(index['unix_time'], end + 1, side='left')
+        if i < len(index): last = int(index['msg_index'][i])
+    return first, last
+
+
+def read_time_range(raw_filename, start=None, end=None, relative=False, index=None, fifo_diagnostics=False):
+    '''
+    Decode the messages with unix time in ``[start, end)``
+
+    :param relative: ``start`` and ``end`` are seconds since the first message of the file
+
+    :returns: numpy structured array with ``pacman_decoder.packets_dtype``
+
+    '''
+    if index is None: index = load_index(raw_filename)
+    if relative and len(index):
+        start = start + int(index['unix_time'][0]) if start is not None else None
+        end = end + int(index['unix_time'][0]) if end is not None else None
+    first, last = message_range(index, start, end)
+    packets = pacman_decoder.decode_rawfile(raw_filename, start=first, end=last, fifo_diagnostics=fifo_diagnostics)
+
+    ##### every message starts with its timestamp packet, trim the margin to the exact range
+    is_header = packets['packet_type'] == pacman_decoder._timestamp_packet_type
+    msg_time = packets['timestamp'][is_header][np.cumsum(is_header)-1]
+    mask = np.ones(len(packets), dtype=bool)
+    if start is not None: mask &= msg_time >= start
+    if end is not None: mask &= msg_time < end
+    return packets[mask]
+
+
+def main(raw_filename, start=_default_start, end=_default_end, relative=_default_relative, output_filename=_default_output_filename, **kwargs):
+    timeStart = time.time()
+    index = load_index(raw_filename)
+    print('==> %.3f seconds --- index of %s: %d entries, unix time %s to %s'%(time.time()-timeStart, raw_filename, len(index),
+        index['unix_time'][0] if len(index) else '-', index['unix_time'][-1] if len(index) else '-'))
+    if output_filename is None: return index
+
+    timeStart = time.time()
+    packets = read_time_range(raw_filename, start, end, relative=relative, index=index)
+    convert_rawhdf5.create_packet_file(output_filename)
+    with h5py.File(output_filename, 'a') as f: convert_rawhdf5.append_packets(f, packets)
+    print('==> %.3f seconds --- %d packets written to %s'%(time.time()-timeStart, len(packets), output_filename))
+    return index
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('raw_filename', type=str, help='''Raw HDF5 file to index''')
+    parser.add_argument('--start', default=_default_start, type=float, help='''Start of the time range to convert (unix time, or seconds with --relative)''')
+    parser.add_argument('--end', default=_default_end, type=float, help='''End of the time range to convert (unix time, or seconds with --relative)''')
+    parser.add_argument('--relative', default=_default_relative, action='store_true', help='''--start and --end are seconds since the start of the file''')
+    parser.add_argument('--output_filename', default=_default_output_filename, type=str, help='''Packet HDF5 file to write the time range to (default: only build the index)''')
+    args = parser.parse_args()
+    main(**vars(args))
@@ -0,0 +1,77 @@
+'''
+Bounded storage for ``Controller.reads``
+
+larpix-control appends a new ``PacketCollection`` to ``c.reads`` on every
+``c.run`` / ``c.read`` / ``multi_read_configuration`` and never drops one, so
+long QC sessions grow without limit. ``ReadRing`` is a drop-in replacement
+for the ``c.reads`` list that keeps only the last ``max_reads`` reads and/or
+at most ``max_packets`` packets (the newest read is always kept, however
+large). Evicted reads are discarded, or appended to the packet HDF5 file
+``spill_filename`` when given. ``c.reads[-1]`` and ``read_id`` numbering
+behave as before.
+
+Usage:
+    import read_ring
+    read_ring.set_read_retention(c, max_reads=16, max_packets=10000000, spill_filename='reads-spill.h5')
+    ...
+    c.reads.clear() # instead of c.reads = [], keeps the retention policy
+
+'''
+import larpix.format.hdf5format as hdf5format
+
+_default_max_reads=16
+_default_max_packets=None
+_default_spill_filename=None
+
+
+class ReadRing(list):
+    '''
+    :param max_reads: maximum number of reads kept (``None`` for no limit)
+
+    :param max_packets: maximum total number of packets kept (``None`` for no limit)
+
+    :param spill_filename: packet HDF5 file evicted reads are appended to (``None`` to discard them)
+
+    '''
+    def __init__(self, reads=(), max_reads=_default_max_reads, max_packets=_default_max_packets, spill_filename=_default_spill_filename):
+        super(ReadRing, self).__init__()
+        self.max_reads = max_reads
+        self.max_packets = max_packets
+        self.spill_filename = spill_filename
+        self.n_packets = 0
+        self.n_evicted = 0
+        self.n_spilled = 0
+        self.extend(reads)
+
+    def append(self, read):
+        super(ReadRing, self).append(read)
+        self.n_packets += len(read)
+        self._evict()
+
+    def extend(self, reads):
+        for read in reads: self.append(read)
+
+    def clear(self):
+        ##### same as evicting every read
+        while len(self): self._pop_oldest()
+
+    def _pop_oldest(self):
+        read = super(ReadRing, self).pop(0)
+        self.n_packets -= len(read)
+        self.n_evicted += 1
+        if self.spill_filename is not None and len(read):
+            hdf5format.to_file(self.spill_filename, packet_list=read.packets)
+            self.n_spilled += len(read)
+        return read
+
+    def _evict(self):
+        while len(self) > 1 and ((self.max_reads is not None and len(self) > self.max_reads)
+                                 or (self.max_packets is not None and self.n_packets > self.max_packets)):
+            self._pop_oldest()
+
+
+def set_read_retention(c, max_reads=_default_max_reads, max_packets=_default_max_packets, spill_filename=_default_spill_filename, verbose=True):
+    ##### replace c.reads, keeping the reads already taken within the new limits
+    c.reads = ReadRing(c.reads, max_reads=max_reads, max_packets=max_packets, spill_filename=spill_filename)
+    if verbose: print('read retention: max reads',max_reads,'max packets',max_packets,'spill file',spill_filename)
+    return c.reads
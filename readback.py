@@ -0,0 +1,190 @@
+'''
+Pipelined configuration readback for a full tile
+
+Read requests for every (chip, register) are streamed down each hydra chain
+with a bounded number of requests in flight per io channel. Responses are
+matched to requests as they arrive, so a verification pass ends as soon as
+the last response is in rather than after a fixed timeout. The returned diff
+map has the same format as ``larpix.Controller.verify_registers``::
+
+    {<chip_key>: {<register>: (<expected>, <read>)}}
+
+where ``<read>`` is ``None`` for registers that never responded.
+
+Usage:
+    import readback
+    ok, diff = readback.enforce_configuration(c, list(c.chips.keys()))
+
+'''
+
+import time
+from collections import defaultdict, deque
+
+import larpix
+import larpix.bitarrayhelper as bah
+
+_default_timeout=0.1 # [s] time to wait for an individual response
+_default_connection_delay=0.01
+_default_window=64 # max outstanding read requests per io channel
+_default_batch_size=256 # max read requests sent per io message
+_default_n=10
+_default_n_verify=10
+
+
+def _normalize_pairs(c, chip_key_register_pairs):
+    ##### accepts the same (chip_key, register(s)) specification as larpix.Controller
+    registers = defaultdict(list)
+    for pair in chip_key_register_pairs:
+        if not isinstance(pair, tuple): pair = (pair, None)
+        chip_key, chip_registers = pair
+        chip_key = larpix.Key(chip_key)
+        if chip_registers is None:
+            chip_registers = range(c[chip_key].config.num_registers)
+        elif isinstance(chip_registers, int):
+            chip_registers = [chip_registers]
+        for register in chip_registers:
+            if register not in registers[chip_key]: registers[chip_key].append(register)
+    return registers
+
+
+def expected_values(c, chip_keys):
+    ##### register values currently stored in the controller, as they should read back
+    expected = dict()
+    for chip_key in chip_keys:
+        expected[chip_key] = [bah.touint(bits, endian=larpix.Packet_v2.endian) for bits in c[chip_key].config.all_data()]
+    return expected
+
+
+def _read_packet(chip_key, register):
+    ##### built directly, chip.get_configuration_read_packets also encodes the register data
+    packet = larpix.Packet_v2()
+    packet.packet_type = larpix.Packet_v2.CONFIG_READ_PACKET
+    packet.chip_key = chip_key
+    packet.register_address = register
+    packet.register_data = 0
+    packet.assign_parity()
+    return packet
+
+
+def read_registers(c, chip_key_register_pairs, timeout=_default_timeout, connection_delay=_default_connection_delay, window=_default_window, batch_size=_default_batch_size, message='pipelined configuration read'):
+    '''
+    Stream read requests for all requested registers and collect responses
+
+    :returns: ``dict`` of ``{(chip_key, register): <read value or None>}``
+
+    '''
+    registers = _normalize_pairs(c, chip_key_register_pairs)
+
+    ##### one request queue per hydra chain, so that each chain is throttled independently
+    queues = defaultdict(deque)
+    for chip_key, chip_registers in registers.items():
+        for register in chip_registers:
+            queues[(chip_key.io_group, chip_key.io_channel)].append(((chip_key, register), _read_packet(chip_key, register)))
+    read = dict([((chip_key, register), None) for chip_key, chip_registers in registers.items() for register in chip_registers])
+    outstanding = defaultdict(dict) # chain -> {(chip_key, register): time sent}
+
+    already_listening = c.io.is_listening
+    group_packets_by_io_group = c.io.group_packets_by_io_group
+    c.io.group_packets_by_io_group = True
+    if not already_listening:
+        c.start_listening()
+        time.sleep(connection_delay)
+
+    all_packets = []
+    all_bytestreams = []
+    try:
+        while any(queues.values()) or any(outstanding.values()):
+            ##### top up each chain to the in-flight window
+            packets = []
+            now = time.time()
+            for chain, queue in queues.items():
+                while queue and len(outstanding[chain]) < window and len(packets) < batch_size:
+                    pair, packet = queue.popleft()
+                    packets.append(packet)
+                    outstanding[chain][pair] = now
+            if packets: c.send(packets)
+
+            ##### match responses as they arrive
+            time.sleep(connection_delay/10)
+            read_packets, read_bytestream = c.read()
+            all_packets += read_packets
+            all_bytestreams.append(read_bytestream)
+            for packet in read_packets:
+                if getattr(packet, 'packet_type', None) != larpix.Packet_v2.CONFIG_READ_PACKET: continue
+                pair = (packet.chip_key, packet.register_address)
+                if pair not in read: continue
+                read[pair] = packet.register_data
+                outstanding[(packet.io_group, packet.io_channel)].pop(pair, None)
+
+            ##### give up on requests that have not been answered within the timeout
+            now = time.time()
+            for chain in outstanding:
+                for pair, sent in list(outstanding[chain].items()):
+                    if now - sent > timeout: del outstanding[chain][pair]
+    finally:
+        if not already_listening:
+            c.stop_listening()
+        c.io.group_packets_by_io_group = group_packets_by_io_group
+    c.store_packets(all_packets, b''.join(all_bytestreams), message)
+    return read
+
+
+def verify_registers(c, chip_key_register_pairs, timeout=_default_timeout, connection_delay=_default_connection_delay, n=1, window=_default_window, batch_size=_default_batch_size):
+    '''
+    Read back the specified registers in a single pipelined pass and compare
+    against the configuration stored in the controller. Registers that do not
+    respond are re-read (only those) up to ``n`` passes in total.
+
+    :returns: 2-``tuple`` of ``bool`` and diff ``dict`` in the ``larpix.Controller.verify_registers`` format
+
+    '''
+    registers = _normalize_pairs(c, chip_key_register_pairs)
+    expected = expected_values(c, registers.keys())
+
+    read = dict()
+    to_read = [(chip_key, chip_registers) for chip_key, chip_registers in registers.items()]
+    i_pass = 0
+    while to_read:
+        i_pass += 1
+        read.update(read_registers(c, to_read, timeout=timeout, connection_delay=connection_delay, window=window, batch_size=batch_size))
+        if n > 0 and i_pass >= n: break
+        missing = defaultdict(list)
+        for (chip_key, register), value in read.items():
+            if value is None: missing[chip_key].append(register)
+        to_read = list(missing.items())
+
+    diff = defaultdict(dict)
+    for (chip_key, register), value in read.items():
+        if value != expected[chip_key][register]:
+            diff[chip_key][register] = (expected[chip_key][register], value)
+    return len(diff) == 0, dict(diff)
+
+
+def enforce_registers(c, chip_key_register_pairs, timeout=_default_timeout, connection_delay=_default_connection_delay, n=_default_n, n_verify=_default_n_verify, window=_default_window, batch_size=_default_batch_size):
+    '''
+    Verify the specified registers, then rewrite and re-verify only the
+    registers that failed, up to ``n`` times.
+
+    :returns: 2-``tuple`` with same format as ``verify_registers``
+
+    '''
+    ok, diff = verify_registers(c, chip_key_register_pairs, timeout=timeout, connection_delay=connection_delay, n=n_verify, window=window, batch_size=batch_size)
+    i_pass = 1
+    while not ok and (n < 1 or i_pass < n):
+        i_pass += 1
+        failed = [(chip_key, list(chip_diff.keys())) for chip_key, chip_diff in diff.items()]
+        c.multi_write_configuration(failed, write_read=0, connection_delay=connection_delay)
+        ok, diff = verify_registers(c, failed, timeout=timeout, connection_delay=connection_delay, n=n_verify, window=window, batch_size=batch_size)
+    return ok, diff
+
+
+def verify_configuration(c, chip_keys=None, timeout=_default_timeout, connection_delay=_default_connection_delay, n=_default_n_verify, window=_default_window, batch_size=_default_batch_size):
+    if chip_keys is None: chip_keys = c.chips.keys()
+    if isinstance(chip_keys, (str, larpix.Key)): chip_keys = [chip_keys]
+    return verify_registers(c, [(chip_key, None) for chip_key in chip_keys], timeout=timeout, connection_delay=connection_delay, n=n, window=window, batch_size=batch_size)
+
+
+def enforce_configuration(c, chip_keys=None, timeout=_default_timeout, connection_delay=_default_connection_delay, n=_default_n, n_verify=_default_n_verify, window=_default_window, batch_size=_default_batch_size):
+    if chip_keys is None: chip_keys = c.chips.keys()
+    if isinstance(chip_keys, (str, larpix.Key)): chip_keys = [chip_keys]
+    return enforce_registers(c, [(chip_key, None) for chip_key in chip_keys], timeout=timeout, connection_delay=connection_delay, n=n, n_verify=n_verify, window=window, batch_size=batch_size)
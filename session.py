@@ -0,0 +1,158 @@
+'''
+Persistent controller session shared by the QC scripts
+
+A session process brings the tile up once with ``base.main`` and then keeps
+the ``larpix.Controller`` (and with it the hydra network state) alive while
+QC steps are requested over a local socket. Consecutive steps therefore run
+against an already powered and configured tile instead of power cycling,
+hard resetting and re-initializing the network for every script. Before
+every step the chips are returned to the configuration saved at bring-up,
+so a step does not inherit the settings of the one before.
+
+Usage:
+    start a session (blocks, run in its own terminal):
+        python3 session.py --controller_config <config> serve
+
+    request QC steps from another terminal:
+        python3 session.py pedestal --args '{"runtime": 60}'
+        python3 session.py trigger_rate --args '{"disabled_list": "<file>.json"}'
+        python3 session.py threshold --args '{"pedestal_file": "<file>.h5"}'
+        python3 session.py status
+        python3 session.py shutdown
+
+``--args`` is a JSON dict passed as keyword arguments to the corresponding
+QC script ``main``; ``controller_config`` defaults to the session's.
+
+'''
+
+import base
+import pedestal_qc
+import multi_trigger_rate_qc
+import threshold_qc
+
+import argparse
+import inspect
+import json
+import time
+import traceback
+from multiprocessing.connection import Listener, Client
+
+_default_controller_config=None
+_default_host='localhost'
+_default_port=6100
+_default_authkey='larpix-qc'
+_default_args='{}'
+
+
+def _run_pedestal(c, **kwargs): pedestal_qc.main(c=c, **kwargs)
+
+
+def _run_trigger_rate(c, **kwargs): multi_trigger_rate_qc.main(c=c, **kwargs)
+
+
+def _run_threshold(c, **kwargs): threshold_qc.main(c=c, **kwargs)
+
+
+qc_steps = dict(
+    pedestal=_run_pedestal,
+    trigger_rate=_run_trigger_rate,
+    threshold=_run_threshold,
+    )
+
+commands = list(qc_steps.keys()) + ['status', 'reset', 'shutdown']
+
+
+def status(c, controller_config, history):
+    return dict(
+        controller_config=controller_config,
+        n_chips=len(c.chips),
+        network=dict([(int(io_group), [int(io_channel) for io_channel in io_channels]) for io_group, io_channels in c.network.items()]),
+        logger=c.logger.filename if hasattr(c,'logger') and c.logger else None,
+        history=history,
+        )
+
+
+def handle(c, controller_config, history, command, kwargs):
+    ##### returns (reply, keep serving)
+    if command == 'status':
+        return dict(ok=True, result=status(c, controller_config, history)), True
+    if command == 'shutdown':
+        if hasattr(c,'logger') and c.logger:
+            c.logger.flush()
+            c.logger.disable()
+        ###### disable tile power
+        for io_g, io_c in c.network.items(): c.io.set_reg(0x00000010, 0, io_group=io_g)
+        return dict(ok=True, result=None), False
+    if command == 'reset':
+        ##### in place: reset with a config would return a new controller
+        base.reset(c, verbose=kwargs.get('verbose', False))
+        history.append(('reset', time.time()))
+        return dict(ok=True, result=None), True
+    if command not in qc_steps:
+        return dict(ok=False, error='unknown command {}, options: {}'.format(command, commands)), True
+
+    kwargs.setdefault('controller_config', controller_config)
+    ##### undo what the previous step left on the chips (periodic triggers, masks, trims, ...) so chained
+    ##### steps measure the same as standalone runs
+    ##### verbose is a session option, handed on only to QC steps that take it
+    verbose = kwargs.pop('verbose', False)
+    if 'verbose' in inspect.signature(qc_steps[command]).parameters: kwargs['verbose'] = verbose
+    ok, diff = base.restore_bring_up_config(c, verbose=verbose)
+    if not ok:
+        print('***config error on',len(diff),'chips*** ==> re-initializing their chains')
+        base.reset(c, chip_keys=list(diff.keys()))
+    timeStart = time.time()
+    qc_steps[command](c, **kwargs)
+    timeEnd = time.time()-timeStart
+    history.append((command, timeEnd))
+    print('==> %.3f seconds --- session step %s'%(timeEnd, command))
+    return dict(ok=True, result=dict(runtime=timeEnd)), True
+
+
+def serve(controller_config, host=_default_host, port=_default_port, authkey=_default_authkey):
+    c = base.main(controller_config=controller_config)
+    history = []
+    print('[START SESSION] listening on {}:{}'.format(host, port))
+    with Listener((host, port), authkey=authkey.encode()) as listener:
+        running = True
+        while running:
+            with listener.accept() as conn:
+                command, kwargs = conn.recv()
+                print('[SESSION] received',command,kwargs)
+                try:
+                    reply, running = handle(c, controller_config, history, command, kwargs)
+                except Exception as e:
+                    traceback.print_exc()
+                    reply = dict(ok=False, error=repr(e))
+                conn.send(reply)
+    print('[FINISH SESSION]')
+    return c
+
+
+def request(command, kwargs=None, host=_default_host, port=_default_port, authkey=_default_authkey):
+    with Client((host, port), authkey=authkey.encode()) as conn:
+        conn.send((command, kwargs if kwargs is not None else dict()))
+        return conn.recv()
+
+
+def main(command, controller_config=_default_controller_config, host=_default_host, port=_default_port, authkey=_default_authkey, args=_default_args, **kwargs):
+    if command == 'serve':
+        return serve(controller_config, host=host, port=port, authkey=authkey)
+    kwargs = json.loads(args)
+    if controller_config is not None: kwargs.setdefault('controller_config', controller_config)
+    reply = request(command, kwargs, host=host, port=port, authkey=authkey)
+    if not reply['ok']: raise RuntimeError(reply['error'])
+    print(json.dumps(reply['result'], indent=4))
+    return reply
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('command', choices=['serve']+commands, help='''Start a session (serve) or send a command to a running session''')
+    parser.add_argument('--controller_config', default=_default_controller_config, type=str, help='''Hydra network configuration file''')
+    parser.add_argument('--host', default=_default_host, type=str, help='''Session address (default=%(default)s)''')
+    parser.add_argument('--port', default=_default_port, type=int, help='''Session port (default=%(default)s)''')
+    parser.add_argument('--authkey', default=_default_authkey, type=str, help='''Shared key between session and clients''')
+    parser.add_argument('--args', default=_default_args, type=str, help='''JSON-formatted dict of keyword arguments for the QC step''')
+    args = parser.parse_args()
+    main(**vars(args))
@@ -4,6 +4,12 @@ Loads specified configuration file and collects data until killed (cleanly exits
 Usage:
   python3 -i start_run.py --config_name <config file/dir> --controller_config <controller config file>
 
+  continuous data taking, new file every --runtime seconds:
+  python3 start_run_log_raw.py --config_name <config file/dir> --controller_config <controller config file> --rotate --outdir <dir>
+
+  several PACMANs, one reader/writer thread and raw file per io group:
+  python3 start_run_log_raw.py --config_name <config file/dir> --controller_config <controller config file> --per_io_group --outdir <dir>
+
 '''
 import larpix
 import larpix.io
@@ -12,6 +18,9 @@ import larpix.format.rawhdf5format as rhdf5
 import larpix.format.pacman_msg_format as pacman_msg_fmt
 
 import base
+import pacman_io
+import hdf5_compression
+import occupancy_monitor
 #import load_config
 import enforce_loaded_config
 
@@ -26,6 +35,14 @@ _default_controller_config=None
 _default_runtime=10*60 # 10-min run files
 _default_outdir='./'
 _default_disabled_channels=None
+_default_rotate=False
+_default_per_io_group=False
+_default_handoff_queue_size=pacman_io._default_handoff_queue_size
+_default_compression=hdf5_compression._default_compression
+_default_monitor=False
+_default_monitor_fraction=occupancy_monitor._default_sample_fraction
+_default_hot_rate=occupancy_monitor._default_hot_rate
+_default_monitor_interval=occupancy_monitor._default_interval
 
 def power_registers():
     adcs=['VDDA', 'IDDA', 'VDDD', 'IDDD']
@@ -42,7 +59,7 @@ def power_registers():
         data[i] = l
     return data
 
-def main(config_name=_default_config_name, controller_config=_default_controller_config, runtime=_default_runtime, outdir=_default_outdir, disabled_channels=_default_disabled_channels):
+def main(config_name=_default_config_name, controller_config=_default_controller_config, runtime=_default_runtime, outdir=_default_outdir, disabled_channels=_default_disabled_channels, rotate=_default_rotate, handoff_queue_size=_default_handoff_queue_size, compression=_default_compression, monitor=_default_monitor, monitor_fraction=_default_monitor_fraction, hot_rate=_default_hot_rate, monitor_interval=_default_monitor_interval, per_io_group=_default_per_io_group):
     print('START RUN')
     startTime = time.time()
     # create controller
@@ -65,9 +82,7 @@ def main(config_name=_default_config_name, controller_config=_default_controller
             c[chip].config.external_trigger_mask[external_trigger_channel] = 0
             c[chip].config.channel_mask[external_trigger_channel] = 0
             c.write_configuration(chip)
-        c.io.set_reg(0x02014,0x0000) # enable forward triggers to larpix
-    else:
-        c.io.set_reg(0x02014,0xffffffff) # disable forward triggers to larpix
+    set_trigger_forwarding(c, trigger_forward_enable)
         
     print('Wait 3 seconds for cooling the ASICs...')
     time.sleep(3)
@@ -75,42 +90,166 @@ def main(config_name=_default_config_name, controller_config=_default_controller
     tile_id = 'tile-id-' + controller_config.split('-')[2]
 
     c.io.disable_packet_parsing = True
-    while True:
-        counter = 0
-        last_count = 0
+    if monitor:
+        c.io.monitor = occupancy_monitor.OccupancyMonitor(chains=[(io_group, io_channel) for io_group in c.network for io_channel in c.network[io_group]],
+                                                          outdir=outdir, tile_id=tile_id, sample_fraction=monitor_fraction, hot_rate=hot_rate, interval=monitor_interval)
+        c.io.monitor.start()
+    if per_io_group:
+        parallel_run(c, tile_id, outdir, runtime, rotate, handoff_queue_size, compression)
+        stop_monitor(c)
+        print('END RUN')
+        return c
+    if rotate:
+        rotating_run(c, tile_id, outdir, runtime, handoff_queue_size, compression)
+        stop_monitor(c)
+        print('END RUN')
+        return c
+
+    c.io.raw_filename = run_filename(c, tile_id, outdir)
+    if compression is None:
         c.io.enable_raw_file_writing = True
-        c.io.raw_filename = tile_id + '-' + time.strftime(c.io.default_raw_filename_fmt)
         c.io.join()
         rhdf5.to_rawfile(filename=c.io.raw_filename, io_version=pacman_msg_fmt.latest_version)
-        print('new run file at ',c.io.raw_filename)
+    ##### the larpix-control raw file worker writes only its own layout, packed (compressed) files go through the raw writer thread
+    else: c.io.start_raw_writer(c.io.raw_filename, maxsize=handoff_queue_size, compression=compression)
+    print('new run file at ',c.io.raw_filename)
+    ##### message counters are kept by the io, no need to reopen the raw file for rates
+    c.io.stats_filename = os.path.splitext(c.io.raw_filename)[0] + '-stats.json'
+    c.io.reset_stats()
+    last_stats = c.io.stats()
 
-        c.start_listening()
-        start_time = time.time()
-        last_time = start_time
-        while True:
-            c.read()
-            now = time.time()
-            if now > start_time + runtime: break
-            if now > last_time + 5 and c.io.raw_filename and os.path.isfile(c.io.raw_filename):
-                counter = rhdf5.len_rawfile(c.io.raw_filename, attempts=0)
-                print(' average message rate [delta_t = {:0.2f} s]: {:0.2f} ({:0.02f}Hz)\r'.format(now-last_time,counter-last_count,(counter-last_count)/(now-last_time+1e-9)),end='')
-                last_count = counter
-                last_time = now
- 
-        c.stop_listening()
+    c.start_listening()
+    start_time = time.time()
+    while True:
         c.read()
-        c.io.join()
-        break
+        now = time.time()
+        if now > start_time + runtime: break
+        if now > last_stats['time'] + 5: last_stats = report_rates(c, last_stats)
+
+    c.stop_listening()
+    c.read()
+    c.io.join()
+    c.io.stop_raw_writer()
+    stop_monitor(c)
 
     print('END RUN')
     return c
 
+def set_trigger_forwarding(c, enable):
+    ##### explicitly on every io group of the network
+    for io_group in sorted(c.network):
+        c.io.set_reg(0x02014, 0x0000 if enable else 0xffffffff, io_group=io_group) # enable / disable forward triggers to larpix
+        print('io_group',io_group,'trigger forwarding','enabled' if enable else 'disabled')
+
+def stop_monitor(c):
+    if c.io.monitor is None: return
+    monitor, c.io.monitor = c.io.monitor, None
+    monitor.stop()
+
+def run_filename(c, tile_id, outdir):
+    return os.path.join(outdir, tile_id + '-' + time.strftime(c.io.default_raw_filename_fmt))
+
+def group_filenames(c, tile_id, outdir):
+    now = time.strftime(c.io.default_raw_filename_fmt)
+    return dict([(io_group, os.path.join(outdir, '{}-io_group-{}-{}'.format(tile_id, io_group, now))) for io_group in sorted(c.network)])
+
+def group_stats_filename(tile_id, outdir):
+    ##### one sidecar for all io groups of a per io group run
+    return os.path.join(outdir, '{}-{}-stats.json'.format(tile_id, time.strftime('%Y_%m_%d_%H_%M_%S_%Z')))
+
+def report_rates(c, last_stats):
+    stats = c.io.stats()
+    rates = pacman_io.stats_rates(last_stats, stats)
+    n_messages = sum([counts['messages'] for counts in stats['io_group'].values()]) - sum([counts['messages'] for counts in last_stats['io_group'].values()])
+    print(' average message rate [delta_t = {:0.2f} s]: {:0.2f} ({:0.02f}Hz)'.format(stats['time']-last_stats['time'],n_messages,sum([rate['messages'] for rate in rates.values()])),
+          '\tpacket rate: '+', '.join(['io_group {} {:0.02f}Hz'.format(io_group, rate['packets']) for io_group, rate in sorted(rates.items())])+'\r',end='')
+    return stats
+
+def rotating_run(c, tile_id, outdir, runtime, handoff_queue_size, compression=_default_compression):
+    ##### back-to-back raw files of runtime seconds until killed; the writer thread switches files
+    ##### between two reads, so listening never stops and no message is lost at a file boundary
+    filename = run_filename(c, tile_id, outdir)
+    c.io.start_raw_writer(filename, maxsize=handoff_queue_size, compression=compression, verbose=True)
+    print('new run file at ',filename)
+    c.io.stats_filename = os.path.splitext(filename)[0] + '-stats.json'
+    c.io.reset_stats()
+    last_stats = c.io.stats()
+
+    c.start_listening()
+    file_start_time = time.time()
+    try:
+        while True:
+            c.read()
+            now = time.time()
+            if now > file_start_time + runtime:
+                c.io.write_stats()
+                filename = run_filename(c, tile_id, outdir)
+                c.io.rotate_raw_file(filename)
+                print('\nnew run file at ',filename)
+                c.io.stats_filename = os.path.splitext(filename)[0] + '-stats.json'
+                c.io.reset_stats()
+                last_stats = c.io.stats()
+                file_start_time = now
+            if now > last_stats['time'] + 5: last_stats = report_rates(c, last_stats)
+    except KeyboardInterrupt:
+        print('\nstopping run')
+
+    c.stop_listening()
+    c.read()
+    c.io.write_stats()
+    raw_writer = c.io.stop_raw_writer()
+    for filename, n in raw_writer.n_written.items(): print(n,'messages written to',filename)
+
+def parallel_run(c, tile_id, outdir, runtime, rotate, handoff_queue_size, compression=_default_compression):
+    ##### one reader and one writer thread per io group, each with its own raw file; the main thread
+    ##### only reports rates and, with rotate, switches all io groups to new files every runtime seconds
+    filenames = group_filenames(c, tile_id, outdir)
+    c.io.start_group_readers(filenames, maxsize=handoff_queue_size, compression=compression, verbose=True)
+    for io_group, filename in filenames.items(): print('io_group',io_group,'new run file at ',filename)
+    c.io.stats_filename = group_stats_filename(tile_id, outdir)
+    c.io.reset_stats()
+    last_stats = c.io.stats()
+
+    start_time = time.time()
+    file_start_time = start_time
+    try:
+        while rotate or time.time() < start_time + runtime:
+            time.sleep(0.1)
+            now = time.time()
+            if rotate and now > file_start_time + runtime:
+                c.io.write_stats()
+                filenames = group_filenames(c, tile_id, outdir)
+                c.io.rotate_group_files(filenames)
+                for io_group, filename in filenames.items(): print('\nio_group',io_group,'new run file at ',filename)
+                c.io.stats_filename = group_stats_filename(tile_id, outdir)
+                c.io.reset_stats()
+                last_stats = c.io.stats()
+                file_start_time = now
+            if now > last_stats['time'] + 5:
+                c.io.write_stats()
+                last_stats = report_rates(c, last_stats)
+    except KeyboardInterrupt:
+        print('\nstopping run')
+
+    raw_writers = c.io.stop_group_readers()
+    c.io.write_stats()
+    for io_group, raw_writer in sorted(raw_writers.items()):
+        for filename, n in raw_writer.n_written.items(): print('io_group',io_group,':',n,'messages written to',filename)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--config_name', default=_default_config_name, type=str, help='''Directory or filename to load chip configurations from''')
     parser.add_argument('--controller_config', default=_default_controller_config, type=str, help='''Hydra network configuration file''')
     parser.add_argument('--outdir', default=_default_outdir, type=str, help='''Directory to send data files to''')
     parser.add_argument('--runtime', default=_default_runtime, type=float, help='''Time duration before flushing remaining data to disk and initiating a new run (in seconds) (default=%(default)s)''')
+    parser.add_argument('--rotate', default=_default_rotate, action='store_true', help='''Keep running until killed, starting a new raw file every --runtime seconds without stopping data taking''')
+    parser.add_argument('--per_io_group', default=_default_per_io_group, action='store_true', help='''Receive and write each io group from its own threads, to its own raw file (combines with --rotate)''')
+    parser.add_argument('--handoff_queue_size', default=_default_handoff_queue_size, type=int, help='''Reads pending in the raw file writer thread before data taking waits on it (--rotate, --per_io_group and --compression only) (default=%(default)s)''')
+    parser.add_argument('--compression', default=_default_compression, type=str, help='''Raw file compression, packed raw layout of hdf5_compression, options: {} (default: larpix-control raw file)'''.format(', '.join(hdf5_compression.modes())))
+    parser.add_argument('--monitor', default=_default_monitor, action='store_true', help='''Monitor channel occupancy on a sample of the data, summary json and xy rate png written to --outdir''')
+    parser.add_argument('--monitor_fraction', default=_default_monitor_fraction, type=float, help='''Fraction of messages decoded by the monitor (default=%(default)s)''')
+    parser.add_argument('--hot_rate', default=_default_hot_rate, type=float, help='''Monitor flags channels above this rate [Hz] (default=%(default)s)''')
+    parser.add_argument('--monitor_interval', default=_default_monitor_interval, type=float, help='''Seconds between monitor summaries (default=%(default)s)''')
     parser.add_argument('--disabled_channels', default=_default_disabled_channels, type=json.loads, help='''json-formatted dict of <chip key>:[<channels>] you'd like disabled''')
     args = parser.parse_args()
     c = main(**vars(args))
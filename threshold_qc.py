@@ -3,6 +3,8 @@ import larpix.io
 import larpix.logger
 
 import base
+import packet_view
+import channel_key
 import h5py
 import argparse
 import time
@@ -10,6 +12,7 @@ import numpy as np
 import json
 from collections import Counter
 import copy
+import os
 
 from base import *
 
@@ -25,9 +28,67 @@ _default_cryo=False
 _default_vdda=1800
 _default_normalization=1.
 _default_verbose=False
+_default_sprt=False
+_default_testpulse_scan=False
+_default_n_pulses=10
+_default_start_dac=200
+_default_pulse_dac=20
+_default_channel_spacing=8 # minimum number of test pulse channel sets
+_default_pulse_delay=0.001 # [s] after each DAC edge of a test pulse, as the 1 ms connection_delay of the per-pulse writes
+_default_geometry_yaml='layout-2.4.0.yaml'
+
+##### sequential probability ratio test for rate checks
+_sprt_rate_ratio=3. # tests rate = set_rate/ratio against rate = set_rate*ratio
+_sprt_error=0.05 # type I and type II error
+_sprt_poll_interval=0.05 # [s]
+
+_default_runaway_rate=10000. # [Hz] total, above it FIFOs overflow and quiet channels cannot be trusted
+_default_max_trim_iterations=24
+
+_testpulse_drain_time=0.2 # [s] wait after a pulse train before reading
 
 nonrouted_channels=[6,7,8,9,22,23,24,25,38,39,40,54,55,56,57]
 
+def sprt_rate_check(c, channels_under_test, set_rate, max_time, rate_ratio=_sprt_rate_ratio, error=_sprt_error):
+    ##### stream packets and run a Poisson SPRT per (chip_key, channel) until every channel is confidently
+    ##### above or below set_rate, or max_time; undecided channels fall back to the measured rate
+    ##### returns {(chip_key, channel): rate >= set_rate}, the acquisition time and the total rate
+    keys = list(channels_under_test)
+    index = dict([(key, i) for i, key in enumerate(keys)])
+    counts = np.zeros(len(keys))
+    decided = np.zeros(len(keys), dtype=bool)
+    above = np.zeros(len(keys), dtype=bool)
+    rate_low, rate_high = set_rate/rate_ratio, set_rate*rate_ratio
+    log_ratio = np.log(rate_high/rate_low)
+    upper = np.log((1-error)/error)
+    lower = np.log(error/(1-error))
+
+    base.flush_data(c)
+    c.start_listening()
+    start_time = time.time()
+    all_packets = []
+    n_total = 0
+    while True:
+        time.sleep(_sprt_poll_interval)
+        packets, _ = c.read()
+        all_packets += packets
+        for packet in packets:
+            if packet.packet_type != 0: continue
+            n_total += 1
+            i = index.get((packet.chip_key, packet.channel_id))
+            if i is not None: counts[i] += 1
+        elapsed = time.time() - start_time
+        llr = counts*log_ratio - (rate_high-rate_low)*elapsed
+        newly_decided = ~decided & ((llr >= upper) | (llr <= lower))
+        above[newly_decided] = llr[newly_decided] >= upper
+        decided |= newly_decided
+        if decided.all() or elapsed >= max_time: break
+    c.stop_listening()
+    above[~decided] = counts[~decided]/elapsed >= set_rate
+    c.store_packets(all_packets, b'', 'sprt rate check')
+    print('rate check: {} / {} channels decided in {:0.3f} s'.format(decided.sum(), len(keys), elapsed))
+    return dict(zip(keys, above.tolist())), elapsed, n_total/elapsed
+
 def measure_background_rate_increase_trim(c, extreme_edge_chip_keys, null_sample_time, set_rate, verbose):
     print('=====> Rate threshold: ',set_rate,' Hz')
     flag = True
@@ -46,7 +107,7 @@ def measure_background_rate_increase_trim(c, extreme_edge_chip_keys, null_sample
                 if chip_key not in c.chips: continue
                 c[chip_key].config.pixel_trim_dac[channel] = 31
                 c.write_configuration(chip_key,[channel])
-        c.reads = []
+        c.reads.clear()
         if count == 0: flag = False
 
     return
@@ -79,7 +140,7 @@ def measure_background_rate_disable_csa(c, extreme_edge_chip_keys, csa_disable,
                 c.write_configuration(chip_key,'channel_mask')
                 c.write_configuration(chip_key,'channel_mask')
                 csa_disable[chip_key].append(channel)
-        c.reads = []
+        c.reads.clear()
         if count == 0: flag = False
         #else:
         #   for chip in c.chips:
@@ -109,28 +170,21 @@ def find_pedestal(pedestal_file, noise_cut, c, verbose):
     data_mask = f['packets'][:]['packet_type']==0
     valid_parity_mask = f['packets'][data_mask]['valid_parity']==1
     good_data = (f['packets'][data_mask])[valid_parity_mask]
-    io_group = good_data['io_group'].astype(np.uint64)
-    io_channel = good_data['io_channel'].astype(np.uint64)
-    chip_id = good_data['chip_id'].astype(np.uint64)
-    channel_id = good_data['channel_id'].astype(np.uint64)
-    unique_channels = set(unique_channel_id(io_group, io_channel, chip_id, channel_id))
+    unique_channels, adc_by_channel = channel_key.group(channel_key.encode_packets(good_data), good_data['dataword'])
 
     pedestal_channel, csa_disable = [{} for i in range(2)]
-    for unique in sorted(unique_channels):
-        channel_mask = unique_channel_id(io_group, io_channel, chip_id, channel_id) == unique
-
-        chip_key = from_unique_to_chip_key(unique)
+    for unique, chip_key, channel, adc in zip(unique_channels.tolist(), channel_key.to_chip_keys(unique_channels),
+                                              channel_key.channel_id(unique_channels).tolist(), adc_by_channel):
         if chip_key not in c.chips: continue
 
-        if from_unique_to_channel_id(unique) in nonrouted_channels:
+        if channel in nonrouted_channels:
             continue
 
-        adc = good_data[channel_mask]['dataword']
         if len(adc) < 2 or np.mean(adc)>200. or np.std(adc)>noise_cut or np.mean(adc)==0:
-            if verbose: print(from_unique_to_chip_key(unique),' disabling channel',from_unique_to_channel_id(unique),
+            if verbose: print(chip_key,' disabling channel',channel,
                               ' with %.2f pedestal ADC RMS'%np.std(adc))
             if chip_key not in csa_disable: csa_disable[chip_key] = []
-            csa_disable[chip_key].append(from_unique_to_channel_id(unique))
+            csa_disable[chip_key].append(channel)
             count_noisy += 1
             continue
 
@@ -138,7 +192,7 @@ def find_pedestal(pedestal_file, noise_cut, c, verbose):
 
     temp, temp_mu, temp_std = [ {} for i in range(3)]
     for unique in pedestal_channel.keys():
-        chip_key = from_unique_to_chip_key(unique)
+        chip_key = channel_key.to_chip_key(unique)
         if chip_key not in temp:
             temp[chip_key], temp_mu[chip_key], temp_std[chip_key] = [ [] for i in range(3)]
         temp[chip_key].append(pedestal_channel[unique]['mu']+pedestal_channel[unique]['std'])
@@ -308,9 +362,9 @@ def find_trim_dac_seed(c, channels, cryo, vdda,
 
     chip_register_pairs = []
     for i in pedestal_channel.keys():
-        ped_chip_key = from_unique_to_chip_key(i)
+        ped_chip_key = channel_key.to_chip_key(i)
         if ped_chip_key not in c.chips: continue
-        ped_channel = from_unique_to_channel_id(i)
+        ped_channel = int(channel_key.channel_id(i))
         if ped_channel not in channels: continue
 
         x = trim_sigma[str(ped_channel)] * from_ADC_to_mV(c, ped_chip_key, pedestal_channel[i]['std'], False, vdda)
@@ -348,8 +402,8 @@ def channel_stop_listen(c, chip_keys, channel):
         chip_register_pairs.append( (chip_key, list(range(66,74))+list(range(131,139)) ) )
     c.multi_write_configuration(chip_register_pairs, connection_delay=0.001)
 
-def send_testpulse(c, chip_keys, channel, n_pulses, start_dac, pulse_dac):
-    c.reads = []
+def send_testpulse(c, chip_keys, channel, n_pulses, start_dac, pulse_dac, pulse_delay=_default_pulse_delay):
+    c.reads.clear()
     chip_register_pairs = []
     for chip_key in chip_keys:
         c[chip_key].config.csa_testpulse_enable = [1]*64
@@ -360,19 +414,8 @@ def send_testpulse(c, chip_keys, channel, n_pulses, start_dac, pulse_dac):
     packet, byte = ([] for i in range(2))
 
     c.start_listening()
-    for i in range(n_pulses):
-        chip_register_pairs = []
-        for chip_key in chip_keys:
-            c[chip_key].config.csa_testpulse_dac = start_dac-pulse_dac
-            chip_register_pairs.append( (chip_key, 108) )
-        c.multi_write_configuration(chip_register_pairs, connection_delay=0.001)
-
-        chip_register_pairs = []
-        for chip_key in chip_keys:
-            c[chip_key].config.csa_testpulse_dac = start_dac
-            chip_register_pairs.append( (chip_key, [108]) )
-        c.multi_write_configuration(chip_register_pairs, connection_delay=0.001)
-
+    send_pulse_train(c, chip_keys, n_pulses, start_dac, pulse_dac, pulse_delay)
+    time.sleep(_testpulse_drain_time)
     read_packets, read_bytestream = c.read()
     c.stop_listening()
 
@@ -386,13 +429,135 @@ def send_testpulse(c, chip_keys, channel, n_pulses, start_dac, pulse_dac):
     data = b''.join(byte)
     c.store_packets(packet,data,'')
 
+    view = packet_view.PacketView(c.reads[-1])
     eff_dict = {}
     for chip_key in chip_keys:
-        eff_dict[chip_key] = len(c.reads[-1].extract('channel_id',packet_type=0,channel_id=channel,chip_id=chip_key.chip_id))/n_pulses
-        if len(c.reads[-1].extract('channel_id',packet_type=0,channel_id=channel,chip_id=chip_key.chip_id))/n_pulses>0:
-            print (chip_key,' efficiency: ',len(c.reads[-1].extract('channel_id',packet_type=0,channel_id=channel,chip_id=chip_key.chip_id))/n_pulses)
+        eff_dict[chip_key] = view.count(packet_type=0,channel_id=channel,chip_id=chip_key.chip_id)/n_pulses
+        if eff_dict[chip_key]>0:
+            print (chip_key,' efficiency: ',eff_dict[chip_key])
     return eff_dict
 
+def pulse_packets(c, chip_keys, start_dac, pulse_dac):
+    ##### DAC toggle writes of one pulse on all chips, built once for the whole train: the low edge
+    ##### (start_dac-pulse_dac) and the high edge (start_dac) packets; chains are interleaved by the io
+    chain_chip_keys = dict()
+    for chip_key in chip_keys:
+        chain_chip_keys.setdefault((chip_key.io_group, chip_key.io_channel), []).append(chip_key)
+    low, high = [], []
+    for chain, keys in chain_chip_keys.items():
+        for chip_key in keys:
+            c[chip_key].config.csa_testpulse_dac = start_dac-pulse_dac
+            low += c[chip_key].get_configuration_write_packets([108])
+        for chip_key in keys:
+            c[chip_key].config.csa_testpulse_dac = start_dac
+            high += c[chip_key].get_configuration_write_packets([108])
+    return low, high
+
+def send_pulse_train(c, chip_keys, n_pulses, start_dac, pulse_dac, pulse_delay=_default_pulse_delay):
+    ##### pulse_delay after each DAC edge, so that the CSA reset and readback of an edge finish before the next one
+    low, high = pulse_packets(c, chip_keys, start_dac, pulse_dac)
+    for i in range(n_pulses):
+        c.send(low)
+        time.sleep(pulse_delay)
+        c.send(high)
+        time.sleep(pulse_delay)
+
+def load_pixel_adjacency(geometry_yaml=_default_geometry_yaml):
+    ##### {channel: set of channels} with a pixel next to (diagonals included) a pixel of the channel,
+    ##### on the same or a neighbouring chip of the layout
+    import yaml
+    with open(geometry_yaml) as fi: geo = yaml.full_load(fi)
+    pixels = [(chip_id, channel, pix) for chip_id, pix_list in geo['chips'] for channel, pix in enumerate(pix_list) if pix is not None]
+    x = np.array([geo['pixels'][pix][1] for _, _, pix in pixels])
+    y = np.array([geo['pixels'][pix][2] for _, _, pix in pixels])
+    pitch = np.min(np.diff(np.unique(np.round(x, 3))))
+    grid = dict([((int(i), int(j)), channel) for (_, channel, _), i, j in zip(pixels, np.round((x-x.min())/pitch), np.round((y-y.min())/pitch))])
+    adjacency = dict()
+    for (i, j), channel in grid.items():
+        for di in (-1,0,1):
+            for dj in (-1,0,1):
+                neighbour = grid.get((i+di, j+dj))
+                if neighbour is None or neighbour == channel: continue
+                adjacency.setdefault(channel, set()).add(neighbour)
+    return adjacency
+
+def testpulse_channel_sets(channels, channel_spacing=_default_channel_spacing, geometry_yaml=_default_geometry_yaml):
+    ##### channel sets pulsed together on all chips, no two channels of a set on adjacent pixels anywhere
+    ##### on the tile; greedy colouring of the pixel adjacency, most constrained channel first, each channel
+    ##### into the smallest allowed set of at least channel_spacing sets
+    adjacency = load_pixel_adjacency(geometry_yaml)
+    channel_sets = [[] for i in range(channel_spacing)]
+    for channel in sorted(channels, key=lambda channel: (-len(adjacency.get(channel, ())), channel)):
+        allowed = [channel_set for channel_set in channel_sets if not adjacency.get(channel, set()) & set(channel_set)]
+        if not allowed:
+            allowed = [[]]
+            channel_sets += allowed
+        min(allowed, key=len).append(channel)
+    return [sorted(channel_set) for channel_set in channel_sets if channel_set]
+
+def testpulse_efficiency_scan(c, chip_keys, channels, csa_disable, n_pulses=_default_n_pulses,
+                   start_dac=_default_start_dac, pulse_dac=_default_pulse_dac,
+                   channel_spacing=_default_channel_spacing, channel_sets=None, pulse_delay=_default_pulse_delay,
+                   geometry_yaml=_default_geometry_yaml, verbose=False):
+    ##### test pulse efficiency of every channel; each channel set (default: testpulse_channel_sets)
+    ##### is pulsed on all chips at once, all other channels masked
+    ##### returns {(chip_key, channel): efficiency}
+    if channel_sets is None: channel_sets = testpulse_channel_sets(channels, channel_spacing, geometry_yaml)
+    previous = dict([(chip_key, (list(c[chip_key].config.channel_mask), list(c[chip_key].config.csa_enable), c[chip_key].config.csa_testpulse_dac)) for chip_key in chip_keys])
+    registers = list(range(66,74))+list(range(100,109))+list(range(131,139))
+
+    efficiency = dict()
+    for channel_set in channel_sets:
+        timeStart = time.time()
+        pulsed = dict()
+        chip_register_pairs = []
+        for chip_key in chip_keys:
+            pulsed[chip_key] = [channel for channel in channel_set if channel not in csa_disable.get(chip_key, [])]
+            c[chip_key].config.channel_mask = [1]*64 # registers [131-138]
+            c[chip_key].config.csa_testpulse_enable = [1]*64 # registers [100-107], active low
+            c[chip_key].config.csa_testpulse_dac = start_dac # register 108
+            for channel in pulsed[chip_key]:
+                c[chip_key].config.channel_mask[channel] = 0
+                c[chip_key].config.csa_enable[channel] = 1 # registers [66-73]
+                c[chip_key].config.csa_testpulse_enable[channel] = 0
+            chip_register_pairs.append( (chip_key, registers) )
+        c.multi_write_configuration(chip_register_pairs, connection_delay=0.001)
+        base.flush_data(c)
+
+        c.reads.clear()
+        c.start_listening()
+        send_pulse_train(c, chip_keys, n_pulses, start_dac, pulse_dac, pulse_delay)
+        time.sleep(_testpulse_drain_time)
+        read_packets, read_bytestream = c.read()
+        c.stop_listening()
+        c.store_packets(read_packets, read_bytestream, 'testpulse scan')
+
+        triggers = packet_view.PacketView(c.reads[-1]).counts('io_group','io_channel','chip_id','channel_id', packet_type=0)
+        for chip_key in chip_keys:
+            for channel in pulsed[chip_key]:
+                efficiency[(chip_key, channel)] = triggers.get((chip_key.io_group, chip_key.io_channel, chip_key.chip_id, channel), 0)/n_pulses
+                if verbose and efficiency[(chip_key, channel)] != 1: print(chip_key,' channel ',channel,' efficiency: ',efficiency[(chip_key, channel)])
+        n_dead = len([key for key in efficiency if key[1] in channel_set and efficiency[key] == 0])
+        print('channels',channel_set,'pulsed on',len(chip_keys),'chips:',n_dead,'without triggers','%.3f s'%(time.time()-timeStart))
+
+    chip_register_pairs = []
+    for chip_key in chip_keys:
+        c[chip_key].config.channel_mask, c[chip_key].config.csa_enable, c[chip_key].config.csa_testpulse_dac = previous[chip_key]
+        c[chip_key].config.csa_testpulse_enable = [1]*64
+        chip_register_pairs.append( (chip_key, registers) )
+    c.multi_write_configuration(chip_register_pairs, connection_delay=0.001)
+    return efficiency
+
+def save_testpulse_efficiency(efficiency, tile_id):
+    record = dict()
+    for (chip_key, channel), eff in efficiency.items():
+        record.setdefault(channel_key.chip_key_string(chip_key), dict())[channel] = eff
+    time_format = time.strftime('%Y_%m_%d_%H_%S_%Z')
+    filename = tile_id+'-testpulse-efficiency-'+time_format+'.json'
+    with open(filename, 'w') as outfile:
+        json.dump(record, outfile, indent=4)
+    print('test pulse efficiency saved to',filename)
+
 def set_pixel_trim(c, channel, status):
     chip_register_pairs = []
     for chip_key in status.keys():
@@ -403,15 +568,12 @@ def set_pixel_trim(c, channel, status):
     c.multi_write_configuration(chip_register_pairs, connection_delay=0.001)
     return
 
-def chip_key_string(chip_key):
-    return '-'.join([str(int(chip_key.io_group)),str(int(chip_key.io_channel)),str(int(chip_key.chip_id))])
-
 def note_tagged_from_outset(channel, csa_disable, record):
     for chip_key in csa_disable.keys():
         if chip_key not in record:
-            record[chip_key_string(chip_key)] = []
+            record[channel_key.chip_key_string(chip_key)] = []
         if channel in csa_disable[chip_key]:
-            record[chip_key_string(chip_key)].append(-1)
+            record[channel_key.chip_key_string(chip_key)].append(-1)
     return
 
 def update(c, status, csa_disable, channel):
@@ -430,7 +592,8 @@ def update(c, status, csa_disable, channel):
         chip_register_pairs.append( (chip_key, [channel]) )
     c.multi_write_configuration(chip_register_pairs, connection_delay=0.001)
 
-def update_chip(c, status):
+def update_chip(c, status, previous_configs=None):
+    ##### with previous_configs (chip key: config as last written) only the registers that changed are written
     chip_register_pairs = []
     for chip_key in status.keys():
         chip_register_pairs.append( (chip_key, list(range(64))+ list(range(66,74)) +list(range(131,139) ) ))
@@ -440,7 +603,8 @@ def update_chip(c, status):
                 c[chip_key].config.csa_enable[channel] = 0
                 c[chip_key].config.channel_mask[channel] = 1
 
-    c.multi_write_configuration(chip_register_pairs, connection_delay=0.001)
+    if previous_configs is None: c.multi_write_configuration(chip_register_pairs, connection_delay=0.001)
+    else: c.differential_write_configuration([(chip_key, previous_configs[chip_key]) for chip_key in status.keys()], connection_delay=0.001)
     return
 
 def silence_all(c, chip_keys):
@@ -453,70 +617,85 @@ def silence_all(c, chip_keys):
     return
 
 def toggle_trim(c, channels, csa_disable, extreme_edge_chip_keys,
-              null_sample_time, set_rate, verbose):
+              null_sample_time, set_rate, verbose, sprt=_default_sprt, runaway_rate=_default_runaway_rate,
+              max_iterations=_default_max_trim_iterations):
+    ##### search each channel's pixel trim DAC, all chips and channels in parallel, for the lowest trim with
+    ##### rate below set_rate; bracket is (low, high], high==32 means CSA disabled
+    ##### the first step is at the seed trim (find_trim_dac_seed, or as configured), then the bracket grows
+    ##### from the seed in doubling steps until both ends are measured and is bisected from there
+    ##### runaway guard as threshold_search: above runaway_rate total, the quiet decisions of a step are discarded
     status = {}
     for chip_key in c.chips:
         l = list(c[chip_key].config.pixel_trim_dac)
-        status[chip_key] = dict( pixel_trim=l, active=[True]*64, disable=[False]*64)
+        status[chip_key] = dict( pixel_trim=l, active=[True]*64, disable=[False]*64, low=[-1]*64, high=[32]*64, step=[1]*64)
         for channel in range(64):
             if channel in csa_disable[chip_key]:
                 status[chip_key]['active'][channel] = False
                 status[chip_key]['disable'][channel] = True
+            elif channel not in channels:
+                status[chip_key]['active'][channel] = False
 
     iter_ctr = 0
-    flag = True
-    while flag:
+    while True:
         timeStart = time.time()
+        previous_configs = dict([(chip_key, copy.deepcopy(c[chip_key].config)) for chip_key in status])
+        n_active = 0
+        for chip_key in status:
+            for channel in range(64):
+                if status[chip_key]['active'][channel] == False: continue
+                n_active += 1
+                low, high, step = status[chip_key]['low'][channel], status[chip_key]['high'][channel], status[chip_key]['step'][channel]
+                if iter_ctr == 0: continue # seed
+                if low == -1 and high < 32: trim = max(high-step, 0) # only quiet measured, expand down
+                elif high == 32 and low > -1: trim = min(low+step, 31) # only noisy measured, expand up
+                else: trim = (low+high)//2
+                status[chip_key]['pixel_trim'][channel] = trim
+        if iter_ctr == max_iterations:
+            ##### unresolved (runaway every step) channels stay at the quiet end of their bracket
+            for chip_key in status:
+                for channel in range(64):
+                    if status[chip_key]['active'][channel] == False: continue
+                    status[chip_key]['active'][channel] = False
+                    status[chip_key]['pixel_trim'][channel] = min(status[chip_key]['high'][channel], 31)
+            print(n_active,'channels unresolved after',iter_ctr,'iterations')
+            n_active = 0
+        update_chip(c, status, previous_configs)
+        if n_active == 0: break
+
         iter_ctr += 1
-        base.flush_data(c)
-        c.multi_read_configuration(extreme_edge_chip_keys, timeout=null_sample_time,message='rate check')
-        triggered_channels = c.reads[-1].extract('chip_key','channel_id',packet_type=0)
-        print('total rate={}Hz'.format(len(triggered_channels)/null_sample_time))
-        fired_channels = {}
-        for chip_key, channel in set(map(tuple,triggered_channels)):
-            if chip_key not in fired_channels: fired_channels[chip_key] = []
-            fired_channels[chip_key].append(channel)
-            rate = triggered_channels.count([chip_key,channel])/null_sample_time
-            if chip_key not in status.keys(): continue
-            if status[chip_key]['active'][channel] == False: continue
+        channels_under_test = [(chip_key, channel) for chip_key in status for channel in range(64) if status[chip_key]['active'][channel]]
+        if sprt:
+            above, _, total_rate = sprt_rate_check(c, channels_under_test, set_rate, null_sample_time)
+        else:
+            base.flush_data(c)
+            c.multi_read_configuration(extreme_edge_chip_keys, timeout=null_sample_time,message='rate check')
+            triggered_channels = c.reads[-1].extract('chip_key','channel_id',packet_type=0)
+            total_rate = len(triggered_channels)/null_sample_time
+            print('total rate={}Hz'.format(total_rate), '\tchannels under test:',n_active)
+            triggers = Counter(map(tuple,triggered_channels))
+            above = dict([(key, triggers[key]/null_sample_time >= set_rate) for key in channels_under_test])
+
+        runaway = total_rate > runaway_rate
+        if runaway: print('runaway rate {:0.1f} Hz at iteration {} -- quiet decisions discarded'.format(total_rate, iter_ctr))
+        for chip_key in status:
+            for channel in range(64):
+                if status[chip_key]['active'][channel] == False: continue
+                if above[(chip_key,channel)]: status[chip_key]['low'][channel] = status[chip_key]['pixel_trim'][channel]
+                elif not runaway: status[chip_key]['high'][channel] = status[chip_key]['pixel_trim'][channel]
+                if iter_ctr > 1: status[chip_key]['step'][channel] *= 2
+                if status[chip_key]['high'][channel] - status[chip_key]['low'][channel] > 1: continue
 
-            if rate >= set_rate:
-                if verbose: print(chip_key,' channel ',channel,' pixel trim',status[chip_key]['pixel_trim'][channel],'below noise floor -- increasing trim')
-                status[chip_key]['pixel_trim'][channel] += 1
-                if status[chip_key]['pixel_trim'][channel]>31:
+                status[chip_key]['active'][channel] = False
+                if status[chip_key]['high'][channel] > 31:
                     status[chip_key]['pixel_trim'][channel] = 31
                     status[chip_key]['disable'][channel] = True
-                    status[chip_key]['active'][channel] = False
                     csa_disable[chip_key].append(channel)
                     if verbose: print(chip_key,' channel ',channel,'pixel trim maxed out below noise floor!!! -- channel CSA disabled')
                 else:
-                    status[chip_key]['active'][channel] = False
-                    if verbose: print('pixel trim set at',status[chip_key]['pixel_trim'][channel])
-            else:
-                status[chip_key]['pixel_trim'][channel] -= 1
-                if status[chip_key]['pixel_trim'][channel]<0:
-                    status[chip_key]['pixel_trim'][channel] = 0
-                    status[chip_key]['active'][channel] = False
-                    if verbose: print('pixel trim bottomed out above noise floor!!!')
-
-        for chip_key in c.chips:
-            if status[chip_key]['active'] == [False]*64: continue
-            for channel in channels:
-                if status[chip_key]['active'][channel] == False: continue
-                if chip_key in fired_channels:
-                    if channel in fired_channels[chip_key]: continue
-                status[chip_key]['pixel_trim'][channel] -= 1
-                if status[chip_key]['pixel_trim'][channel]<0:
-                    status[chip_key]['pixel_trim'][channel] = 0
-                    status[chip_key]['active'][channel] = False
-                    if verbose: print('pixel trim bottomed out above noise floor!!!')
+                    status[chip_key]['pixel_trim'][channel] = status[chip_key]['high'][channel]
+                    if verbose and status[chip_key]['high'][channel] == 0: print(chip_key,' channel ',channel,'pixel trim bottomed out above noise floor!!!')
+                    elif verbose: print(chip_key,' channel ',channel,'pixel trim set at',status[chip_key]['pixel_trim'][channel])
 
-        update_chip(c, status)
-        count = 0
-        for chip_key in status:
-            if True in status[chip_key]['active']: count+=1
-            if count == 1: break
-        if count == 0: flag = False
         timeEnd = time.time()-timeStart
         print('iteration ', iter_ctr,' processing time %.3f seconds\n\n'%timeEnd)
 
@@ -557,11 +736,19 @@ def main(controller_config=_default_controller_config,
          vdda=_default_vdda,
          normalization=_default_normalization,
          verbose=_default_verbose,
+         sprt=_default_sprt,
+         testpulse_scan=_default_testpulse_scan,
+         n_pulses=_default_n_pulses,
+         pulse_dac=_default_pulse_dac,
+         channel_spacing=_default_channel_spacing,
+         pulse_delay=_default_pulse_delay,
+         geometry_yaml=_default_geometry_yaml,
+         c=None,
          **kwargs):
 
     time_initial = time.time()
 
-    c = base.main(controller_config=controller_config)
+    if c is None: c = base.main(controller_config=controller_config)
     base.flush_data(c, runtime=2)
     print('START THRESHOLD\n')
 
@@ -638,9 +825,18 @@ def main(controller_config=_default_controller_config,
     ###timeEnd = time.time() - timeStart
     ###print('==> %.3f seconds --- measured background rate with seeded global & trim DACs\n --> trim DAC maxed out for channels that exceed rate\n\n'%timeEnd)
 
+    if os.path.isfile(trim_sigma_file):
+        ##### per-channel starting point of the trim DAC search
+        timeStart = time.time()
+        trim_sigma = load_trim_sigma(trim_sigma_file)
+        find_trim_dac_seed(c, channels, cryo, vdda, pedestal_channel, pedestal_chip, trim_sigma)
+        timeEnd = time.time() - timeStart
+        print('==> %.3f seconds --- set trim DAC seed \n\n'%timeEnd)
+    else: print('no trim DAC scale factor file',trim_sigma_file,'--- trim DAC search starts from the current trim')
+
     timeStart = time.time()
     toggle_trim(c, channels, csa_disable, extreme_edge_chip_keys,
-                null_sample_time, set_rate, verbose)
+                null_sample_time, set_rate, verbose, sprt)
     timeEnd = time.time() - timeStart
     print('==> %.3f seconds --- toggle trim DACs'%timeEnd)
     tile_id = 'tile-id-' + controller_config.split('-')[2]
@@ -649,6 +845,15 @@ def main(controller_config=_default_controller_config,
     timeEnd = time.time()-timeStart
     print('==> %.3f seconds --- saving to json config file \n'%timeEnd)
 
+    if testpulse_scan:
+        timeStart = time.time()
+        efficiency = testpulse_efficiency_scan(c, chip_keys, channels, csa_disable, n_pulses=n_pulses,
+                                               pulse_dac=pulse_dac, channel_spacing=channel_spacing, pulse_delay=pulse_delay,
+                                               geometry_yaml=geometry_yaml, verbose=verbose)
+        save_testpulse_efficiency(efficiency, tile_id)
+        timeEnd = time.time()-timeStart
+        print('==> %.3f seconds --- test pulse efficiency scan \n'%timeEnd)
+
     time10 = time.time()-time_initial
     print('END THRESHOLD ==> %.3f seconds total run time'%time10)
     return c
@@ -697,6 +902,34 @@ if __name__ == '__main__':
     parser.add_argument('--normalization',
                         default=_default_normalization,
                         type=float, help='''Seeded threshold scale factor''')
+    parser.add_argument('--sprt',
+                        default=_default_sprt,
+                        action='store_true',
+                        help='''Stop each trim rate check as soon as every channel is confidently above or below --set_rate (--null_sample_time is the maximum)''')
+    parser.add_argument('--testpulse_scan',
+                        default=_default_testpulse_scan,
+                        action='store_true',
+                        help='''Measure test pulse efficiency of all enabled channels after threshold setting''')
+    parser.add_argument('--n_pulses',
+                        default=_default_n_pulses,
+                        type=int,
+                        help='''Test pulses per channel (default=%(default)s)''')
+    parser.add_argument('--pulse_dac',
+                        default=_default_pulse_dac,
+                        type=int,
+                        help='''Test pulse amplitude in DAC counts (default=%(default)s)''')
+    parser.add_argument('--channel_spacing',
+                        default=_default_channel_spacing,
+                        type=int,
+                        help='''Minimum number of test pulse channel sets, limits the active channels per chip (default=%(default)s)''')
+    parser.add_argument('--pulse_delay',
+                        default=_default_pulse_delay,
+                        type=float,
+                        help='''Wait after each DAC edge of a test pulse [s] (default=%(default)s)''')
+    parser.add_argument('--geometry_yaml',
+                        default=_default_geometry_yaml,
+                        type=str,
+                        help='''Pixel layout, channels on adjacent pixels are not pulsed together (default=%(default)s)''')
     parser.add_argument('--verbose',
                         default=_default_verbose,
                         action='store_true',
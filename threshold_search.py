@@ -0,0 +1,104 @@
+'''
+Parallel bisection of the global threshold DAC
+
+Every chip under test keeps a bracket ``(low, high]`` on ``threshold_global``
+where ``low`` is known (or assumed) to trigger above the target rate and
+``high`` is known (or assumed) to be quiet. Each step sets every unresolved
+chip to the middle of its bracket with one batched write, takes a single
+acquisition for the whole tile and moves each chip's bracket from its own
+rate, so the full 0-255 range resolves in ~8 steps.
+
+Runaway guard: if the total rate of a step exceeds ``runaway_rate`` (FIFOs
+overflow and quiet-looking chips cannot be trusted), only the "noisy"
+decisions of that step are kept; the noisy chips move up and the others are
+measured again at the same threshold in the next step. Chips whose bracket
+closes are set to its quiet end before the next step. ``max_steps`` caps
+the number of acquisitions.
+
+Usage:
+    import threshold_search
+    thresholds, unresolved = threshold_search.bisect_global_dac(c, chip_keys, target_rate=2.)
+
+'''
+
+import time
+from collections import Counter
+
+import base
+
+_default_runtime=1. # [s] acquisition per step
+_default_target_rate=2. # [Hz] per channel (or per chip)
+_default_runaway_rate=10000. # [Hz] total
+_default_low=-1 # assumed noisy
+_default_high=255 # assumed quiet
+_default_max_steps=16
+
+_threshold_global_register=64
+
+
+def write_thresholds(c, chip_keys):
+    chip_register_pairs = [(chip_key, _threshold_global_register) for chip_key in chip_keys]
+    if not chip_register_pairs: return
+    c.multi_write_configuration(chip_register_pairs, write_read=0, connection_delay=0.001)
+    c.multi_write_configuration(chip_register_pairs, write_read=0, connection_delay=0.001)
+
+
+def measure_rates(c, chip_keys, runtime=_default_runtime, per_channel=True):
+    ##### one acquisition for all chips, returns {chip_key: rate} and the total rate
+    ##### per_channel: a chip's rate is that of its noisiest channel, otherwise the chip total
+    base.flush_data(c)
+    c.run(runtime,'global threshold bisection')
+    triggers = Counter()
+    n_total = 0
+    for packet in c.reads[-1]:
+        if packet.packet_type != 0: continue
+        n_total += 1
+        triggers[(packet.chip_key, packet.channel_id) if per_channel else packet.chip_key] += 1
+    rates = dict([(chip_key, 0.) for chip_key in chip_keys])
+    for key, n in triggers.items():
+        chip_key = key[0] if per_channel else key
+        if chip_key in rates: rates[chip_key] = max(rates[chip_key], n/runtime) if per_channel else n/runtime
+    return rates, n_total/runtime
+
+
+def bisect_global_dac(c, chip_keys, target_rate=_default_target_rate, runtime=_default_runtime, low=_default_low, high=_default_high, runaway_rate=_default_runaway_rate, max_steps=_default_max_steps, per_channel=True, verbose=False):
+    '''
+    Find, for all chips in parallel, the lowest ``threshold_global`` in
+    ``(low, high]`` with rate at or below ``target_rate``.
+
+    ``low`` and ``high`` are either a single value for all chips or a
+    ``dict`` of ``{chip_key: value}``. The threshold of each chip is left
+    at its result in the controller and on the chip.
+
+    :returns: 2-``tuple`` of ``{chip_key: threshold_global}`` and the list of chips that did not converge within ``max_steps``
+
+    '''
+    chip_keys = list(chip_keys)
+    low = dict([(chip_key, low[chip_key] if isinstance(low, dict) else low) for chip_key in chip_keys])
+    high = dict([(chip_key, high[chip_key] if isinstance(high, dict) else high) for chip_key in chip_keys])
+    active = [chip_key for chip_key in chip_keys if high[chip_key] - low[chip_key] > 1]
+
+    step = 0
+    while active and step < max_steps:
+        step += 1
+        timeStart = time.time()
+        for chip_key in active: c[chip_key].config.threshold_global = (low[chip_key] + high[chip_key])//2
+        write_thresholds(c, active)
+        rates, total_rate = measure_rates(c, active, runtime=runtime, per_channel=per_channel)
+
+        runaway = total_rate > runaway_rate
+        for chip_key in active:
+            if rates[chip_key] > target_rate: low[chip_key] = c[chip_key].config.threshold_global
+            elif not runaway: high[chip_key] = c[chip_key].config.threshold_global
+        if runaway: print('runaway rate {:0.1f} Hz at step {} -- quiet decisions discarded'.format(total_rate, step))
+        resolved = [chip_key for chip_key in active if high[chip_key] - low[chip_key] <= 1]
+        active = [chip_key for chip_key in active if high[chip_key] - low[chip_key] > 1]
+        ##### resolved chips go to the quiet end of their bracket now, so they do not keep triggering in later steps
+        for chip_key in resolved: c[chip_key].config.threshold_global = high[chip_key]
+        write_thresholds(c, resolved)
+        if verbose: print('step',step,'total rate {:0.1f} Hz'.format(total_rate),len(active),'chips unresolved','%.3f s'%(time.time()-timeStart))
+
+    ##### leave every chip at the quiet end of its bracket
+    for chip_key in chip_keys: c[chip_key].config.threshold_global = high[chip_key]
+    write_thresholds(c, chip_keys)
+    return dict([(chip_key, high[chip_key]) for chip_key in chip_keys]), active
@@ -2,7 +2,9 @@ import larpix
 import larpix.io
 import larpix.logger
 
+import base
 import base___no_enforce
+import channel_key
 
 import argparse
 import json
@@ -22,11 +24,12 @@ suffix = ['no_cut','10kHz_cut','1kHz_cut','100Hz_cut']
 
 v2a_nonrouted_channels=[6,7,8,9,22,23,24,25,38,39,40,54,55,56,57]
 
-def initial_setup(ctr, controller_config):
+def initial_setup(ctr, controller_config, c=None):
     now = datetime.now().strftime("%Y_%m_%d_%H_%M_%S")
     fname="trigger_rate_%s_" % suffix[ctr] #str(rate_cut[ctr])
     fname=fname+str(now)+".h5"
-    c = base___no_enforce.main(controller_config, logger=True, filename=fname)
+    if c is None: c = base___no_enforce.main(controller_config, logger=True, filename=fname)
+    else: base.rotate_logger(c, fname)
     return c, fname
 
 def find_mode(l):
@@ -72,53 +75,24 @@ def asic_test(c, chips_to_test, forbidden, threshold, runtime):
         c.logger.record_configs([c[chip_key]])
 
               
-def unique_channel_id(io_group, io_channel, chip_id, channel_id):
-    return channel_id + 100*(chip_id + 1000*(io_channel + 1000*(io_group)))
-
-
-def from_unique_to_chip_key(unique):
-    io_group = (unique // (100*1000*1000)) % 1000
-    io_channel = (unique // (100*1000)) % 1000
-    chip_id = (unique // 100) % 1000
-    return larpix.Key(io_group, io_channel, chip_id)
-
-def chip_key_to_string(chip_key):
-    return '-'.join([str(int(chip_key.io_group)),str(int(chip_key.io_channel)),str(int(chip_key.chip_id))])
-              
-def from_unique_to_channel_id(unique):
-    return int(unique) % 100
-              
-              
 def evaluate_rate(fname, ctr, runtime, forbidden):
-    f = h5py.File(fname,'r')
-    data_mask=f['packets'][:]['packet_type']==0
-    data=f['packets'][data_mask]
-
-    io_group=data['io_group'].astype(np.uint64)
-    io_channel=data['io_channel'].astype(np.uint64)
-    chip_id=data['chip_id'].astype(np.uint64)
-    channel_id=data['channel_id'].astype(np.uint64)
-    unique_channels = set(unique_channel_id(io_group, io_channel, chip_id, channel_id))
-
-    for unique in sorted(unique_channels):
-        channel_mask = unique_channel_id(io_group, io_channel, chip_id, channel_id) == unique
-        triggers = len(data[channel_mask]['dataword'])
-        if triggers/runtime > rate_cut[ctr]:
-            pair = ( chip_key_to_string(from_unique_to_chip_key(unique)), from_unique_to_channel_id(unique) )
-            if pair not in forbidden:
-                forbidden.append(pair)
-                print(pair,' added to do not enable list')
+    with h5py.File(fname,'r') as f: packets=f['packets'][:]
+    data=packets[packets['packet_type']==0]
+
+    ##### triggers per channel in one pass, forbidden is a set of (chip key string, channel)
+    unique_channels, triggers = np.unique(channel_key.encode_packets(data), return_counts=True)
+    hot_channels = unique_channels[triggers/runtime > rate_cut[ctr]]
+    for pair in zip(channel_key.to_strings(hot_channels), channel_key.channel_id(hot_channels).tolist()):
+        if pair not in forbidden:
+            forbidden.add(pair)
+            print(pair,' added to do not enable list')
     return forbidden
 
 
-def chip_key_string(chip_key):
-    return '-'.join([str(int(chip_key.io_group)),str(int(chip_key.io_channel)),str(int(chip_key.chip_id))])
-
-              
 def save_do_not_enable_list(forbidden):
     d = {}
-    for p in forbidden:
-        #ck = chip_key_string(p[0])
+    for p in sorted(forbidden, key=lambda p: (str(p[0]), p[1])):
+        #ck = channel_key.chip_key_string(p[0])
         ck = str(p[0])
         #ck = p[0]
         if ck not in d: d[ck]=[]
@@ -138,7 +112,7 @@ def main(controller_config=_default_controller_config, chip_key=_default_chip_ke
     print('chips to test: ',chips_to_test)
     print('==> \tfound ASICs to test')
 
-    forbidden=[] # list of (chip key, channel) to disable, to be updated as script progresses
+    forbidden=set() # set of (chip key, channel) to disable, to be updated as script progresses
     if disabled_list:
         print('applying disabled list: ', disabled_list)
         with open(disabled_list,'r') as f:
@@ -146,16 +120,16 @@ def main(controller_config=_default_controller_config, chip_key=_default_chip_ke
             for key in disable_input.keys():
                 channel_list = disable_input[key]
                 for chan in channel_list:
-                    forbidden.append((key,chan))
+                    forbidden.add((key,chan))
     else:
         print('No disabled list provided. Default disabled list applied.')
         for chip_key in chips_to_test:
             for channel in v2a_nonrouted_channels:
-                forbidden.append((chip_key,channel))
+                forbidden.add((chip_key,channel))
     print('==> \tinitial channel disable list set')
 
     for ctr in range(len(rate_cut)):
-        c, fname = initial_setup(ctr, controller_config)
+        c, fname = initial_setup(ctr, controller_config, c)
         print('==> \ttesting ASICs with ',rate_cut[ctr],' Hz trigger rate threshold')
         asic_test(c, chips_to_test, forbidden, threshold, runtime)
         if ctr==3: continue